@@ -0,0 +1,8 @@
+"""
+The ``apimws`` application contains the integration of the MWS panel with the
+external systems: the VM API, Ansible, the IP register database, Jackdaw and
+BES++.
+
+"""
+
+default_app_config = 'apimws.apps.ApiMWSConfig'
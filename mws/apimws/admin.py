@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin
 from reversion.admin import VersionAdmin
-from apimws.models import AnsibleConfiguration, PHPLib, Host, Cluster
+from apimws.models import AnsibleConfiguration, PHPLib, Host, Cluster, AnsibleRun, AnsibleRollout
 
 
 class AnsibleConfigurationAdmin(VersionAdmin):
@@ -10,8 +10,46 @@ class AnsibleConfigurationAdmin(VersionAdmin):
     list_display = ('key', 'value', 'service')
 
 
+class HostAdmin(ModelAdmin):
+
+    model = Host
+    list_display = ('hostname', 'cluster', 'numcpu', 'sizeram', 'sizedisk')
+    list_filter = ('cluster', )
+
+
+class AnsibleRunAdmin(ModelAdmin):
+
+    model = AnsibleRun
+    list_display = ('id', 'service', 'started_at', 'finished_at', 'successful', 'num_requests', 'reasons', 'tags')
+    list_filter = ('successful', )
+
+
+def stop_rollouts(modeladmin, request, queryset):
+    from apimws.rollout import stop_rollout
+    for rollout in queryset:
+        stop_rollout(rollout)
+
+
+stop_rollouts.short_description = "Stop rollout"
+
+
+class AnsibleRolloutAdmin(ModelAdmin):
+
+    model = AnsibleRollout
+    list_display = ('id', 'created_at', 'finished_at', 'status', 'progress')
+    list_filter = ('status', )
+    actions = [stop_rollouts]
+
+    def progress(self, obj):
+        progress = obj.progress()
+        return ", ".join("%s: %d" % (status, progress[status]) for status in
+                         ['pending', 'running', 'done', 'failed', 'skipped'])
+
+
 admin.site.register(AnsibleConfiguration, AnsibleConfigurationAdmin)
+admin.site.register(AnsibleRollout, AnsibleRolloutAdmin)
+admin.site.register(AnsibleRun, AnsibleRunAdmin)
 # admin.site.register(ApacheModule, VersionAdmin)
 admin.site.register(PHPLib, VersionAdmin)
 admin.site.register(Cluster, ModelAdmin)
-admin.site.register(Host, ModelAdmin)
+admin.site.register(Host, HostAdmin)
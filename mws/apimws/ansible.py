@@ -1,27 +1,94 @@
 import logging
 import subprocess
+from collections import OrderedDict
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 from celery import shared_task, Task
+from django.conf import settings
 from django.utils import timezone
+from apimws.models import AnsibleRunRequest, AnsibleRun
 from sitesmanagement.models import Site, Snapshot, Service, Vhost
 
 
 LOGGER = logging.getLogger('mws')
 
+# Ansible tags of the roles that need to be run for each reason why a run can be requested (AnsibleRunRequest.REASONS).
+# Reasons not listed here need the full playbook to be run. It is empty so that every run is a full run: a run with
+# tags that the playbook does not define does nothing and still succeeds, and the changes that depend on it (e.g.
+# deleting the unix groups marked to be deleted) would be applied as if ansible had run. Partial runs are enabled
+# with the MWS_ANSIBLE_TAGS setting once the playbook defines the tags, e.g. {'vhosts': ['vhosts'], 'domains':
+# ['vhosts'], 'tls': ['vhosts', 'tls'], 'users': ['users'], 'unix_groups': ['unix_groups']}.
+ANSIBLE_TAGS = {}
+
 
 class UnexpectedVMStatus(Exception):
     pass
 
 
+class VMCommandError(subprocess.CalledProcessError):
+    """Raised by run_in_vms when the command has failed in any of the VMs. errors contains the CalledProcessError of
+    each of the VMs where it failed by VM name. It is a CalledProcessError itself so that it is handled as if the
+    command had been run in a single VM."""
+    def __init__(self, errors):
+        self.errors = errors
+        first_error = errors.values()[0]
+        output = "\n".join("%s: %s" % (vm_name, error.output) for vm_name, error in errors.items())
+        super(VMCommandError, self).__init__(first_error.returncode, first_error.cmd, output)
+
+    def __str__(self):
+        return "Command failed in %s: %s" % (", ".join(self.errors.keys()),
+                                             "; ".join(str(error) for error in self.errors.values()))
+
+
+def run_in_vms(vms, command):
+    """Runs a userv/ansible command in each of the VMs concurrently, up to MWS_ANSIBLE_VM_CONCURRENCY VMs at a time.
+    :param vms: the VirtualMachines (with their network_configuration already fetched)
+    :param command: function that returns the command line to run for the VM passed as parameter
+    :return: the output of the command by VM name, in the same order as the VMs
+    :raises VMCommandError: if the command has failed in any of the VMs, once all of them have finished
+    """
+    # Commands are generated beforehand so that the threads do not need to query the database
+    commands = [(vm.network_configuration.name, command(vm)) for vm in vms]
+
+    def run(vm_command):
+        vm_name, cmd = vm_command
+        try:
+            return vm_name, subprocess.check_output(cmd, stderr=subprocess.STDOUT), None
+        except subprocess.CalledProcessError as e:
+            return vm_name, None, e
+
+    if len(commands) > 1:
+        pool = ThreadPool(min(len(commands), getattr(settings, 'MWS_ANSIBLE_VM_CONCURRENCY', 4)))
+        try:
+            results = pool.map(run, commands)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run, commands)
+
+    errors = OrderedDict((vm_name, error) for vm_name, output, error in results if error is not None)
+    if errors:
+        raise VMCommandError(errors)
+    return OrderedDict((vm_name, output) for vm_name, output, error in results)
+
+
 def refresh_object(obj):
     """ Reload an object from the database """
     return obj.__class__._default_manager.get(pk=obj.pk)
 
 
-def launch_ansible(service):
+def launch_ansible(service, reason='full'):
+    """Requests ansible to be run in the VMs of the service. The run is delayed MWS_ANSIBLE_DEBOUNCE seconds so that
+    all the requests made in the meantime (e.g. a burst of edits of the vhosts of the service) are covered by it.
+    :param service: the Service
+    :param reason: why ansible needs to be run, one of AnsibleRunRequest.REASONS
+    """
+    AnsibleRunRequest.objects.create(service=service, reason=reason)
     if service.status == 'ready':
         service.status = 'ansible'
         service.save()
-        launch_ansible_async.delay(service)
+        launch_ansible_async.apply_async(args=(service, ), countdown=getattr(settings, 'MWS_ANSIBLE_DEBOUNCE', 10))
     elif service.status == 'ansible':
         service.status = 'ansible_queued'
         service.save()
@@ -33,17 +100,39 @@ def launch_ansible(service):
         raise UnexpectedVMStatus()  # TODO pass the vm object?
 
 
-def launch_ansible_by_user(user):
-    for site in Site.objects.all():
-        if user in site.list_of_all_type_of_active_users() and not site.is_canceled():
-            launch_ansible_site(site)  # TODO: Change this to other thing more sensible
+def ansible_tags(service, reasons):
+    """Returns the list of ansible tags that need to be run to apply the changes requested for the service, or None
+    if the full playbook needs to be run. A full run is done when one of the reasons is not covered by any tag, when
+    the changes affect more than MWS_ANSIBLE_PARTIAL_MAX_TAGS tags (a full run is as quick) or when the last
+    successful full run is older than MWS_ANSIBLE_FULL_RUN_INTERVAL seconds.
+    :param service: the Service
+    :param reasons: the list of reasons of the requests covered by the run
+    """
+    tags_by_reason = getattr(settings, 'MWS_ANSIBLE_TAGS', ANSIBLE_TAGS)
+    if not reasons or any(reason not in tags_by_reason for reason in reasons):
+        return None
+    tags = sorted(set(tag for reason in reasons for tag in tags_by_reason[reason]))
+    if len(tags) > getattr(settings, 'MWS_ANSIBLE_PARTIAL_MAX_TAGS', 3):
+        return None
+    full_run_interval = timedelta(seconds=getattr(settings, 'MWS_ANSIBLE_FULL_RUN_INTERVAL', 24*60*60))
+    if not AnsibleRun.objects.filter(service=service, tags='', successful=True,
+                                     started_at__gt=timezone.now() - full_run_interval).exists():
+        return None
+    return tags
 
 
-def launch_ansible_site(site):
+def launch_ansible_by_user(user, reason='users'):
+    if not user.is_active:
+        return
+    for site in Site.sites_of_user(user).filter(end_date__isnull=True):
+        launch_ansible_site(site, reason)
+
+
+def launch_ansible_site(site, reason='full'):
     if site.production_service and site.production_service.active:
-        launch_ansible(site.production_service)
+        launch_ansible(site.production_service, reason)
     if site.test_service and site.test_service.active:
-        launch_ansible(site.test_service)
+        launch_ansible(site.test_service, reason)
 
 
 class AnsibleTaskWithFailure(Task):
@@ -51,7 +140,7 @@ class AnsibleTaskWithFailure(Task):
     abstract = True
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        if type(exc) is subprocess.CalledProcessError:
+        if isinstance(exc, subprocess.CalledProcessError):
             LOGGER.error("An error happened when trying to execute Ansible.\nThe task id is %s.\n\n"
                          "The parameters passed to the task were: \nargs: %s\nkwargs: %s\n\nThe traceback is:\n%s\n\n"
                          "The output from the command was: %s\n", task_id, args, kwargs, einfo, exc.output)
@@ -68,43 +157,59 @@ class AnsibleTaskWithFailure(Task):
 @shared_task(base=AnsibleTaskWithFailure, default_retry_delay=120, max_retries=2)
 def launch_ansible_async(service, ignore_host_key=False):
     while service.status != 'ready':
+        # All the changes requested until now are covered by this run, new requests will queue another one
+        Service.objects.filter(pk=service.pk, status='ansible_queued').update(status='ansible')
+        run = AnsibleRun.start(service)
+        tags = None if ignore_host_key else ansible_tags(service, filter(None, run.reasons.split(',')))
+        if tags:
+            run.tags = ",".join(tags)
+            run.save()
+        LOGGER.info("Running ansible for service %s covering %d requests (%s) with tags: %s", service.id,
+                    run.num_requests, run.reasons, run.tags or "all")
+        if tags:
+            command = lambda vm: ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
+                                  "--tags", run.tags]
+        elif ignore_host_key:
+            command = lambda vm: ["userv", "--defvar", "ANSIBLE_HOST_KEY_CHECKING=False", "mws-admin",
+                                  "mws_ansible_host", vm.network_configuration.name]
+        else:
+            command = lambda vm: ["userv", "mws-admin", "mws_ansible_host", vm.network_configuration.name]
         try:
-            for vm in service.virtual_machines.all():
-                if ignore_host_key:
-                    subprocess.check_output(["userv", "--defvar", "ANSIBLE_HOST_KEY_CHECKING=False", "mws-admin",
-                                             "mws_ansible_host", vm.network_configuration.name],
-                                            stderr=subprocess.STDOUT)
-                else:
-                    subprocess.check_output(["userv", "mws-admin", "mws_ansible_host", vm.network_configuration.name],
-                                        stderr=subprocess.STDOUT)
+            run_in_vms(service.virtual_machines.select_related('network_configuration'), command)
         except subprocess.CalledProcessError as e:
+            run.finish(successful=False)
             raise launch_ansible_async.retry(exc=e)
+        run.finish(successful=True)
         service = refresh_object(service)
+        if not tags or 'unix_groups' in tags:
+            # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
+            service.unix_groups.filter(to_be_deleted=True).delete()
         if service.status == 'ansible_queued':
             service.status = 'ansible'
             service.save()
+            debounce = getattr(settings, 'MWS_ANSIBLE_DEBOUNCE', 10)
+            if debounce:
+                # More changes were requested while ansible was running, wait for them to settle
+                launch_ansible_async.apply_async(args=(service, ignore_host_key), countdown=debounce)
+                return
         else:
             service.status = 'ready'
             service.save()
-        # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
-        service.unix_groups.filter(to_be_deleted=True).delete()
 
 
 @shared_task(base=AnsibleTaskWithFailure)
 def ansible_change_mysql_root_pwd(service):
-    for vm in service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
-                                 "--tags", "change_mysql_root_pwd", "-e", "change_mysql_root_pwd=true"],
-                                stderr=subprocess.STDOUT)
+    run_in_vms(service.virtual_machines.select_related('network_configuration'),
+               lambda vm: ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
+                           "--tags", "change_mysql_root_pwd", "-e", "change_mysql_root_pwd=true"])
 
 
 @shared_task(base=AnsibleTaskWithFailure)
 def ansible_create_custom_snapshot(service, snapshot):
     try:
-        for vm in service.virtual_machines.all():
-            subprocess.check_output(["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
-                                     "--tags", "create_custom_snapshot", "-e",
-                                     'create_snapshot_name="%s"' % snapshot.name], stderr=subprocess.STDOUT)
+        run_in_vms(service.virtual_machines.select_related('network_configuration'),
+                   lambda vm: ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
+                               "--tags", "create_custom_snapshot", "-e", 'create_snapshot_name="%s"' % snapshot.name])
         snapshot.date = timezone.now()
         snapshot.save()
     except Exception as e:
@@ -114,31 +219,28 @@ def ansible_create_custom_snapshot(service, snapshot):
 
 @shared_task(base=AnsibleTaskWithFailure)
 def restore_snapshot(service, snapshot_name):
-    for vm in service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
-                                 "--tags", "restore_snapshot", "-e", 'restore_snapshot_name="%s"' % snapshot_name],
-                                stderr=subprocess.STDOUT)
+    run_in_vms(service.virtual_machines.select_related('network_configuration'),
+               lambda vm: ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
+                           "--tags", "restore_snapshot", "-e", 'restore_snapshot_name="%s"' % snapshot_name])
 
 
 @shared_task(base=AnsibleTaskWithFailure)
 def delete_snapshot(service, snapshot_id):
     snapshot = Snapshot.objects.get(id=snapshot_id)
-    for vm in snapshot.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
-                                 "--tags", "delete_snapshot", "-e", 'delete_snapshot_name="%s"' % snapshot.name],
-                                stderr=subprocess.STDOUT)
+    run_in_vms(snapshot.service.virtual_machines.select_related('network_configuration'),
+               lambda vm: ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name,
+                           "--tags", "delete_snapshot", "-e", 'delete_snapshot_name="%s"' % snapshot.name])
     snapshot.delete()
 
 
 @shared_task(base=AnsibleTaskWithFailure)
 def delete_vhost_ansible(service, vhost_name, vhost_webapp):
     '''delete the vhost folder and all its contents '''
-    for vm in service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_delete_vhost", vm.network_configuration.name,
-                                 "--tags", "delete_vhost", "-e", "delete_vhost_name=%s delete_vhost_webapp=%s" %
-                                 (vhost_name, vhost_webapp)],
-                                stderr=subprocess.STDOUT)
-    launch_ansible(service)
+    run_in_vms(service.virtual_machines.select_related('network_configuration'),
+               lambda vm: ["userv", "mws-admin", "mws_delete_vhost", vm.network_configuration.name,
+                           "--tags", "delete_vhost", "-e", "delete_vhost_name=%s delete_vhost_webapp=%s" %
+                           (vhost_name, vhost_webapp)])
+    launch_ansible(service, 'vhosts')
     return
 
 
@@ -146,9 +248,9 @@ def delete_vhost_ansible(service, vhost_name, vhost_webapp):
 def vhost_enable_apache_owned(vhost_id):
     '''Changes ownership of the docroot folder to the user www-data'''
     vhost = Vhost.objects.get(id=vhost_id)
-    for vm in vhost.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
-                                 vhost.name, "enable"], stderr=subprocess.STDOUT)
+    run_in_vms(vhost.service.virtual_machines.select_related('network_configuration'),
+               lambda vm: ["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
+                           vhost.name, "enable"])
     vhost.apache_owned = True
     vhost.save()
     vhost_disable_apache_owned.apply_async(args=(vhost_id,), countdown=3600) # Leave an hour to the user
@@ -158,8 +260,8 @@ def vhost_enable_apache_owned(vhost_id):
 def vhost_disable_apache_owned(vhost_id):
     '''Revert the ownership of the docroot folder back to site-admin'''
     vhost = Vhost.objects.get(id=vhost_id)
-    for vm in vhost.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
-                                 vhost.name, "disable"], stderr=subprocess.STDOUT)
+    run_in_vms(vhost.service.virtual_machines.select_related('network_configuration'),
+               lambda vm: ["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
+                           vhost.name, "disable"])
     vhost.apache_owned = False
     vhost.save()
@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+
+
+class ApiMWSConfig(AppConfig):
+    """
+    Configuration for the apimws application.
+
+    """
+    name = "apimws"
+
+    def ready(self):
+        """
+        Perform application-specific initialisation.
+
+        """
+        # import (and, hence, register) signal handlers. The import is done
+        # within ready() to minimise disruption from importing application
+        # code. See: https://docs.djangoproject.com/en/1.8/topics/signals/.
+        from . import signals
@@ -1,35 +1,151 @@
 '''API to output data to Bes++'''
+import hashlib
 import json
-from datetime import date
-from django.db.models import Q
-from django.http import HttpResponse
+from datetime import date, datetime, time, timedelta
+from itertools import chain
+from django.conf import settings
+from django.db.models import Q, Prefetch
+from django.http import StreamingHttpResponse, HttpResponseBadRequest, HttpResponseGone
+from django.utils import timezone
+from django.views.decorators.http import condition
 from stronghold.decorators import public
-from sitesmanagement.models import Site, VirtualMachine
+from apimws.models import BesChange
+from sitesmanagement.models import Site, Service, VirtualMachine
+
+
+# Do not backup sites that have been cancelled or sites that are not ready
+# Backups from sites that disappear from the bes API will still be kept during 14 days before getting deleted
+BES_SERVICE_STATUSES = ('ansible', 'ansible_queued', 'ready')
+
+
+def bes_sites():
+    """Sites included in the feed. Filtering by the ids of the services avoids the duplicates that a join with them
+    would return for sites with both services ready"""
+    return Site.objects.filter(Q(deleted=False) & (Q(end_date__isnull=True) | Q(end_date__gt=date.today())),
+                               id__in=Service.objects.filter(status__in=BES_SERVICE_STATUSES).values('site_id'))
+
+
+def bes_site(site):
+    json_site = {}
+    json_site['id'] = "mwssite-%s" % site.id
+    for sitekey in site.keys.all():
+        json_site['ssh-public-key-%s' % sitekey.type.lower()] = sitekey.public_key
+    json_vms = []
+    for vm in sorted((vm for service in site.services.all() for vm in service.virtual_machines.all()),
+                     key=lambda vm: vm.id):
+        json_vm = {}
+        json_vm['name'] = vm.name
+        json_vm['disabled'] = site.disabled
+        json_vm['fqdn'] = vm.network_configuration.name
+        json_vm['service_fqdn'] = vm.service.network_configuration.name
+        json_vm['location'] = 'mws-cluster-1'  # TODO change it for a variable in the model
+        json_vm['backup'] = ['/replicated']  # TODO change it for a variable?
+        json_vm['backup-user'] = "dump"  # TODO change it for a variable in the model
+        json_vms.append(json_vm)
+    json_site['vms'] = json_vms
+    return json_site
+
+
+def bes_feed(site_ids):
+    """Yields the entries of the sites given, fetched BES_FEED_CHUNK_SIZE sites at a time with four queries per
+    chunk"""
+    chunk_size = getattr(settings, 'BES_FEED_CHUNK_SIZE', 200)
+    vms = VirtualMachine.objects.select_related('network_configuration')
+    services = Service.objects.select_related('network_configuration') \
+        .prefetch_related(Prefetch('virtual_machines', queryset=vms))
+    for start in range(0, len(site_ids), chunk_size):
+        for site in Site.objects.filter(id__in=site_ids[start:start+chunk_size]).order_by('id') \
+                .prefetch_related('keys', Prefetch('services', queryset=services)):
+            yield bes_site(site)
+
+
+def stream_json_list(items):
+    """Yields the JSON of the list of items, formatted as json.dumps would do, one item at a time"""
+    yield '['
+    for n, item in enumerate(items):
+        yield (', ' if n else '') + json.dumps(item)
+    yield ']'
+
+
+def prune_bes_changes():
+    """Deletes the changes older than BES_CHANGE_LOG_DAYS days, except the last one. The backup system needs to get
+    the full feed again if its token is older than that"""
+    latest = BesChange.latest()
+    if latest:
+        since = timezone.now() - timedelta(days=getattr(settings, 'BES_CHANGE_LOG_DAYS', 30))
+        return BesChange.objects.filter(changed_at__lt=since, id__lt=latest.id).delete()[0]
+    return 0
+
+
+def parse_since(request):
+    """Returns the token passed in the since parameter, None if there is none, or raises ValueError"""
+    since = request.GET.get('since')
+    if since is None or since == '':
+        return None
+    since = int(since)
+    if since < 0:
+        raise ValueError(since)
+    return since
+
+
+def _bes_version(request):
+    # Computed once per request for both the ETag and the Last-Modified headers. The feed also changes when the
+    # cancelled sites reach their end date, so the date is part of the version
+    if not hasattr(request, '_bes_version'):
+        latest = BesChange.latest()
+        request._bes_change = latest
+        midnight = timezone.make_aware(datetime.combine(date.today(), time()))
+        request._bes_version = (hashlib.md5("%d-%s-%s" % (latest.id if latest else 0, date.today(),
+                                                          request.GET.get('since', ''))).hexdigest(),
+                                max(latest.changed_at, midnight) if latest else midnight)
+    return request._bes_version
+
+
+def bes_changes(since):
+    """Returns the entries of the sites changed after the change since, and tombstones for the sites changed or
+    cancelled since then that are no longer backed up. Returns None if the changes after since are not available
+    anymore (see BES_CHANGE_LOG_DAYS).
+
+    Two transactions committed at about the same time may insert their changes in the opposite order to their ids,
+    so the changes recorded during the BES_CHANGE_SAFETY_SECONDS before the change since are sent again: the entries
+    of the sites are the same every time they are sent"""
+    first = BesChange.objects.order_by('id').first()
+    if since > 0 and (first is None or since < first.id - 1):
+        return None
+    since_change = BesChange.objects.filter(id__lte=since).order_by('-id').first() or first
+    changes = Q(id__gt=since)
+    if since_change:
+        safety = timedelta(seconds=getattr(settings, 'BES_CHANGE_SAFETY_SECONDS', 60))
+        changes |= Q(changed_at__gt=since_change.changed_at - safety)
+    changed = set(BesChange.objects.filter(changes).values_list('site_id', flat=True))
+    if since_change:
+        # The sites that have reached their end date have not been saved
+        changed.update(Site.objects.filter(end_date__gt=timezone.localtime(since_change.changed_at).date(),
+                                           end_date__lte=date.today()).values_list('id', flat=True))
+    site_ids = sorted(bes_sites().filter(id__in=changed).values_list('id', flat=True))
+    tombstones = [{'id': "mwssite-%s" % site_id, 'deleted': True} for site_id in sorted(changed - set(site_ids))]
+    return chain(bes_feed(site_ids), tombstones)
 
 
 @public
+@condition(etag_func=lambda request: _bes_version(request)[0],
+           last_modified_func=lambda request: _bes_version(request)[1])
 def bes(request):
-    json_all = []
-    for site in Site.objects.filter(
-                    Q(deleted=False, services__status__in=('ansible', 'ansible_queued', 'ready'))
-                    & (Q(end_date__isnull=True) | Q(end_date__gt=date.today()))):
-        # Do not backup sites that have been cancelled or sites that are not ready
-        # Backups from sites that disappear from the bes API will still be kept during 14 days before getting deleted
-        json_site = {}
-        json_site['id'] = "mwssite-%s" % site.id
-        for sitekey in site.keys.all():
-            json_site['ssh-public-key-%s' % sitekey.type.lower()] = sitekey.public_key
-        json_vms = []
-        for vm in VirtualMachine.objects.filter(service__site = site):
-            json_vm = {}
-            json_vm['name'] = vm.name
-            json_vm['disabled'] = vm.service.site.disabled
-            json_vm['fqdn'] = vm.network_configuration.name
-            json_vm['service_fqdn'] = vm.service.network_configuration.name
-            json_vm['location'] = 'mws-cluster-1'  # TODO change it for a variable in the model
-            json_vm['backup'] = ['/replicated']  # TODO change it for a variable?
-            json_vm['backup-user'] = "dump"  # TODO change it for a variable in the model
-            json_vms.append(json_vm)
-        json_site['vms'] = json_vms
-        json_all.append(json_site)
-    return HttpResponse(json.dumps(json_all), content_type='application/json')
+    """Returns the backup feed of all the sites, or only the sites changed after the token given in the since
+    parameter. The token to pass in the next request is returned in the X-BES-Token header"""
+    try:
+        since = parse_since(request)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid since token")
+    _bes_version(request)
+    token = request._bes_change.id if request._bes_change else 0
+    if since is None:
+        site_ids = list(bes_sites().order_by('id').values_list('id', flat=True))
+        entries = bes_feed(site_ids)
+    else:
+        entries = bes_changes(min(since, token))
+        if entries is None:
+            return HttpResponseGone("The changes after the token given are not available, get the full feed")
+    response = StreamingHttpResponse(stream_json_list(entries), content_type='application/json')
+    response['X-BES-Token'] = str(token)
+    return response
@@ -0,0 +1,80 @@
+"""
+The :py:mod:`~apimws.capacity` module reports the resources available and used in each cluster and forecasts when
+they will run out at the current rate of sites created and cancelled, so that hardware can be planned before new
+VMs cannot be placed anywhere (see :py:mod:`apimws.placement`).
+
+"""
+
+from datetime import date, timedelta
+from django.conf import settings
+from django.db.models import Sum, Count, Case, When, IntegerField
+from apimws.models import Host
+from apimws.placement import cluster_loads, RESOURCES
+from sitesmanagement.models import Site
+
+
+def site_growth(days):
+    """Returns the number of sites started and the resources of the sites started minus the ones of the sites
+    cancelled in the last days, computed in a single query"""
+    since = date.today() - timedelta(days=days)
+
+    def conditional_sum(value, **conditions):
+        return Sum(Case(When(then=value, **conditions), default=0, output_field=IntegerField()))
+
+    aggregates = {'started': Count(Case(When(start_date__gt=since, then='id')))}
+    for resource in RESOURCES:
+        aggregates['started_' + resource] = conditional_sum('type__' + resource, start_date__gt=since)
+        aggregates['ended_' + resource] = conditional_sum('type__' + resource, end_date__gt=since)
+    totals = Site.objects.filter(preallocated=False).aggregate(**aggregates)
+    return totals['started'], dict((resource, (totals['started_' + resource] or 0) - (totals['ended_' + resource] or 0))
+                                   for resource in RESOURCES)
+
+
+def capacity_report(days=None):
+    """Returns the capacity and usage of each cluster and of all of them together, and the date in which each of
+    the resources is expected to run out based on the sites created and cancelled in the last days (by default
+    MWS_CAPACITY_FORECAST_DAYS)"""
+    days = days or getattr(settings, 'MWS_CAPACITY_FORECAST_DAYS', 90)
+    hosts = {}
+    for host in Host.objects.order_by('hostname'):
+        hosts.setdefault(host.cluster_id, []).append(dict((resource, getattr(host, resource))
+                                                          for resource in ('hostname', ) + RESOURCES))
+
+    clusters = []
+    total = {'capacity': dict.fromkeys(RESOURCES, 0), 'used': dict.fromkeys(RESOURCES, 0), 'guests': 0}
+    for load in cluster_loads():
+        clusters.append({
+            'name': load.cluster.name,
+            'hosts': hosts.get(load.cluster.name, []),
+            'capacity': load.capacity,
+            'used': load.used,
+            'guests': load.guests,
+            'utilisation': load.utilisation(),
+        })
+        for resource in RESOURCES:
+            total['capacity'][resource] += load.capacity[resource]
+            total['used'][resource] += load.used[resource]
+        total['guests'] += load.guests
+    total['free'] = dict((resource, total['capacity'][resource] - total['used'][resource]) for resource in RESOURCES)
+
+    started, growth = site_growth(days)
+    exhaustion = {}
+    for resource in RESOURCES:
+        if not total['capacity'][resource]:
+            exhaustion[resource] = None  # Unknown
+        elif total['free'][resource] <= 0:
+            exhaustion[resource] = date.today()
+        elif growth[resource] > 0:
+            exhaustion[resource] = date.today() + timedelta(days=total['free'][resource] * days / growth[resource])
+        else:
+            exhaustion[resource] = None  # Not growing
+    return {
+        'clusters': clusters,
+        'total': total,
+        'forecast': {
+            'days': days,
+            'sites_per_day': float(started) / days,
+            'growth_per_day': dict((resource, float(growth[resource]) / days) for resource in RESOURCES),
+            'exhaustion': exhaustion,
+        },
+    }
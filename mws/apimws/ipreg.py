@@ -1,6 +1,9 @@
+import copy
 import json
 import logging
 import subprocess
+import threading
+import time
 from celery import shared_task
 from django.conf import settings
 from apimws.jackdaw import SSHTaskWithFailure
@@ -9,7 +12,24 @@ from apimws.jackdaw import SSHTaskWithFailure
 LOGGER = logging.getLogger('mws')
 
 
-def ip_reg_call(call):
+# Calls that only read from the IPREG database. Their results are cached for IP_REG_API_CACHE_TTL seconds, the
+# entries of a hostname are dropped when a call writes to it
+READ_CALLS = {('get', 'nameinfo'), ('get', 'cname'), ('find', 'sshfp')}
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def invalidate_cache(hostname=None):
+    """Drops the cached results of the read calls for the hostname given, or all of them"""
+    with _cache_lock:
+        if hostname is None:
+            _cache.clear()
+        else:
+            for key in [key for key in _cache if key[2] == str(hostname)]:
+                del _cache[key]
+
+
+def userv_ip_reg_call(call):
     try:
         response = subprocess.check_output(settings.IP_REG_API_END_POINT + call)
     except subprocess.CalledProcessError as excp:
@@ -25,6 +45,78 @@ def ip_reg_call(call):
     return result
 
 
+def ip_reg_call(call):
+    """Makes a call to the IPREG API backend configured in IP_REG_API_BACKEND: "userv" (default) for the real one, or
+    "fake" for the in-memory :py:class:`FakeIPRegBackend`"""
+    call = [str(arg) for arg in call]
+    key = tuple(call[:3])
+    if key[:2] not in READ_CALLS:
+        if len(call) > 2:
+            invalidate_cache(call[2])
+        return _ip_reg_backend_call(call)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached and cached[0] > time.time():
+        return copy.deepcopy(cached[1])
+    result = _ip_reg_backend_call(call)
+    ttl = getattr(settings, 'IP_REG_API_CACHE_TTL', 60)
+    if ttl:
+        with _cache_lock:
+            _cache[key] = (time.time() + ttl, copy.deepcopy(result))
+    return result
+
+
+def _ip_reg_backend_call(call):
+    if getattr(settings, 'IP_REG_API_BACKEND', 'userv') == 'fake':
+        return fake_backend.call(call)
+    return userv_ip_reg_call(call)
+
+
+def ip_reg_batch(calls):
+    """Submits several calls to the IPREG API and returns their results in the same order. The result of a call that
+    failed is the CalledProcessError that ip_reg_call would have raised for it, so that one failure does not prevent
+    the other calls from being made. If IP_REG_API_BATCH is set all the calls are submitted in a single request to the
+    batch method of the API, otherwise they are made one after the other."""
+    if not getattr(settings, 'IP_REG_API_BATCH', False) or \
+            getattr(settings, 'IP_REG_API_BACKEND', 'userv') == 'fake':
+        results = []
+        for call in calls:
+            try:
+                results.append(ip_reg_call(call))
+            except subprocess.CalledProcessError as excp:
+                results.append(excp)
+        return results
+
+    calls = [[str(arg) for arg in call] for call in calls]
+    for call in calls:
+        if tuple(call[:2]) not in READ_CALLS and len(call) > 2:
+            invalidate_cache(call[2])
+    command = settings.IP_REG_API_END_POINT + ['batch']
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(json.dumps(calls))
+    if p.returncode:
+        LOGGER.error("IPREG API Call: %s\n\nFAILED with exit code %i:\n%s\n%s" % (command, p.returncode, stdout, stderr))
+        raise subprocess.CalledProcessError(p.returncode, command, stdout)
+    try:
+        responses = json.loads(stdout)
+        if len(responses) != len(calls):
+            raise ValueError("%d results for %d calls" % (len(responses), len(calls)))
+    except (ValueError, TypeError) as e:
+        LOGGER.error("IPREG API response to batch call (%s) is not properly formatted: %s", calls, stdout)
+        raise e
+    results = []
+    for call, response in zip(calls, responses):
+        if 'error' in response:
+            LOGGER.error("IPREG API Call: %s\n\nFAILED with exit code %i:\n%s"
+                         % (call, response['error']['returncode'], response['error']['message']))
+            results.append(subprocess.CalledProcessError(response['error']['returncode'],
+                                                         settings.IP_REG_API_END_POINT + call,
+                                                         json.dumps(response['error'])))
+        else:
+            results.append(response['result'])
+    return results
+
+
 def get_nameinfo(hostname):
     try:
         result = ip_reg_call(['get', 'nameinfo', str(hostname)])
@@ -80,9 +172,78 @@ def set_sshfp(hostname, algorithm, fptype, fingerprint):
     return result
 
 
+def set_sshfp_batch(records):
+    """Sets the SSHFP records given as (hostname, algorithm, fptype, fingerprint) tuples. Returns a list of
+    (record, result) pairs where result is a CalledProcessError if the record could not be set"""
+    return zip(records, ip_reg_batch([['put', 'sshfp'] + [str(field) for field in record] for record in records]))
+
+
 def delete_sshfp(hostname, algorithm, fptype):
     try:
         result = ip_reg_call(['delete', 'sshfp', str(hostname), str(algorithm), str(fptype)])
     except subprocess.CalledProcessError as excp:
         raise excp
     return result
+
+
+def delete_sshfp_batch(records):
+    """Deletes the SSHFP records given as (hostname, algorithm, fptype) tuples. Returns a list of (record, result)
+    pairs where result is a CalledProcessError if the record could not be deleted"""
+    return zip(records, ip_reg_batch([['delete', 'sshfp'] + [str(field) for field in record] for record in records]))
+
+
+class FakeIPRegBackend(object):
+    """In-memory stand-in for the IPREG API used when IP_REG_API_BACKEND is "fake", e.g. in tests and development. It
+    keeps the CNAME and SSHFP records written to it, and the nameinfo of a hostname can be set with
+    :py:meth:`set_nameinfo`. Every call made is recorded in :py:attr:`calls`. Failures are raised as the
+    CalledProcessError the userv helper would exit with."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = []
+        self.nameinfo = {}
+        self.cnames = {}
+        self.sshfp = {}
+
+    def default_nameinfo(self, hostname):
+        return {'domain': hostname.split('.', 1)[-1], 'exists': [], 'delegated': 'N', 'emails': [], 'crsids': []}
+
+    def set_nameinfo(self, hostname, **nameinfo):
+        self.nameinfo[hostname] = dict(self.default_nameinfo(hostname), **nameinfo)
+
+    def error(self, call, returncode, message):
+        raise subprocess.CalledProcessError(returncode, settings.IP_REG_API_END_POINT + call,
+                                            json.dumps({'message': message}))
+
+    def call(self, call):
+        self.calls.append(call)
+        method, record_type, hostname, args = call[0], call[1], call[2], call[3:]
+        if (method, record_type) == ('get', 'nameinfo'):
+            return self.nameinfo.get(hostname) or self.default_nameinfo(hostname)
+        if (method, record_type) == ('get', 'cname'):
+            if hostname not in self.cnames:
+                self.error(call, 2, "CNAME %s not found" % hostname)
+            return {'name': hostname, 'target': self.cnames[hostname]}
+        if (method, record_type) == ('put', 'cname'):
+            if self.nameinfo.get(hostname, {}).get('delegated') == 'Y':
+                self.error(call, 7, "%s is in a delegated domain" % hostname)
+            self.cnames[hostname] = args[0]
+            return {}
+        if (method, record_type) == ('delete', 'cname'):
+            self.cnames.pop(hostname, None)
+            return {}
+        if (method, record_type) == ('find', 'sshfp'):
+            return [{'algorithm': int(algorithm), 'fptype': int(fptype), 'fingerprint': fingerprint}
+                    for (algorithm, fptype), fingerprint in sorted(self.sshfp.get(hostname, {}).items())]
+        if (method, record_type) == ('put', 'sshfp'):
+            self.sshfp.setdefault(hostname, {})[(args[0], args[1])] = args[2]
+            return {}
+        if (method, record_type) == ('delete', 'sshfp'):
+            self.sshfp.get(hostname, {}).pop((args[0], args[1]), None)
+            return {}
+        self.error(call, 1, "Unknown call %s %s" % (method, record_type))
+
+
+fake_backend = FakeIPRegBackend()
@@ -1,7 +1,11 @@
 import logging
 import subprocess
+import time
 from celery import shared_task, Task
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case, When, Value, IntegerField
 from mwsauth.models import MWSUser
 
 
@@ -18,34 +22,98 @@ def extract_crsid_and_uuid(text_to_be_parsed):
     return (crsid, uid)
 
 
-def deactive_this_user(user_crsid):
-    # TODO pass to ansible the uid of the user so it can delete this user?
-    updated = User.objects.filter(username=user_crsid).update(is_active=False)
-    # if updated is 0 the user had never used the mws3 service
-    # if updated is 1 then the user used the service and has been deactivated
-    # if updated is more than 2 an exception should be raise, it shouldn't be the case
-    MWSUser.objects.filter(user_id=user_crsid).delete()
-
-
-def deactivate_users(jackdaw_users_crsids, list_of_mws_users):
-    map(deactive_this_user, set(list_of_mws_users) - set(jackdaw_users_crsids))
-
-
-def reactivate_or_create_mws_user(user_crsid, jackdaw_users):
-    updated = User.objects.filter(username=user_crsid).update(is_active=True)
-    # if updated is 0 the user has not yet used the mws3 service
-    # if updated is 1 then the user has used the service, was deactivated and now they has been reactivated
-    # if updated is more than 2 an exception should be raise, it shouldn't be the case
-    # Assumption that the uid is never going to change in jackdaw
-    if jackdaw_users[user_crsid] < 1000:
-        MWSUser.objects.update_or_create(user_id=user_crsid, uid=66000+jackdaw_users[user_crsid])
-    else:
-        MWSUser.objects.update_or_create(user_id=user_crsid, uid=jackdaw_users[user_crsid])
-    # TODO if we let users enter to MWS server if they are not in jackdaw change to get_or_create
-
-
-def reactivate_users(jackdaw_users_crsids, list_of_mws_users, jackdaw_users):
-    map(lambda x: reactivate_or_create_mws_user(x, jackdaw_users), set(jackdaw_users_crsids) - set(list_of_mws_users))
+def mws_uid(uid):
+    """UID of the user in the MWS servers, the UIDs below 1000 are reserved for system users"""
+    if uid < 1000:
+        return 66000 + uid
+    return uid
+
+
+class JackdawEmptyFeedException(Exception):
+    """The Jackdaw feed has no users, which would deactivate all the users of the service"""
+    pass
+
+
+def parse_jackdaw_feed(jackdaw_response):
+    """Returns the MWS UID of each crsid in the Jackdaw feed. Only users with UID are valid"""
+    jackdaw_users = {}
+    for line in jackdaw_response.splitlines():
+        crsid, uid = extract_crsid_and_uuid(line)
+        if uid is not None:
+            jackdaw_users[crsid] = mws_uid(uid)
+    if not jackdaw_users:
+        raise JackdawEmptyFeedException()
+    return jackdaw_users
+
+
+def diff_jackdaw_users(jackdaw_users, mws_users, inactive_users):
+    """Compares the users in the Jackdaw feed ({crsid: uid}) with the MWSUsers ({crsid: uid}) and the usernames of
+    the inactive Users. Returns the MWSUsers to add, remove (their Users are deactivated) and change UID, and the
+    Users to reactivate: only those that get their MWSUser back, an inactive User that still has its MWSUser has
+    been banned by an administrator"""
+    add = dict((crsid, uid) for crsid, uid in jackdaw_users.items() if crsid not in mws_users)
+    return {
+        'add': add,
+        'remove': set(mws_users) - set(jackdaw_users),
+        'change': dict((crsid, uid) for crsid, uid in jackdaw_users.items()
+                       if crsid in mws_users and mws_users[crsid] != uid),
+        'reactivate': set(inactive_users) & set(add),
+    }
+
+
+def batches(items, size):
+    items = sorted(items)
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+
+def apply_jackdaw_diff(diff):
+    """Applies the changes computed by diff_jackdaw_users, all of them or none, in batches of
+    JACKDAW_SYNC_BATCH_SIZE users"""
+    from apimws.signals import invalidate_users_hostvars
+    size = getattr(settings, 'JACKDAW_SYNC_BATCH_SIZE', 500)
+    with transaction.atomic():
+        for batch in batches(diff['remove'], size):
+            # The deletion sends the signals that invalidate the hostvars of each MWSUser, there are only a few
+            MWSUser.objects.filter(user_id__in=batch).delete()
+            User.objects.filter(username__in=batch).update(is_active=False)
+        MWSUser.objects.bulk_create([MWSUser(user_id=crsid, uid=uid) for crsid, uid in sorted(diff['add'].items())],
+                                    batch_size=size)
+        for batch in batches(diff['change'], size):
+            MWSUser.objects.filter(user_id__in=batch).update(uid=Case(
+                *[When(user_id=crsid, then=Value(diff['change'][crsid])) for crsid in batch],
+                output_field=IntegerField()))
+        for batch in batches(diff['reactivate'], size):
+            User.objects.filter(username__in=batch).update(is_active=True)
+        # Bulk creations and updates do not send the signals that invalidate the hostvars
+        for batch in batches(set(diff['add']) | set(diff['change']) | diff['reactivate'], size):
+            invalidate_users_hostvars(batch)
+
+
+def sync_jackdaw_users(jackdaw_response):
+    """Synchronises the MWSUsers and whether Users are active with the Jackdaw feed. Returns the number of changes
+    of each type and the time spent in each step"""
+    timings = {}
+    start = time.time()
+    jackdaw_users = parse_jackdaw_feed(jackdaw_response)
+    timings['parse'] = time.time() - start
+
+    start = time.time()
+    mws_users = dict(MWSUser.objects.values_list('user_id', 'uid'))
+    inactive_users = set(User.objects.filter(is_active=False).values_list('username', flat=True))
+    diff = diff_jackdaw_users(jackdaw_users, mws_users, inactive_users)
+    timings['diff'] = time.time() - start
+
+    start = time.time()
+    apply_jackdaw_diff(diff)
+    timings['apply'] = time.time() - start
+
+    report = dict((change, len(users)) for change, users in diff.items())
+    report['timings'] = timings
+    LOGGER.info("Jackdaw sync of %d users: %d added, %d removed, %d UIDs changed, %d reactivated "
+                "(parse %.2fs, diff %.2fs, apply %.2fs)", len(jackdaw_users), report['add'], report['remove'],
+                report['change'], report['reactivate'], timings['parse'], timings['diff'], timings['apply'])
+    return report
 
 
 class SSHTaskWithFailure(Task):
@@ -65,13 +133,4 @@ class SSHTaskWithFailure(Task):
 def jackdaw_api():
     jackdaw_response = subprocess.check_output(["ssh", "mwsv3@jackdaw.csi.cam.ac.uk", "p", "get_people"],
                                                stderr=subprocess.STDOUT)
-    jackdaw_response_parsed = jackdaw_response.splitlines()  # TODO Raise a custom exception if response is empty
-    jackdaw_users = map(extract_crsid_and_uuid, jackdaw_response_parsed)
-    # Only take as valid users, users with uid
-    jackdaw_valid_users = filter(lambda user: user[1] is not None, jackdaw_users)
-    jackdaw_users_crsids = dict(jackdaw_valid_users).keys()
-    list_of_mws_users = MWSUser.objects.values_list('user', flat=True)
-    # Deactivate those users that are no longer in Jackdaw
-    deactivate_users(jackdaw_users_crsids, list_of_mws_users)
-    # Reactivate those users that are in Jackdaw but not in MWS3 db
-    reactivate_users(jackdaw_users_crsids, list_of_mws_users, dict(jackdaw_users))
+    return sync_jackdaw_users(jackdaw_response)
@@ -0,0 +1,134 @@
+"""
+The :py:mod:`~apimws.locks` module provides locks shared by all the celery workers so that tasks can make sure that
+they are not run more than once at the same time with the same parameters (see :py:func:`single_instance`).
+
+Locks are kept in Redis (MWS_TASK_LOCK_REDIS_URL, by default the BROKER_URL if the broker is Redis). If Redis is
+not used or it is not reachable, the locks are kept in the database (:py:class:`~apimws.models.TaskLock`).
+
+"""
+
+import logging
+import uuid
+from datetime import timedelta
+from functools import wraps
+import redis
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from apimws.models import TaskLock
+
+
+LOGGER = logging.getLogger('mws')
+
+_redis_clients = {}
+
+
+def get_redis_client(url):
+    """Returns a Redis client for the url, reusing its connection pool"""
+    if url not in _redis_clients:
+        _redis_clients[url] = redis.StrictRedis.from_url(url, socket_timeout=5)
+    return _redis_clients[url]
+
+
+class RedisLockBackend(object):
+    # Only delete the key if the lock is still ours, it may have expired and been acquired by another task
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) " \
+                     "else return 0 end"
+
+    def __init__(self, client):
+        self.client = client
+
+    def acquire(self, key, token, timeout):
+        return bool(self.client.set(key, token, nx=True, ex=timeout))
+
+    def release(self, key, token):
+        self.client.eval(self.RELEASE_SCRIPT, 1, key, token)
+
+
+class DatabaseLockBackend(object):
+
+    def acquire(self, key, token, timeout):
+        now = timezone.now()
+        TaskLock.objects.filter(key=key, expires_at__lte=now).delete()
+        try:
+            with transaction.atomic():
+                TaskLock.objects.create(key=key, token=token, expires_at=now + timedelta(seconds=timeout))
+        except IntegrityError:
+            return False
+        return True
+
+    def release(self, key, token):
+        TaskLock.objects.filter(key=key, token=token).delete()
+
+
+class Lock(object):
+    """A lock acquired with acquire_lock"""
+    def __init__(self, backend, key, token):
+        self.backend = backend
+        self.key = key
+        self.token = token
+
+    def release(self):
+        self.backend.release(self.key, self.token)
+
+
+def get_lock_backend():
+    url = getattr(settings, 'MWS_TASK_LOCK_REDIS_URL', getattr(settings, 'BROKER_URL', ''))
+    if url and url.startswith('redis://'):
+        return RedisLockBackend(get_redis_client(url))
+    return DatabaseLockBackend()
+
+
+def acquire_lock(key, timeout=None):
+    """Tries to acquire the lock identified by key without waiting for it.
+    :param key: the name of the lock
+    :param timeout: seconds after which the lock is released if it has not been released before (to avoid locks
+    held forever by workers that have died), by default MWS_TASK_LOCK_TIMEOUT
+    :return: the Lock or None if it is held by someone else
+    """
+    timeout = timeout or getattr(settings, 'MWS_TASK_LOCK_TIMEOUT', 600)
+    token = uuid.uuid4().hex
+    backend = get_lock_backend()
+    try:
+        acquired = backend.acquire(key, token, timeout)
+    except redis.RedisError as e:
+        LOGGER.warning("Redis is not available for task locks, using the database instead: %s", e)
+        backend = DatabaseLockBackend()
+        acquired = backend.acquire(key, token, timeout)
+    return Lock(backend, key, token) if acquired else None
+
+
+def single_instance(key=None, timeout=None):
+    """Decorator for tasks that must not run more than once at the same time with the same parameters. If the task
+    is already running with the same parameters, it returns False straight away without doing anything.
+    :param key: function that returns the name of the lock from the parameters of the task, by default all of them
+    are used
+    :param timeout: see acquire_lock
+
+    It has to be placed below the task decorator::
+
+        @shared_task
+        @single_instance()
+        def reset_vm(vm_id):
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if key:
+                parameters = key(*args, **kwargs)
+            else:
+                parameters = ":".join(map(str, args) + ["%s=%s" % item for item in sorted(kwargs.items())])
+            lock_key = "mws-lock:%s.%s:%s" % (function.__module__, function.__name__, parameters)
+            lock = acquire_lock(lock_key, timeout)
+            if lock is None:
+                LOGGER.info("%s is already running with the same parameters %s %s", function.__name__, args, kwargs)
+                return False
+            try:
+                return function(*args, **kwargs)
+            finally:
+                try:
+                    lock.release()
+                except redis.RedisError as e:
+                    LOGGER.warning("The lock %s could not be released, it will expire: %s", lock_key, e)
+        return wrapper
+    return decorator
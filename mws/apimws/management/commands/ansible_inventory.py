@@ -1,12 +1,17 @@
 import sys
 import json
+from collections import defaultdict
+from itertools import chain
 from django.core.management.base import BaseCommand, CommandError
-from optparse import make_option
 from django.core.urlresolvers import reverse
-from django.db.models import Q
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Q
+from ucamlookup.models import LookupGroup
 from apimws.lv import update_lv_list
-from apimws.models import PHPLib
-from sitesmanagement.models import VirtualMachine, Site, UnixGroup
+from apimws.models import PHPLib, AnsibleConfiguration, HostvarsCache
+from mwsauth.models import MWSUser
+from mwsauth.utils import refresh_expired_groups
+from sitesmanagement.models import VirtualMachine, Site, Service, Vhost, DomainName, UnixGroup
 from django.conf import settings
 
 
@@ -50,6 +55,89 @@ yzdfJ72n+1JfHGP+workciKNldgqYX6J4jPrCIEIBrtDta4QxP10Tyd9RFu13XmE
 -----END CERTIFICATE-----'''
 
 
+def group_members(groups):
+    """Users of the LookupGroups given, read from the copy of their members prefetched with them"""
+    return chain.from_iterable(group.membership.users.all() for group in groups if hasattr(group, 'membership'))
+
+
+class InventoryData(object):
+    """All the information needed to generate the hostvars of a set of VMs. It is retrieved from the database
+    with a fixed number of queries regardless of the number of VMs, sites and services involved, and then
+    grouped in memory by site and service.
+    """
+
+    DOMAIN_STATUSES = ('accepted', 'external', 'special')
+
+    def __init__(self, vms):
+        self.vms = list(vms.select_related('network_configuration', 'service__network_configuration'))
+
+        # Sites together with their users and the members of their groups, the copies of the members that have
+        # expired are retrieved from lookup beforehand so that all of them can be read at once
+        site_ids = list(Site.objects.filter(services__virtual_machines__in=vms).distinct().values_list('id',
+                                                                                                      flat=True))
+        refresh_expired_groups(LookupGroup.objects.filter(Q(sites__in=site_ids) | Q(sites_auth_as_user__in=site_ids)))
+        self.sites = {site.id: site for site in Site.objects.filter(id__in=site_ids).prefetch_related(
+            'users', 'ssh_users', 'groups__membership__users', 'ssh_groups__membership__users', 'supporters')}
+
+        # All services of those sites, not only the ones with VMs in the inventory, as the test service needs
+        # the vhosts of the production service and the production service needs to know about the test service
+        self.services = {}
+        self.site_services = defaultdict(dict)
+        for service in Service.objects.filter(site_id__in=site_ids).select_related(
+                'network_configuration').annotate(num_vms=Count('virtual_machines')):
+            self.services[service.id] = service
+            self.site_services[service.site_id][service.type] = service
+        service_ids = self.services.keys()
+
+        # Vhosts and the domain names to be configured in each one of them
+        self.vhosts = defaultdict(list)
+        for vhost in Vhost.objects.filter(service_id__in=service_ids).select_related('main_domain'):
+            self.vhosts[vhost.service_id].append(vhost)
+        self.domain_names = defaultdict(list)
+        for vhost_id, name in DomainName.objects.filter(vhost__service_id__in=service_ids,
+                                                        status__in=self.DOMAIN_STATUSES).values_list('vhost_id',
+                                                                                                      'name'):
+            self.domain_names[vhost_id].append(name)
+
+        # Unix groups of each site and the names of the unix groups each user belongs to
+        self.unix_groups = defaultdict(list)
+        for site_id, gid, name, to_be_deleted in UnixGroup.objects.filter(service__site_id__in=site_ids).values_list(
+                'service__site_id', 'id', 'name', 'to_be_deleted'):
+            self.unix_groups[site_id].append((gid, name, to_be_deleted))
+        self.user_unix_groups = defaultdict(list)
+        for site_id, user_id, name in UnixGroup.users.through.objects.filter(
+                unixgroup__service__site_id__in=site_ids, unixgroup__to_be_deleted=False).values_list(
+                'unixgroup__service__site_id', 'user_id', 'unixgroup__name'):
+            self.user_unix_groups[(site_id, user_id)].append(name)
+
+        # Users (admins, ssh users and supporters) of each site and their MWS account
+        self.site_users = {}
+        for site in self.sites.values():
+            users = set(chain(site.users.all(), site.ssh_users.all(), group_members(site.groups.all()),
+                              group_members(site.ssh_groups.all())))
+            self.site_users[site.id] = [user for user in users if user.is_active] + list(site.supporters.all())
+        usernames = set(user.username for users in self.site_users.values() for user in users)
+        self.mws_users = {mws_user.user_id: mws_user for mws_user in
+                          MWSUser.objects.filter(user_id__in=usernames)} if usernames else {}
+
+        # PHP libraries, all of them as the ones not enabled in a service are to be deleted
+        self.php_libs = list(PHPLib.objects.values_list('name', 'available'))
+        self.service_php_libs = defaultdict(set)
+        for service_id, phplib_id in PHPLib.services.through.objects.filter(
+                service_id__in=service_ids).values_list('service_id', 'phplib_id'):
+            self.service_php_libs[service_id].add(phplib_id)
+
+        # Operating system of each service
+        self.operating_systems = dict(AnsibleConfiguration.objects.filter(
+            service_id__in=service_ids, key='os').values_list('service_id', 'value'))
+
+    def service(self, vm):
+        return self.services[vm.service_id]
+
+    def site(self, vm):
+        return self.sites[self.service(vm).site_id]
+
+
 class Command(BaseCommand):
     help = "Generates a dynamic inventory for ansible from the MWS database."
     output_transaction = True
@@ -67,23 +155,53 @@ class Command(BaseCommand):
         if list:
             vms = VirtualMachine.objects.filter(
                 service__status__in=('ansible', 'ansible_queued', 'ready', 'postinstall'),
-                service__site__disabled=False, service__site__deleted=False, service__site__end_date__isnull=True)
+                service__site__disabled=False, service__site__deleted=False, service__site__end_date__isnull=True)\
+                .select_related('network_configuration', 'service__site')
+            hostvars = self.cached_hostvars(vms)
             result = {'_meta': {'hostvars': {}}, group: [self.hostid(vm) for vm in vms]}
-            for site in Site.objects.all():
-                if not site.is_canceled():
-                    result[self.sitegroup(site)] = [
-                        self.hostid(vm) for vm in vms.filter(service__site=site)]
+            for site in Site.objects.filter(end_date__isnull=True).only('id'):
+                result[self.sitegroup(site)] = []
             for vm in vms:
-                result['_meta']['hostvars'][self.hostid(vm)] = (
-                    self.hostvars(vm))
+                result[self.sitegroup(vm.service.site)].append(self.hostid(vm))
+                result['_meta']['hostvars'][self.hostid(vm)] = hostvars[vm.id]
             json.dump(result, outfile)
             outfile.write("\n")
         else:
             vm = VirtualMachine.objects.get(
                 network_configuration__name=host)
-            json.dump(self.hostvars(vm), outfile)
+            json.dump(self.cached_hostvars([vm])[vm.id], outfile)
             outfile.write("\n")
 
+    def cached_hostvars(self, vms):
+        """Returns a dictionary with the hostvars of each one of the VMs passed as parameter. The hostvars are
+        taken from the HostvarsCache, only those that have been invalidated (or never generated) are regenerated.
+        """
+        cache = {entry.vm_id: entry for entry in HostvarsCache.objects.filter(vm__in=vms)}
+        new_entries = [HostvarsCache(vm=vm) for vm in vms if vm.id not in cache]
+        if new_entries:
+            try:
+                with transaction.atomic():
+                    HostvarsCache.objects.bulk_create(new_entries)
+                cache.update({entry.vm_id: entry for entry in new_entries})
+            except IntegrityError:
+                pass  # Created concurrently by another process, they will be cached in the next run
+        result = {vm_id: json.loads(entry.hostvars) for vm_id, entry in cache.items() if entry.hostvars is not None}
+        dirty = [vm.id for vm in vms if vm.id not in result]
+        if dirty:
+            data = InventoryData(VirtualMachine.objects.filter(id__in=dirty))
+            regenerated = {vm.id: self.hostvars(vm, data) for vm in data.vms}
+            result.update(regenerated)
+            with transaction.atomic():
+                # Only store those that have not been invalidated while they were being generated
+                current = HostvarsCache.objects.select_for_update().filter(vm_id__in=regenerated.keys())
+                fresh = [vm_id for vm_id, generation in current.values_list('vm_id', 'generation')
+                         if vm_id in cache and cache[vm_id].generation == generation]
+                HostvarsCache.objects.filter(vm_id__in=fresh).delete()
+                HostvarsCache.objects.bulk_create([
+                    HostvarsCache(vm_id=vm_id, generation=cache[vm_id].generation,
+                                  hostvars=json.dumps(regenerated[vm_id])) for vm_id in fresh])
+        return result
+
     def sitegroup(self, site):
         return "mwssite-%d" % (site.id,)
 
@@ -93,28 +211,35 @@ class Command(BaseCommand):
     def hostid(self, vm):
         return vm.network_configuration.name
 
-    def hostvars(self, vm):
+    def hostvars(self, vm, data=None):
+        if data is None:
+            data = InventoryData(VirtualMachine.objects.filter(pk=vm.pk))
+            vm = data.vms[0]
+        site = data.site(vm)
+        service = data.service(vm)
+        production_service = data.site_services[site.id].get('production')
+        test_service = data.site_services[site.id].get('test')
+
         v = {}
         v['ansible_ssh_host'] = (vm.network_configuration.name or
                                  vm.network_configuration.IPv4 or
                                  vm.network_configuration.IPv6)
-        v['mws_name'] = vm.site.name
-        v['mws_webmaster_email'] = vm.site.email
+        v['mws_name'] = site.name
+        v['mws_webmaster_email'] = site.email
 
-        def user_vars(user, service):
+        def user_vars(user):
             uv = {}
             uv['username'] = user.username
-            uv['groups'] = list(UnixGroup.objects.filter(service__site=service.site, users__in=[user],
-                                                         to_be_deleted=False).values_list('name', flat=True))
-            if hasattr(user, "mws_user") and user.mws_user.uid is not None:
-                uv['uid'] = user.mws_user.uid
-                if user.mws_user.ssh_public_key:
-                    uv['ssh_key'] = user.mws_user.ssh_public_key
+            uv['groups'] = data.user_unix_groups[(site.id, user.id)]
+            mws_user = data.mws_users.get(user.username)
+            if mws_user is not None and mws_user.uid is not None:
+                uv['uid'] = mws_user.uid
+                if mws_user.ssh_public_key:
+                    uv['ssh_key'] = mws_user.ssh_public_key
             return uv
 
         # List of active users (admin and ssh only) together with the list of supporters
-        v['mws_users'] = [user_vars(u, vm.service) for u in
-                          vm.site.list_of_all_type_of_active_users() + list(vm.site.supporters.all())]
+        v['mws_users'] = [user_vars(u) for u in data.site_users[site.id]]
 
         def vhost_vars(vh):
             # List of variables for each vhost
@@ -122,8 +247,7 @@ class Command(BaseCommand):
             vhv['id'] = vh.id
             vhv['name'] = vh.name
             # List of domain names associated to the vhost (only those already accepted or external [non cam.ac.uk])
-            vhv['domains'] = [dom.name for dom in
-                              vh.domain_names.filter(Q(status='accepted') | Q(status='external') | Q(status='special'))]
+            vhv['domains'] = data.domain_names[vh.id]
             # The main domain where all the domain names associated will redirect to
             if vh.main_domain:
                 vhv['main_domain'] = vh.main_domain.name
@@ -145,16 +269,15 @@ class Command(BaseCommand):
             return vhv
 
         # List of Vhosts of the production service (the test service uses the production one)
-        v['mws_vhosts'] = [vhost_vars(vh) for vh in vm.service.vhosts.all()] if vm.service.primary else \
-            [vhost_vars(vh) for vh in vm.service.site.production_service.vhosts.all()]
+        v['mws_vhosts'] = [vhost_vars(vh) for vh in data.vhosts[service.id]] if service.primary else \
+            [vhost_vars(vh) for vh in data.vhosts[production_service.id]]
 
         # Is the VM the production or the test one?
-        v['mws_is_primary'] = vm.primary
+        v['mws_is_primary'] = service.primary
 
         # Has this an active test Service?
-        v['mws_test_active'] = vm.service.site.test_service.active if vm.service.site.test_service else False
-        v['mws_test_name'] = vm.service.site.test_service.network_configuration.name \
-            if vm.service.site.test_service else ""
+        v['mws_test_active'] = test_service.num_vms > 0 if test_service else False
+        v['mws_test_name'] = test_service.network_configuration.name if test_service else ""
 
         # Network configuration of the VM
         if vm.network_configuration.IPv4:
@@ -169,44 +292,46 @@ class Command(BaseCommand):
         v['mws_tls_enabled'] = any(['certificate' in vhv for vhv in v['mws_vhosts']])
 
         # version of the operating system
-        v['mws_os'] = vm.operating_system
+        v['mws_os'] = data.operating_systems.get(service.id)
 
         # mws_site_group refers to the Ansible host group representing
         # this host's site.
-        v['mws_site_group'] = self.sitegroup(vm.site)
+        v['mws_site_group'] = self.sitegroup(site)
         # mws_site_id is a convenient string identifying the site for use
         # in filenames etc.
         v['mws_site_id'] = v['mws_site_group']
 
         # mws_service_group refers to the Ansible host group representing
         # this host's service.
-        v['mws_service_group'] = self.servicegroup(vm.service)
-        v['mws_service_fqdn'] = vm.service.network_configuration.name
-        v['mws_service_ipv4'] = vm.service.network_configuration.IPv4
-        v['mws_service_ipv4_netmask'] = vm.service.network_configuration.IPv4_netmask
-        v['mws_service_ipv4_gateway'] = vm.service.network_configuration.IPv4_gateway
-        v['mws_service_ipv6'] = vm.service.network_configuration.IPv6
+        v['mws_service_group'] = self.servicegroup(service)
+        v['mws_service_fqdn'] = service.network_configuration.name
+        v['mws_service_ipv4'] = service.network_configuration.IPv4
+        v['mws_service_ipv4_netmask'] = service.network_configuration.IPv4_netmask
+        v['mws_service_ipv4_gateway'] = service.network_configuration.IPv4_gateway
+        v['mws_service_ipv6'] = service.network_configuration.IPv6
 
         # List of PHP libraries to be installed
-        v['mws_php_libs_enabled'] = list(PHPLib.objects.filter(services__id=vm.service.id, available=True)
-                                         .values_list('name', flat=True))
+        v['mws_php_libs_enabled'] = [name for name, available in data.php_libs
+                                     if available and name in data.service_php_libs[service.id]]
 
         # List of PHP libraries to be deleted
-        v['mws_php_libs_disabled'] = list(PHPLib.objects.exclude(services__id=vm.service.id)
-                                          .values_list('name', flat=True))
+        v['mws_php_libs_disabled'] = [name for name, available in data.php_libs
+                                      if name not in data.service_php_libs[service.id]]
 
         # List of Unix groups and their associated gids
         v['mws_unix_groups'] = []
-        for unix_group in UnixGroup.objects.filter(service__site=vm.service.site, to_be_deleted=False):
-            v['mws_unix_groups'].append({'name': unix_group.name, 'gid': INITIAL_GID-unix_group.id})
+        for gid, name, to_be_deleted in data.unix_groups[site.id]:
+            if not to_be_deleted:
+                v['mws_unix_groups'].append({'name': name, 'gid': INITIAL_GID-gid})
 
         # List of Unix Groups to be deleted
         v['mws_delete_unix_groups'] = []
-        for unix_group in UnixGroup.objects.filter(service__site=vm.service.site, to_be_deleted=True):
-            v['mws_delete_unix_groups'].append({'name': unix_group.name})
+        for gid, name, to_be_deleted in data.unix_groups[site.id]:
+            if to_be_deleted:
+                v['mws_delete_unix_groups'].append({'name': name})
 
         # Let ansible know if the VM should be quarantined (apache and exim services disabled)
-        v['mws_quarantined'] = vm.service.quarantined
+        v['mws_quarantined'] = service.quarantined
 
         # URL to the panel to inform about the deletion of LVs
         v['mws_update_lv_list_url'] = "%s%s" % (settings.MAIN_DOMAIN, reverse(update_lv_list))
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from apimws.models import AnsibleRollout
+from apimws.rollout import start_rollout, stop_rollout
+from sitesmanagement.models import Service
+
+
+class Command(BaseCommand):
+    help = "Runs the full ansible playbook across all the active services (or a subset of them) in batches, or shows " \
+           "the progress of a rollout or stops it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['start', 'status', 'stop'])
+        parser.add_argument('rollout_id', type=int, nargs='?', help="The rollout (for status and stop)")
+        parser.add_argument('--service-type', choices=['production', 'test'], help="Only services of this type")
+        parser.add_argument('--cluster', action='append', help="Only services with VMs in this cluster")
+        parser.add_argument('--site', type=int, action='append', help="Only the services of this site")
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help="Maximum number of services dispatched at a time (default: 10)")
+        parser.add_argument('--max-concurrency', type=int, default=20,
+                            help="Maximum number of services running ansible at the same time (default: 20)")
+        parser.add_argument('--max-per-host', type=int, default=2,
+                            help="Maximum number of services running ansible at the same time per host of each "
+                                 "cluster (default: 2)")
+        parser.add_argument('--max-failures', type=int, default=0,
+                            help="Stop the rollout when more services than this have failed (default: 0)")
+        parser.add_argument('--dry-run', action='store_true', help="Only show the services that would be included")
+
+    def handle(self, *args, **options):
+        if options['action'] == 'start':
+            return self.start(options)
+
+        if options['rollout_id'] is None:
+            raise CommandError("A rollout id is needed")
+        try:
+            rollout = AnsibleRollout.objects.get(id=options['rollout_id'])
+        except AnsibleRollout.DoesNotExist:
+            raise CommandError("Rollout not found with id: %s" % options['rollout_id'])
+        if options['action'] == 'stop':
+            stop_rollout(rollout)
+            rollout.refresh_from_db()
+        self.show_progress(rollout)
+
+    def start(self, options):
+        if options['batch_size'] < 1 or options['max_concurrency'] < 1 or options['max_per_host'] < 1:
+            raise CommandError("The batch size and the concurrency limits need to be at least 1")
+        services = Service.objects.filter(site__isnull=False, site__end_date__isnull=True,
+                                          virtual_machines__isnull=False)
+        if options['service_type']:
+            services = services.filter(type=options['service_type'])
+        if options['cluster']:
+            services = services.filter(virtual_machines__cluster__in=options['cluster'])
+        if options['site']:
+            services = services.filter(site__in=options['site'])
+        services = services.distinct()
+
+        if options['dry_run']:
+            for service in services.select_related('network_configuration'):
+                self.stdout.write(str(service))
+            self.stdout.write("%d services" % services.count())
+            return
+
+        rollout = start_rollout(services, batch_size=options['batch_size'],
+                                max_concurrency=options['max_concurrency'], max_per_host=options['max_per_host'],
+                                max_failures=options['max_failures'])
+        self.stdout.write("Ansible rollout %d started" % rollout.id)
+        rollout.refresh_from_db()
+        self.show_progress(rollout)
+
+    def show_progress(self, rollout):
+        progress = rollout.progress()
+        self.stdout.write("Ansible rollout %d: %s" % (rollout.id, rollout.get_status_display()))
+        self.stdout.write("%d/%d services finished (%s)" % (
+            progress['done'] + progress['failed'] + progress['skipped'], sum(progress.values()),
+            ", ".join("%s: %d" % (status, progress[status]) for status in
+                      ['pending', 'running', 'done', 'failed', 'skipped'])))
+        for rollout_service in rollout.services.filter(status='failed').select_related('service'):
+            self.stdout.write("Failed: %s" % rollout_service.service)
@@ -0,0 +1,29 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+from apimws.models import AnsibleRun, AnsibleRunRequest
+
+
+class Command(BaseCommand):
+    help = "Shows how many ansible runs have been requested and how many of those requests have been merged"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help="Number of days to take into account (default: 7)")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        runs = AnsibleRun.objects.filter(started_at__gte=since).aggregate(num_runs=Count('id'),
+                                                                          num_requests=Sum('num_requests'))
+        num_runs = runs['num_runs']
+        num_requests = runs['num_requests'] or 0
+        self.stdout.write("Runs: %d" % num_runs)
+        self.stdout.write("Failed runs: %d" % AnsibleRun.objects.filter(started_at__gte=since,
+                                                                         successful=False).count())
+        self.stdout.write("Requests covered: %d" % num_requests)
+        self.stdout.write("Requests merged: %d" % max(num_requests - num_runs, 0))
+        self.stdout.write("Requests pending: %d" % AnsibleRunRequest.objects.filter(run__isnull=True).count())
+        reasons = AnsibleRunRequest.objects.filter(requested_at__gte=since).values('reason') \
+            .annotate(num_requests=Count('id')).order_by('-num_requests')
+        for reason in reasons:
+            self.stdout.write("  %s: %d" % (reason['reason'], reason['num_requests']))
@@ -0,0 +1,56 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand, CommandError
+from apimws.placement import cluster_loads, choose_cluster, RESOURCES
+from sitesmanagement.models import VirtualMachine
+
+
+class Command(BaseCommand):
+    help = "Replays the placement of all the current VMs, in the order they were created, over empty clusters and " \
+           "compares the result with where they are now"
+
+    def describe(self, load):
+        resources = ", ".join("%s %d/%s" % (resource, load.used[resource], load.capacity[resource] or "-")
+                              for resource in RESOURCES)
+        utilisation = load.utilisation()
+        return "%d guests, %s, utilisation %s" % (load.guests, resources,
+                                                   "%.0f%%" % (utilisation * 100) if utilisation is not None else "-")
+
+    def sharing_clusters(self, clusters_of_site):
+        return sum(1 for clusters in clusters_of_site.values() if any(count > 1 for count in clusters.values()))
+
+    def handle(self, *args, **options):
+        current = cluster_loads()
+        simulated = cluster_loads()
+        if not simulated:
+            raise CommandError("There are no clusters with hosts")
+        for load in simulated:
+            load.used = dict.fromkeys(RESOURCES, 0)
+            load.guests = 0
+
+        clusters_of_site = defaultdict(lambda: defaultdict(int))
+        current_clusters_of_site = defaultdict(lambda: defaultdict(int))
+        not_fitting = 0
+        moved = 0
+        for vm in VirtualMachine.objects.select_related('service__site__type').order_by('id'):
+            site = vm.service.site
+            server_type = site.type if site else None
+            for load in simulated:
+                load.site_guests = clusters_of_site[site.id][load.cluster.name] if site else 0
+            load = choose_cluster(simulated, server_type)
+            if not load.fits(server_type):
+                not_fitting += 1
+            load.add(server_type)
+            if site:
+                clusters_of_site[site.id][load.cluster.name] += 1
+                current_clusters_of_site[site.id][vm.cluster_id] += 1
+            if load.cluster.name != vm.cluster_id:
+                moved += 1
+
+        for current_load, simulated_load in zip(current, simulated):
+            self.stdout.write("%s" % current_load.cluster.name)
+            self.stdout.write("  current:   %s" % self.describe(current_load))
+            self.stdout.write("  simulated: %s" % self.describe(simulated_load))
+        self.stdout.write("VMs placed in a different cluster: %d" % moved)
+        self.stdout.write("VMs that would not fit: %d" % not_fitting)
+        self.stdout.write("Sites with more than one VM in the same cluster: %d now, %d simulated" % (
+            self.sharing_clusters(current_clusters_of_site), self.sharing_clusters(clusters_of_site)))
@@ -1,13 +1,20 @@
+import mock
 import uuid
 from django.test import TestCase
 from django.core.management.base import CommandError
 import json
 from StringIO import StringIO
 from datetime import datetime
-from apimws.models import Cluster, Host
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from ucamlookup.models import LookupGroup
+from apimws.models import Cluster, Host, PHPLib, HostvarsCache
 from apimws.xen import which_cluster
+from mwsauth.models import MWSUser, LookupGroupMembership
 from sitesmanagement.models import (Site, VirtualMachine, NetworkConfig, Service, ServerType)
-from .commands.ansible_inventory import Command
+from .commands.ansible_inventory import Command, INITIAL_GID
 
 
 class SimpleCommandTests(TestCase):
@@ -90,3 +97,146 @@ class TestsWithData(TestCase):
             self.assertEqual(v['mws_ipv4'], self.vm.network_configuration.IPv4)
         self.assertEqual(v['mws_ipv6'], self.vm.network_configuration.IPv6)
         self.assertEqual(v['mws_service_fqdn'], self.vm.service.network_configuration.name)
+
+    def add_site(self, n):
+        NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n, type='ipvxpub',
+                                     name="mws-%d.mws3.example" % n)
+        NetworkConfig.objects.create(IPv4='192.0.2.%d' % n, type='ipv4priv', name='mws-%d.mws3.private.example' % n)
+        NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:%d' % n, name='mws-guest%d.example' % n, type='ipv6')
+        site = Site.objects.create(name="testSite%d" % n, start_date=datetime.today(),
+                                   type=ServerType.objects.get(id=1))
+        service = Service.objects.create(type="production", site=site, status="ready",
+                                         network_configuration=NetworkConfig.get_free_prod_service_config())
+        Service.objects.create(type="test", site=site, status="ready",
+                               network_configuration=NetworkConfig.get_free_test_service_config())
+        VirtualMachine.objects.create(name="test_vm%d" % n, token=uuid.uuid4(), service=service,
+                                      network_configuration=NetworkConfig.get_free_host_config(),
+                                      cluster=which_cluster())
+        vhost = service.vhosts.create(name="vhost")
+        vhost.domain_names.create(name="foo%d.example" % n, status='external')
+        MWSUser.objects.create(user_id="test%04d" % n, uid=1000+n, ssh_public_key="ssh-rsa AAAA test%04d" % n)
+        with mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Test User"):
+            user = User.objects.create(username="test%04d" % n)
+        site.users.add(user)
+        service.unix_groups.create(name="GROUP").users.add(user)
+        PHPLib.objects.create(name="php-lib-%d" % n, description="PHP library").services.add(service)
+        # Lookup groups of admins and ssh users, whose members have already been retrieved
+        for prefix, uid_base, groups in (("adm", 2000, site.groups), ("ssh", 3000, site.ssh_groups)):
+            MWSUser.objects.create(user_id="%s%04d" % (prefix, n), uid=uid_base+n,
+                                   ssh_public_key="ssh-rsa AAAA %s%04d" % (prefix, n))
+            with mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Test User"):
+                member = User.objects.create(username="%s%04d" % (prefix, n))
+            with mock.patch("ucamlookup.signals.return_title_by_groupid", return_value="Test group"):
+                lookup_group = LookupGroup.objects.create(lookup_id=str(uid_base + n))
+            LookupGroupMembership.objects.create(group=lookup_group, refreshed_at=timezone.now()).users.add(member)
+            groups.add(lookup_group)
+        return site
+
+    def test_list_num_queries(self):
+        # The number of queries needed to generate the inventory must not depend on the number of VMs
+        self.add_site(1)
+        with CaptureQueriesContext(connection) as queries:
+            Command().handle(list=True, outfile=StringIO())
+        for n in range(2, 6):
+            self.add_site(n)
+        HostvarsCache.objects.all().delete()
+        s = StringIO()
+        with self.assertNumQueries(len(queries)):
+            Command().handle(list=True, outfile=s)
+        r = json.loads(s.getvalue())
+        self.assertEqual(len(r['mwsclients']), 6)
+        v = r['_meta']['hostvars']['mws-guest5.example']
+        self.assertEqual(sorted(v['mws_users'], key=lambda user: user['username']), [
+            {'username': 'adm0005', 'groups': [], 'uid': 2005, 'ssh_key': 'ssh-rsa AAAA adm0005'},
+            {'username': 'ssh0005', 'groups': [], 'uid': 3005, 'ssh_key': 'ssh-rsa AAAA ssh0005'},
+            {'username': 'test0005', 'groups': ['GROUP'], 'uid': 1005, 'ssh_key': 'ssh-rsa AAAA test0005'}])
+        self.assertEqual(v['mws_vhosts'][0]['domains'], ["foo5.example"])
+        self.assertIn("php-lib-5", v['mws_php_libs_enabled'])
+        self.assertIn("php-lib-4", v['mws_php_libs_disabled'])
+        self.assertEqual(v['mws_unix_groups'], [{'name': 'GROUP', 'gid': INITIAL_GID - Site.objects.get(
+            name="testSite5").production_service.unix_groups.get().id}])
+        self.assertTrue(v['mws_test_name'])
+        self.assertFalse(v['mws_test_active'])
+        self.assertEqual(r['mwssite-%d' % Site.objects.get(name="testSite5").id], ['mws-guest5.example'])
+
+    @mock.patch("mwsauth.utils.GroupMethods")
+    def test_list_expired_groups(self, mock_group_methods):
+        site = self.add_site(1)
+        mock_group_methods.return_value.getMembers.return_value = [
+            mock.Mock(identifier=mock.Mock(value="adm0001"), visibleName="Test User")]
+        # The members of the groups that have expired are retrieved from lookup once before generating the hostvars
+        LookupGroupMembership.objects.filter(group__lookup_id="3001").update(refreshed_at=None)
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+        v = json.loads(s.getvalue())['_meta']['hostvars']['mws-guest1.example']
+        self.assertEqual(sorted(user['username'] for user in v['mws_users']), ['adm0001', 'test0001'])
+        self.assertEqual(site.list_of_ssh_users(), [])
+
+    def test_host(self):
+        # --host and --list must generate the same hostvars
+        self.add_site(1)
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        r = json.loads(s.getvalue())
+        for hostname in r['mwsclients']:
+            s = StringIO()
+            Command().handle(host=hostname, outfile=s)
+            self.assertEqual(json.loads(s.getvalue()), r['_meta']['hostvars'][hostname])
+
+    def test_cache(self):
+        site = self.add_site(1)
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        r = json.loads(s.getvalue())
+        self.assertEqual(HostvarsCache.objects.filter(hostvars__isnull=False).count(), 2)
+
+        # Only the VMs that have been invalidated are regenerated
+        with mock.patch("apimws.management.commands.ansible_inventory.InventoryData") as mock_data:
+            s = StringIO()
+            Command().handle(list=True, outfile=s)
+            mock_data.assert_not_called()
+        self.assertEqual(json.loads(s.getvalue()), r)
+
+        # Changes in the database invalidate the VMs affected
+        self.vhost1.domain_names.create(name="bar.example", status='external')
+        self.assertEqual(HostvarsCache.objects.get(vm=self.vm).hostvars, None)
+        self.assertNotEqual(HostvarsCache.objects.get(vm=site.production_vms.get()).hostvars, None)
+        site.users.clear()
+        self.assertEqual(HostvarsCache.objects.get(vm=site.production_vms.get()).hostvars, None)
+        site.groups.clear()
+        site.ssh_groups.clear()
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        r = json.loads(s.getvalue())
+        self.assertIn("bar.example", r['_meta']['hostvars'][self.vm.network_configuration.name]
+                      ['mws_vhosts'][0]['domains'])
+        self.assertEqual(r['_meta']['hostvars']['mws-guest1.example']['mws_users'], [])
+        self.assertEqual(HostvarsCache.objects.filter(hostvars__isnull=False).count(), 2)
+
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_cache_test_vm_deleted(self, mock_vm_api_request):
+        site = self.add_site(1)
+        NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:2', name='mws-guest2.example', type='ipv6')
+        test_vm = VirtualMachine.objects.create(name="test_vm_test", token=uuid.uuid4(), service=site.test_service,
+                                                network_configuration=NetworkConfig.get_free_host_config(),
+                                                cluster=which_cluster())
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        self.assertTrue(json.loads(s.getvalue())['_meta']['hostvars']['mws-guest1.example']['mws_test_active'])
+
+        # The production VM knows that the test VM no longer exists
+        test_vm.delete()
+        self.assertEqual(HostvarsCache.objects.get(vm=site.production_vms.get()).hostvars, None)
+        s = StringIO()
+        Command().handle(list=True, outfile=s)
+        self.assertFalse(json.loads(s.getvalue())['_meta']['hostvars']['mws-guest1.example']['mws_test_active'])
+
+    def test_cache_invalidated_while_generating(self):
+        # hostvars invalidated while being generated are not stored
+        def invalidate(vm, data):
+            HostvarsCache.invalidate(vm=vm)
+            return {}
+        with mock.patch.object(Command, "hostvars", side_effect=invalidate):
+            Command().handle(list=True, outfile=StringIO())
+        self.assertEqual(HostvarsCache.objects.get(vm=self.vm).hostvars, None)
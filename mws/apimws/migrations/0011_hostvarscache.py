@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0078_auto_20171129_1334'),
+        ('apimws', '0010_auto_20160506_1715'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostvarsCache',
+            fields=[
+                ('vm', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='hostvars_cache', serialize=False, to='sitesmanagement.VirtualMachine')),
+                ('hostvars', models.TextField(blank=True, null=True)),
+                ('generation', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0078_auto_20171129_1334'),
+        ('apimws', '0011_hostvarscache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnsibleRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('successful', models.NullBooleanField()),
+                ('num_requests', models.IntegerField(default=0)),
+                ('reasons', models.CharField(blank=True, max_length=250)),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ansible_runs', to='sitesmanagement.Service')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnsibleRunRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[(b'full', b'Full configuration'), (b'site', b'Site details'), (b'users', b'Authorised users and groups'), (b'vhosts', b'Websites'), (b'domains', b'Domain names'), (b'tls', b'TLS certificates'), (b'unix_groups', b'Unix groups'), (b'php_libs', b'PHP libraries'), (b'quarantine', b'Quarantine')], default=b'full', max_length=50)),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+                ('run', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='requests', to='apimws.AnsibleRun')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ansible_requests', to='sitesmanagement.Service')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0012_ansiblerun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ansiblerun',
+            name='tags',
+            field=models.CharField(blank=True, max_length=250),
+        ),
+    ]
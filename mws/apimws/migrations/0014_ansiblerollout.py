@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0078_auto_20171129_1334'),
+        ('apimws', '0013_ansiblerun_tags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnsibleRollout',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[(b'running', b'Running'), (b'finished', b'Finished'), (b'stopped', b'Stopped')], default=b'running', max_length=50)),
+                ('batch_size', models.IntegerField(default=10)),
+                ('max_concurrency', models.IntegerField(default=20)),
+                ('max_per_host', models.IntegerField(default=2)),
+                ('max_failures', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnsibleRolloutService',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed'), (b'skipped', b'Skipped')], db_index=True, default=b'pending', max_length=50)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('rollout', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='services', to='apimws.AnsibleRollout')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ansible_rollouts', to='sitesmanagement.Service')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ansiblerolloutservice',
+            unique_together=set([('rollout', 'service')]),
+        ),
+    ]
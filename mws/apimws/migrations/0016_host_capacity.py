@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0015_tasklock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='numcpu',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='sizedisk',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='sizeram',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0016_host_capacity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyStats',
+            fields=[
+                ('date', models.DateField(primary_key=True, serialize=False)),
+                ('in_use', models.PositiveIntegerField()),
+                ('requests', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
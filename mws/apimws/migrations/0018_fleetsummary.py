@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0017_monthlystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetSummary',
+            fields=[
+                ('date', models.DateField(primary_key=True, serialize=False)),
+                ('websites', models.PositiveIntegerField()),
+                ('live_websites', models.PositiveIntegerField()),
+                ('servers', models.PositiveIntegerField()),
+                ('live_servers', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from sitesmanagement.models import Service
 
 
@@ -12,6 +14,11 @@ class Cluster(models.Model):
 class Host(models.Model):
     hostname = models.CharField(max_length=250, primary_key=True)
     cluster = models.ForeignKey(Cluster, related_name='hosts')
+    # Resources available for guests, used to decide where new VMs are placed (see apimws.placement). Leave them
+    # empty if unknown
+    numcpu = models.PositiveIntegerField(blank=True, null=True)
+    sizeram = models.PositiveIntegerField(blank=True, null=True)  # In GB
+    sizedisk = models.PositiveIntegerField(blank=True, null=True)  # In GB
 
     def __unicode__(self):
         return self.hostname
@@ -44,3 +51,181 @@ class PHPLib(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class HostvarsCache(models.Model):
+    """Cached copy of the Ansible hostvars of a VM as generated by the ansible_inventory command. hostvars is
+    None when the cached copy has been invalidated and needs to be regenerated. generation is increased each
+    time the entry is invalidated so that a copy generated before the last invalidation is never stored.
+    """
+    vm = models.OneToOneField('sitesmanagement.VirtualMachine', primary_key=True, related_name='hostvars_cache')
+    hostvars = models.TextField(null=True, blank=True)  # JSON
+    generation = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def invalidate(cls, *args, **kwargs):
+        """Invalidates the cached hostvars of the VMs matching the filter passed as parameters"""
+        return cls.objects.filter(*args, **kwargs).update(hostvars=None, generation=F('generation')+1)
+
+
+class AnsibleRunRequest(models.Model):
+    """A request to run ansible in the VMs of a service. Requests are not dispatched straight away: all the requests
+    made for a service before its next run starts are merged and covered by that single run (see
+    :py:func:`apimws.ansible.launch_ansible`). run is None while the request is pending.
+    """
+    REASONS = (
+        ('full', 'Full configuration'),
+        ('site', 'Site details'),
+        ('users', 'Authorised users and groups'),
+        ('vhosts', 'Websites'),
+        ('domains', 'Domain names'),
+        ('tls', 'TLS certificates'),
+        ('unix_groups', 'Unix groups'),
+        ('php_libs', 'PHP libraries'),
+        ('quarantine', 'Quarantine'),
+    )
+
+    service = models.ForeignKey(Service, related_name='ansible_requests')
+    reason = models.CharField(max_length=50, choices=REASONS, default='full')
+    requested_at = models.DateTimeField(auto_now_add=True)
+    run = models.ForeignKey('AnsibleRun', null=True, blank=True, on_delete=models.SET_NULL, related_name='requests')
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.get_reason_display(), self.service)
+
+
+class AnsibleRun(models.Model):
+    """A run of ansible in the VMs of a service and the number of requests (AnsibleRunRequest) that it covered.
+    tags is empty if the full playbook was run"""
+    service = models.ForeignKey(Service, related_name='ansible_runs')
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    successful = models.NullBooleanField()
+    num_requests = models.IntegerField(default=0)
+    reasons = models.CharField(max_length=250, blank=True)
+    tags = models.CharField(max_length=250, blank=True)
+
+    def __unicode__(self):
+        return "Ansible run %s (%s)" % (self.id, self.service)
+
+    @classmethod
+    def start(cls, service):
+        """Starts a new run claiming all the pending requests of the service"""
+        with transaction.atomic():
+            run = cls.objects.create(service=service)
+            pending = AnsibleRunRequest.objects.select_for_update().filter(service=service, run__isnull=True)
+            reasons = sorted(set(pending.values_list('reason', flat=True)))
+            run.num_requests = pending.update(run=run)
+            run.reasons = ",".join(reasons)
+            run.save()
+        return run
+
+    def finish(self, successful):
+        """Marks the run as finished. The requests of an unsuccessful run are released so that they are covered by
+        the next one"""
+        self.finished_at = timezone.now()
+        self.successful = successful
+        self.save()
+        if not successful:
+            self.requests.update(run=None)
+
+
+class AnsibleRollout(models.Model):
+    """A run of the full ansible playbook across a set of services, dispatched in batches by
+    :py:func:`apimws.rollout.rollout_step`. No more than max_concurrency services (counting all the rollouts) run
+    at the same time, no more than max_per_host per host of each cluster, and the rollout is stopped once more than
+    max_failures services have failed."""
+    STATUS_CHOICES = (
+        ('running', 'Running'),
+        ('finished', 'Finished'),
+        ('stopped', 'Stopped'),
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='running')
+    batch_size = models.IntegerField(default=10)
+    max_concurrency = models.IntegerField(default=20)
+    max_per_host = models.IntegerField(default=2)
+    max_failures = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "Ansible rollout %s" % self.id
+
+    def progress(self):
+        """Returns the number of services of the rollout in each status"""
+        progress = dict((status, 0) for status, name in AnsibleRolloutService.STATUS_CHOICES)
+        progress.update(self.services.values_list('status').annotate(num_services=models.Count('id')))
+        return progress
+
+
+class AnsibleRolloutService(models.Model):
+    """A service included in an AnsibleRollout"""
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('skipped', 'Skipped'),
+    )
+
+    rollout = models.ForeignKey(AnsibleRollout, related_name='services')
+    service = models.ForeignKey(Service, related_name='ansible_rollouts')
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='pending', db_index=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ("rollout", "service")
+
+
+class TaskLock(models.Model):
+    """Lock held by a running task, used by :py:mod:`apimws.locks` when Redis is not available"""
+    key = models.CharField(max_length=250, primary_key=True)
+    token = models.CharField(max_length=50)
+    expires_at = models.DateTimeField()
+
+
+class MonthlyStats(models.Model):
+    """Number of MWS servers in use on a date and requested in its month, as shown in the public stats page.
+    Precomputed by :py:func:`apimws.stats.update_monthly_stats`"""
+    date = models.DateField(primary_key=True)
+    in_use = models.PositiveIntegerField()
+    requests = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class FleetSummary(models.Model):
+    """Number of websites and MWS servers on a date, total and live (using a domain name other than the default
+    mws3.csx.cam.ac.uk one). Today's snapshot is refreshed by :py:func:`apimws.stats.update_fleet_summary` and the
+    ones of the previous days are kept as history"""
+    date = models.DateField(primary_key=True)
+    websites = models.PositiveIntegerField()
+    live_websites = models.PositiveIntegerField()
+    servers = models.PositiveIntegerField()
+    live_servers = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BesChange(models.Model):
+    """Change log of the BES++ backup feed (see :py:mod:`apimws.bes`): a site whose entry in the feed may have
+    changed, recorded by :py:mod:`apimws.signals`. The id of the last change is the token that the backup system
+    passes back to get only the sites changed since then. site_id is not a foreign key so that the changes of
+    deleted sites are kept.
+
+    Changes are inserted once the transaction that made them has been committed, so that ids are handed out in
+    commit order and a token never covers a change that was not visible yet. Changes committed at about the same
+    time may still get their ids out of order, see BES_CHANGE_SAFETY_SECONDS in :py:func:`apimws.bes.bes_changes`"""
+    site_id = models.IntegerField(db_index=True)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def record(cls, site_ids):
+        site_ids = set(site_ids) - {None}
+        if site_ids:
+            transaction.on_commit(lambda: cls.objects.bulk_create([cls(site_id=site_id) for site_id in site_ids]))
+
+    @classmethod
+    def latest(cls):
+        return cls.objects.order_by('-id').first()
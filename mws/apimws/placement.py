@@ -0,0 +1,91 @@
+"""
+The :py:mod:`~apimws.placement` module decides in which cluster a new VM is created (see
+:py:func:`apimws.xen.which_cluster`).
+
+The resources used in each cluster are the sum of the CPUs, RAM and disk of the
+:py:class:`~sitesmanagement.models.ServerType` of the sites of its guests, and its capacity is the sum of the
+resources configured in its hosts. Clusters are chosen in this order of preference:
+
+- clusters with enough free resources for the new VM
+- clusters that do not host any VM of the same site, so that the production and test VMs of a site do not end up in
+  the same cluster
+- clusters with capacities configured, the least used first (the highest proportion of any of its resources)
+- clusters with less guests
+
+"""
+
+from django.db.models import OuterRef, Subquery, Sum, Count, IntegerField
+from apimws.models import Cluster, Host
+from sitesmanagement.models import VirtualMachine
+
+
+RESOURCES = ('numcpu', 'sizeram', 'sizedisk')
+
+
+class ClusterLoad(object):
+    """Resources used and available in a cluster"""
+
+    def __init__(self, cluster, capacity, used, guests, site_guests=0):
+        self.cluster = cluster
+        self.capacity = capacity
+        self.used = used
+        self.guests = guests
+        self.site_guests = site_guests
+
+    @staticmethod
+    def needs(server_type):
+        return dict((resource, getattr(server_type, resource) if server_type else 0) for resource in RESOURCES)
+
+    def utilisation(self, server_type=None):
+        """Returns the highest proportion used of any of the resources of the cluster after adding a VM of
+        server_type, or None if the cluster does not have any capacity configured"""
+        needs = self.needs(server_type)
+        utilisations = [float(self.used[resource] + needs[resource]) / self.capacity[resource]
+                        for resource in RESOURCES if self.capacity[resource]]
+        return max(utilisations) if utilisations else None
+
+    def fits(self, server_type):
+        needs = self.needs(server_type)
+        return all(self.used[resource] + needs[resource] <= self.capacity[resource]
+                   for resource in RESOURCES if self.capacity[resource])
+
+    def add(self, server_type):
+        needs = self.needs(server_type)
+        for resource in RESOURCES:
+            self.used[resource] += needs[resource]
+        self.guests += 1
+
+
+def cluster_loads(site=None):
+    """Returns the ClusterLoad of all the clusters with hosts, computed in a single query. Clusters without hosts
+    cannot run VMs and, as they have no capacity configured, would look as if they had room for any VM. If a site is
+    given, site_guests is the number of VMs of the site in each cluster"""
+    def aggregate(queryset, function):
+        return Subquery(queryset.filter(cluster=OuterRef('pk')).order_by().values('cluster')
+                        .annotate(total=function).values('total'), output_field=IntegerField())
+
+    annotations = {'guests_count': aggregate(VirtualMachine.objects.all(), Count('id'))}
+    for resource in RESOURCES:
+        annotations['capacity_' + resource] = aggregate(Host.objects.all(), Sum(resource))
+        annotations['used_' + resource] = aggregate(VirtualMachine.objects.all(),
+                                                    Sum('service__site__type__' + resource))
+    if site:
+        annotations['site_guests'] = aggregate(VirtualMachine.objects.filter(service__site=site), Count('id'))
+
+    return [ClusterLoad(cluster,
+                        capacity=dict((resource, getattr(cluster, 'capacity_' + resource) or 0)
+                                      for resource in RESOURCES),
+                        used=dict((resource, getattr(cluster, 'used_' + resource) or 0) for resource in RESOURCES),
+                        guests=cluster.guests_count or 0, site_guests=getattr(cluster, 'site_guests', None) or 0)
+            for cluster in Cluster.objects.filter(hosts__isnull=False).distinct().annotate(**annotations)
+            .order_by('name')]
+
+
+def choose_cluster(loads, server_type=None):
+    """Returns the ClusterLoad preferred for a new VM of server_type (see the module documentation)"""
+    def preference(load):
+        utilisation = load.utilisation(server_type)
+        return (not load.fits(server_type), load.site_guests > 0, utilisation is None, utilisation, load.guests,
+                load.cluster.name)
+
+    return min(loads, key=preference) if loads else None
@@ -0,0 +1,130 @@
+"""
+The :py:mod:`~apimws.rollout` module runs the full ansible playbook across the fleet (or a subset of it) without
+flooding the celery queue. A rollout (:py:class:`~apimws.models.AnsibleRollout`) is advanced by
+:py:func:`rollout_step`, which reschedules itself every MWS_ANSIBLE_ROLLOUT_POLL seconds until all its services
+have been dispatched and have finished.
+
+"""
+
+import logging
+from collections import Counter, defaultdict
+from celery import shared_task, Task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from apimws.ansible import launch_ansible
+from apimws.models import AnsibleRollout, AnsibleRolloutService, AnsibleRun, Host
+from sitesmanagement.models import VirtualMachine
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class RolloutTaskWithFailure(Task):
+    abstract = True
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        LOGGER.error("An error happened when trying to advance an ansible rollout.\nThe task id is %s.\n\n"
+                     "The parameters passed to the task were: %s\n\nThe traceback is:\n%s\n", task_id, args, einfo)
+
+
+def start_rollout(services, **options):
+    """Creates a rollout of the full ansible playbook for the services given and starts it
+    :param services: the queryset of Services
+    :param options: batch_size, max_concurrency, max_per_host and max_failures of the rollout
+    :return: the AnsibleRollout
+    """
+    with transaction.atomic():
+        rollout = AnsibleRollout.objects.create(**options)
+        AnsibleRolloutService.objects.bulk_create(
+            AnsibleRolloutService(rollout=rollout, service_id=service_id)
+            for service_id in services.order_by('id').values_list('id', flat=True).distinct())
+    rollout_step.delay(rollout.id)
+    return rollout
+
+
+def stop_rollout(rollout):
+    """Stops dispatching the services of the rollout. Services already running are not interrupted."""
+    AnsibleRollout.objects.filter(id=rollout.id, status='running').update(status='stopped', finished_at=timezone.now())
+
+
+def update_running_services(rollout):
+    """Checks the services of the rollout that were running and marks those which have finished as done or failed
+    depending on the result of their last ansible run"""
+    for rollout_service in rollout.services.filter(status='running').select_related('service'):
+        if rollout_service.service.status != 'ready':
+            continue
+        last_run = AnsibleRun.objects.filter(service=rollout_service.service,
+                                             started_at__gte=rollout_service.started_at).order_by('-id').first()
+        rollout_service.status = 'done' if last_run and last_run.successful else 'failed'
+        rollout_service.finished_at = timezone.now()
+        rollout_service.save()
+
+
+def clusters_of_services(service_ids):
+    """Returns the set of clusters where the VMs of each service are by service id"""
+    clusters = defaultdict(set)
+    for service_id, cluster_id in VirtualMachine.objects.filter(service_id__in=service_ids) \
+            .values_list('service_id', 'cluster_id'):
+        clusters[service_id].add(cluster_id)
+    return clusters
+
+
+def dispatch_services(rollout):
+    """Launches ansible for the next batch of pending services of the rollout without exceeding the maximum number
+    of services running at the same time, either in total or per cluster"""
+    running = AnsibleRolloutService.objects.filter(status='running', rollout__status='running')
+    slots = min(rollout.batch_size, rollout.max_concurrency - running.count())
+    if slots <= 0:
+        return 0
+    pending = list(rollout.services.filter(status='pending').select_related('service')
+                   .order_by('id')[:max(slots * 5, 50)])
+    clusters = clusters_of_services([rs.service_id for rs in pending] +
+                                    list(running.values_list('service_id', flat=True)))
+    running_per_cluster = Counter(cluster for service_id in running.values_list('service_id', flat=True)
+                                  for cluster in clusters[service_id])
+    hosts_per_cluster = dict(Host.objects.values_list('cluster').annotate(num_hosts=Count('hostname')))
+
+    dispatched = 0
+    for rollout_service in pending:
+        if dispatched >= slots:
+            break
+        service = rollout_service.service
+        if service.status not in ('ready', 'ansible', 'ansible_queued') or not clusters[service.id]:
+            # The service is being installed or does not have any VM
+            rollout_service.status = 'skipped'
+            rollout_service.save()
+            continue
+        if any(running_per_cluster[cluster] >= rollout.max_per_host * max(hosts_per_cluster.get(cluster, 1), 1)
+               for cluster in clusters[service.id]):
+            continue
+        rollout_service.status = 'running'
+        rollout_service.started_at = timezone.now()
+        rollout_service.save()
+        running_per_cluster.update(clusters[service.id])
+        dispatched += 1
+        launch_ansible(service, 'full')
+    return dispatched
+
+
+@shared_task(base=RolloutTaskWithFailure)
+def rollout_step(rollout_id):
+    """Advances a rollout: checks the services that were running, stops the rollout if too many of them have failed
+    and dispatches the next batch"""
+    rollout = AnsibleRollout.objects.get(id=rollout_id)
+    if rollout.status != 'running':
+        return
+    update_running_services(rollout)
+    progress = rollout.progress()
+    if progress['failed'] > rollout.max_failures:
+        stop_rollout(rollout)
+        LOGGER.error("Ansible rollout %s has been stopped after %d services failed", rollout.id, progress['failed'])
+        return
+    if not progress['pending'] and not progress['running']:
+        AnsibleRollout.objects.filter(id=rollout.id).update(status='finished', finished_at=timezone.now())
+        LOGGER.info("Ansible rollout %s finished: %s", rollout.id, progress)
+        return
+    dispatched = dispatch_services(rollout)
+    LOGGER.info("Ansible rollout %s: %d services dispatched, progress: %s", rollout.id, dispatched, progress)
+    rollout_step.apply_async(args=(rollout_id, ), countdown=getattr(settings, 'MWS_ANSIBLE_ROLLOUT_POLL', 30))
@@ -0,0 +1,208 @@
+"""
+Signal handlers that invalidate the cached Ansible hostvars
+(:py:class:`~apimws.models.HostvarsCache`) of the VMs affected by a change in
+the database, and that record the sites whose entry in the BES++ backup feed
+changes (:py:class:`~apimws.models.BesChange`).
+
+"""
+from django.db.models import Q
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from apimws.bes import BES_SERVICE_STATUSES
+from apimws.models import HostvarsCache, AnsibleConfiguration, PHPLib, BesChange
+from mwsauth.models import MWSUser, LookupGroupMembership
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, Vhost, DomainName, UnixGroup, \
+    SiteKey
+
+
+def invalidate_service(service_id):
+    """The hostvars of a VM depend on both services of its site: the test service uses the vhosts of the
+    production one and the production service needs to know about the test one"""
+    HostvarsCache.invalidate(Q(vm__service_id=service_id) | Q(vm__service__site__services__id=service_id))
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_site_hostvars(instance, **kwargs):
+    HostvarsCache.invalidate(vm__service__site_id=instance.id)
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def invalidate_service_hostvars(instance, **kwargs):
+    invalidate_service(instance.id)
+
+
+@receiver(post_save, sender=VirtualMachine)
+@receiver(post_delete, sender=VirtualMachine)
+def invalidate_vm_hostvars(instance, **kwargs):
+    invalidate_service(instance.service_id)
+
+
+@receiver(post_save, sender=NetworkConfig)
+def invalidate_network_configuration_hostvars(instance, **kwargs):
+    HostvarsCache.invalidate(Q(vm__network_configuration=instance) |
+                             Q(vm__service__site__services__network_configuration=instance))
+
+
+@receiver(post_save, sender=Vhost)
+@receiver(post_delete, sender=Vhost)
+@receiver(post_save, sender=UnixGroup)
+@receiver(post_delete, sender=UnixGroup)
+def invalidate_service_objects_hostvars(instance, **kwargs):
+    invalidate_service(instance.service_id)
+
+
+@receiver(post_save, sender=DomainName)
+@receiver(post_delete, sender=DomainName)
+def invalidate_domain_name_hostvars(instance, **kwargs):
+    HostvarsCache.invalidate(Q(vm__service__vhosts__id=instance.vhost_id) |
+                             Q(vm__service__site__services__vhosts__id=instance.vhost_id))
+
+
+@receiver(post_save, sender=AnsibleConfiguration)
+@receiver(post_delete, sender=AnsibleConfiguration)
+def invalidate_ansible_configuration_hostvars(instance, **kwargs):
+    # Only the operating system is passed to ansible, other keys (e.g. backup_first_date) are updated often
+    if instance.key == 'os':
+        HostvarsCache.invalidate(vm__service_id=instance.service_id)
+
+
+@receiver(post_save, sender=PHPLib)
+@receiver(post_delete, sender=PHPLib)
+def invalidate_php_lib_hostvars(instance, **kwargs):
+    # All the VMs get the list of PHP libraries that are not enabled
+    HostvarsCache.invalidate()
+
+
+def invalidate_users_hostvars(usernames):
+    """Invalidates the hostvars of the VMs of the sites of the users given, e.g. after a bulk update of their
+    MWSUser that does not send signals"""
+    HostvarsCache.invalidate(Q(vm__service__site__users__username__in=usernames) |
+                             Q(vm__service__site__ssh_users__username__in=usernames) |
+                             Q(vm__service__site__supporters__username__in=usernames) |
+                             Q(vm__service__site__groups__membership__users__username__in=usernames) |
+                             Q(vm__service__site__ssh_groups__membership__users__username__in=usernames))
+
+
+@receiver(post_save, sender=MWSUser)
+@receiver(post_delete, sender=MWSUser)
+def invalidate_mws_user_hostvars(instance, **kwargs):
+    invalidate_users_hostvars([instance.user_id])
+
+
+@receiver(m2m_changed, sender=Site.users.through)
+@receiver(m2m_changed, sender=Site.ssh_users.through)
+@receiver(m2m_changed, sender=Site.groups.through)
+@receiver(m2m_changed, sender=Site.ssh_groups.through)
+@receiver(m2m_changed, sender=Site.supporters.through)
+def invalidate_site_members_hostvars(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        HostvarsCache.invalidate(vm__service__site_id=instance.id)
+    elif pk_set is not None:
+        HostvarsCache.invalidate(vm__service__site_id__in=pk_set)
+    else:
+        # A user or a group has been removed from all their sites, which are not known anymore
+        HostvarsCache.invalidate()
+
+
+@receiver(m2m_changed, sender=UnixGroup.users.through)
+def invalidate_unix_group_members_hostvars(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_service(instance.service_id)
+    elif pk_set is not None:
+        HostvarsCache.invalidate(Q(vm__service__unix_groups__id__in=pk_set) |
+                                 Q(vm__service__site__services__unix_groups__id__in=pk_set))
+    else:
+        HostvarsCache.invalidate()
+
+
+@receiver(m2m_changed, sender=PHPLib.services.through)
+def invalidate_php_lib_services_hostvars(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        HostvarsCache.invalidate(vm__service=instance)
+    elif pk_set is not None:
+        HostvarsCache.invalidate(vm__service_id__in=pk_set)
+    else:
+        HostvarsCache.invalidate()
+
+
+@receiver(m2m_changed, sender=LookupGroupMembership.users.through)
+def invalidate_lookup_group_members_hostvars(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        HostvarsCache.invalidate(Q(vm__service__site__groups__membership=instance) |
+                                 Q(vm__service__site__ssh_groups__membership=instance))
+    elif pk_set is not None:
+        HostvarsCache.invalidate(Q(vm__service__site__groups__in=pk_set) |
+                                 Q(vm__service__site__ssh_groups__in=pk_set))
+    else:
+        HostvarsCache.invalidate()
+
+
+# The values of each model that are part of the BES++ feed. They are read from __dict__ so that querysets that
+# defer a field do not need an extra query per instance
+BES_FEED_VALUES = {
+    Site: lambda instance: (instance.__dict__.get('deleted'), instance.__dict__.get('end_date'),
+                            instance.__dict__.get('disabled')),
+    Service: lambda instance: (instance.__dict__.get('status') in BES_SERVICE_STATUSES,
+                               instance.__dict__.get('site_id'), instance.__dict__.get('network_configuration_id')),
+    VirtualMachine: lambda instance: (instance.__dict__.get('name'), instance.__dict__.get('service_id'),
+                                      instance.__dict__.get('network_configuration_id')),
+    SiteKey: lambda instance: (instance.__dict__.get('site_id'), instance.__dict__.get('type'),
+                               instance.__dict__.get('public_key')),
+    NetworkConfig: lambda instance: instance.__dict__.get('name'),
+}
+
+
+@receiver(post_init, sender=Site)
+@receiver(post_init, sender=Service)
+@receiver(post_init, sender=VirtualMachine)
+@receiver(post_init, sender=SiteKey)
+@receiver(post_init, sender=NetworkConfig)
+def remember_bes_feed_values(sender, instance, **kwargs):
+    instance._loaded_bes_feed_values = BES_FEED_VALUES[sender](instance)
+
+
+def bes_feed_site_ids(sender, instance, values):
+    """Returns the ids of the sites whose entry in the feed depends on the instance, given the values it has had"""
+    if sender is Site:
+        return {instance.id}
+    if sender is Service:
+        return set(site_id for ready, site_id, network_configuration_id in values)
+    if sender is SiteKey:
+        return set(site_id for site_id, type, public_key in values)
+    if sender is VirtualMachine:
+        return set(Service.objects.filter(id__in=[service_id for name, service_id, netconf_id in values])
+                   .values_list('site_id', flat=True))
+    return set(Site.objects.filter(Q(services__network_configuration=instance) |
+                                   Q(services__virtual_machines__network_configuration=instance))
+               .values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_save, sender=Service)
+@receiver(post_save, sender=VirtualMachine)
+@receiver(post_save, sender=SiteKey)
+@receiver(post_save, sender=NetworkConfig)
+def record_bes_feed_change(sender, instance, created, **kwargs):
+    # Changes that do not modify the feed, e.g. a service going from ready to ansible, are not recorded
+    values = BES_FEED_VALUES[sender](instance)
+    if created or values != instance._loaded_bes_feed_values:
+        BesChange.record(bes_feed_site_ids(sender, instance, [values, instance._loaded_bes_feed_values]))
+        instance._loaded_bes_feed_values = values
+
+
+@receiver(post_delete, sender=Site)
+@receiver(post_delete, sender=Service)
+@receiver(post_delete, sender=VirtualMachine)
+@receiver(post_delete, sender=SiteKey)
+def record_bes_feed_deletion(sender, instance, **kwargs):
+    BesChange.record(bes_feed_site_ids(sender, instance, [BES_FEED_VALUES[sender](instance)]))
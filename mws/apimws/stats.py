@@ -0,0 +1,103 @@
+"""
+The :py:mod:`~apimws.stats` module computes the time series and the summary of the fleet shown in the public stats
+page. They are stored in :py:class:`~apimws.models.MonthlyStats` and :py:class:`~apimws.models.FleetSummary` by
+periodic tasks so that serving them does not need to count the sites of every month since the service started or
+join the sites with their domain names.
+
+"""
+
+import calendar
+import hashlib
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.db.models import Q, Max, Count
+from apimws.models import MonthlyStats, FleetSummary
+from sitesmanagement.models import Site, DomainName, Vhost
+
+
+def add_months(sourcedate, months=1):
+    month = sourcedate.month - 1 + months
+    year = sourcedate.year + month / 12
+    month = month % 12 + 1
+    day = min(sourcedate.day, calendar.monthrange(year, month)[1])
+    return date(year, month, day)
+
+
+def stats_dates():
+    """Returns the dates of the points of the time series, one per month from the start of the service until next
+    month"""
+    dates = []
+    today = add_months(datetime.today().date())
+    odate = date(2016, 4, 1) - timedelta(days=1)
+    while odate < today:
+        dates.append(odate)
+        odate = add_months(odate)
+    return dates
+
+
+def sites_in_use(odate):
+    return Site.objects.filter(Q(start_date__lte=odate), Q(end_date__gt=odate) | Q(end_date__isnull=True),
+                               Q(preallocated=False), Q(exmws2__isnull=True)).count() + \
+        Site.objects.filter(Q(exmws2__isnull=False), Q(exmws2__lte=odate),
+                            Q(end_date__gt=odate) | Q(end_date__isnull=True)).count()  # exmws2 sites
+
+
+def sites_requested(odate):
+    return Site.objects.filter(Q(start_date__month=odate.month, start_date__year=odate.year,
+                                 preallocated=False, exmws2__isnull=True) |
+                               Q(exmws2__month=odate.month, exmws2__year=odate.year)).count()  # + exmws2 sites
+
+
+def update_monthly_stats(full=False):
+    """Stores the points of the time series that are missing or that can still change: those less than
+    MWS_STATS_REFRESH_DAYS days old (sites are started and cancelled today, and next month's point counts the sites
+    in use today). Everything is recomputed if full is True. Returns the number of points computed"""
+    dates = stats_dates()
+    MonthlyStats.objects.exclude(date__in=dates).delete()
+    stored = set(MonthlyStats.objects.values_list('date', flat=True))
+    since = date.today() - timedelta(days=getattr(settings, 'MWS_STATS_REFRESH_DAYS', 62))
+    computed = 0
+    for odate in dates:
+        if full or odate not in stored or odate >= since:
+            MonthlyStats.objects.update_or_create(date=odate, defaults={'in_use': sites_in_use(odate),
+                                                                        'requests': sites_requested(odate)})
+            computed += 1
+    return computed
+
+
+def monthly_stats_version():
+    """Returns the time the time series were last updated and an ETag for them, or (None, None) if they have not
+    been computed yet"""
+    version = MonthlyStats.objects.aggregate(updated_at=Max('updated_at'), points=Count('date'))
+    if not version['updated_at']:
+        return None, None
+    return version['updated_at'], hashlib.md5("%s-%d" % (version['updated_at'].isoformat(),
+                                                         version['points'])).hexdigest()
+
+
+def monthly_stats():
+    """Returns the points of the time series, computing them first if the periodic task has not run yet"""
+    points = list(MonthlyStats.objects.order_by('date'))
+    if not points:
+        update_monthly_stats()
+        points = list(MonthlyStats.objects.order_by('date'))
+    return points
+
+
+def update_fleet_summary():
+    """Stores today's numbers of websites and MWS servers, total and live"""
+    all = Site.objects.filter(Q(end_date__gt=datetime.today().date()) | Q(end_date__isnull=True), preallocated=False)
+    external_domains = DomainName.objects.exclude(name__endswith="mws3.csx.cam.ac.uk")
+    websites = Vhost.objects.filter(service__site__preallocated=False, service__site__end_date__isnull=True)
+    summary, created = FleetSummary.objects.update_or_create(date=date.today(), defaults={
+        'websites': websites.count(),
+        'live_websites': websites.exclude(main_domain__name__endswith="mws3.csx.cam.ac.uk").count(),
+        'servers': all.count(),
+        'live_servers': all.filter(services__vhosts__domain_names__in=external_domains).distinct().count(),
+    })
+    return summary
+
+
+def fleet_summary():
+    """Returns the latest summary of the fleet, computing it first if the periodic task has not run yet"""
+    return FleetSummary.objects.order_by('-date').first() or update_fleet_summary()
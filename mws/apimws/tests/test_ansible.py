@@ -0,0 +1,195 @@
+import subprocess
+import threading
+import uuid
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import mock
+from apimws.ansible import launch_ansible, launch_ansible_async, ansible_tags, run_in_vms, VMCommandError
+from apimws.models import Cluster, Host, AnsibleRun, AnsibleRunRequest
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, ServerType
+
+
+TEST_ANSIBLE_TAGS = {
+    'vhosts': ['vhosts'],
+    'domains': ['vhosts'],
+    'tls': ['vhosts', 'tls'],
+    'users': ['users'],
+    'unix_groups': ['unix_groups'],
+    'php_libs': ['php_libs'],
+}
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class AnsibleSchedulerTests(TestCase):
+
+    def setUp(self):
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.example", cluster=cluster)
+        NetworkConfig.objects.create(IPv4='198.51.100.1', IPv6='2001:db8:212:8::8c:1', type='ipvxpub',
+                                     name="mws-1.mws3.example")
+        NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:1', name='mws-guest1.example', type='ipv6')
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        self.service = Service.objects.create(type="production", site=site, status="ready",
+                                              network_configuration=NetworkConfig.get_free_prod_service_config())
+        VirtualMachine.objects.create(name="test_vm", token=uuid.uuid4(), service=self.service, cluster=cluster,
+                                      network_configuration=NetworkConfig.get_free_host_config())
+
+    def test_requests_merged(self):
+        # A run has been scheduled and it is waiting for the debounce window to finish
+        self.service.status = 'ansible'
+        self.service.save()
+        launch_ansible(self.service, 'vhosts')
+        launch_ansible(self.service, 'domains')
+        launch_ansible(Service.objects.get(id=self.service.id), 'vhosts')
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ansible_queued')
+        self.assertEqual(AnsibleRunRequest.objects.filter(run__isnull=True).count(), 3)
+
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            launch_ansible_async(self.service)
+            mock_check_output.assert_called_once_with(["userv", "mws-admin", "mws_ansible_host",
+                                                       "mws-guest1.example"], stderr=subprocess.STDOUT)
+        run = AnsibleRun.objects.get()
+        self.assertEqual(run.num_requests, 3)
+        self.assertEqual(run.reasons, "domains,vhosts")
+        self.assertTrue(run.successful)
+        self.assertIsNotNone(run.finished_at)
+        self.assertFalse(AnsibleRunRequest.objects.filter(run__isnull=True).exists())
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+    def test_request_while_running(self):
+        def request_during_first_run(*args, **kwargs):
+            if mock_check_output.call_count == 1:
+                launch_ansible(Service.objects.get(id=self.service.id), 'unix_groups')
+
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            mock_check_output.side_effect = request_during_first_run
+            launch_ansible(self.service, 'php_libs')
+            self.assertEqual(mock_check_output.call_count, 2)
+        self.assertEqual(list(AnsibleRun.objects.order_by('id').values_list('num_requests', 'reasons')),
+                         [(1, 'php_libs'), (1, 'unix_groups')])
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+    def test_failed_run_releases_requests(self):
+        self.service.status = 'ansible'
+        self.service.save()
+        launch_ansible(self.service, 'tls')
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            mock_check_output.side_effect = subprocess.CalledProcessError(1, "userv", "error")
+            with self.assertRaises(subprocess.CalledProcessError):
+                launch_ansible_async(Service.objects.get(id=self.service.id))
+        self.assertFalse(AnsibleRun.objects.last().successful)
+        self.assertEqual(AnsibleRunRequest.objects.filter(run__isnull=True).count(), 1)
+
+    def test_ansible_stats(self):
+        self.service.status = 'ansible'
+        self.service.save()
+        for reason in ['vhosts', 'vhosts', 'domains']:
+            launch_ansible(self.service, reason)
+        with mock.patch("apimws.ansible.subprocess.check_output"):
+            launch_ansible_async(self.service)
+        out = StringIO()
+        call_command('ansible_stats', stdout=out)
+        self.assertIn("Runs: 1\n", out.getvalue())
+        self.assertIn("Requests covered: 3\n", out.getvalue())
+        self.assertIn("Requests merged: 2\n", out.getvalue())
+        self.assertIn("  vhosts: 2\n", out.getvalue())
+
+    @override_settings(MWS_ANSIBLE_TAGS=TEST_ANSIBLE_TAGS)
+    def test_partial_runs(self):
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            # There has not been any full run yet
+            launch_ansible(self.service, 'domains')
+            mock_check_output.assert_called_once_with(["userv", "mws-admin", "mws_ansible_host",
+                                                       "mws-guest1.example"], stderr=subprocess.STDOUT)
+            mock_check_output.reset_mock()
+            launch_ansible(Service.objects.get(id=self.service.id), 'domains')
+            mock_check_output.assert_called_once_with(["userv", "mws-admin", "mws_ansible_host_d",
+                                                       "mws-guest1.example", "--tags", "vhosts"],
+                                                      stderr=subprocess.STDOUT)
+        self.assertEqual(AnsibleRun.objects.last().tags, "vhosts")
+
+    @override_settings(MWS_ANSIBLE_TAGS=TEST_ANSIBLE_TAGS)
+    def test_ansible_tags(self):
+        AnsibleRun.objects.create(service=self.service, successful=True)
+        self.assertEqual(ansible_tags(self.service, ['domains', 'vhosts', 'tls']), ['tls', 'vhosts'])
+        self.assertEqual(ansible_tags(self.service, ['users', 'unix_groups']), ['unix_groups', 'users'])
+        # Reasons that are not covered by any tag
+        self.assertIsNone(ansible_tags(self.service, ['vhosts', 'site']))
+        self.assertIsNone(ansible_tags(self.service, []))
+        # Too many roles affected
+        self.assertIsNone(ansible_tags(self.service, ['tls', 'users', 'php_libs']))
+        with self.settings(MWS_ANSIBLE_PARTIAL_MAX_TAGS=4):
+            self.assertEqual(ansible_tags(self.service, ['tls', 'users', 'php_libs']),
+                             ['php_libs', 'tls', 'users', 'vhosts'])
+        # The last full run is too old
+        AnsibleRun.objects.update(started_at=timezone.now() - timedelta(days=2))
+        self.assertIsNone(ansible_tags(self.service, ['vhosts']))
+        AnsibleRun.objects.create(service=self.service, successful=True, tags="vhosts")
+        self.assertIsNone(ansible_tags(self.service, ['vhosts']))
+
+    def test_full_runs_by_default(self):
+        AnsibleRun.objects.create(service=self.service, successful=True)
+        self.assertIsNone(ansible_tags(self.service, ['vhosts']))
+        self.assertIsNone(ansible_tags(self.service, ['unix_groups']))
+
+    @override_settings(MWS_ANSIBLE_TAGS=TEST_ANSIBLE_TAGS)
+    def test_unix_groups_deleted_after_run(self):
+        AnsibleRun.objects.create(service=self.service, successful=True)
+        self.service.unix_groups.create(name="GROUP", to_be_deleted=True)
+        with mock.patch("apimws.ansible.subprocess.check_output"):
+            launch_ansible(self.service, 'vhosts')
+            self.assertTrue(self.service.unix_groups.exists())
+            launch_ansible(Service.objects.get(id=self.service.id), 'unix_groups')
+            self.assertFalse(self.service.unix_groups.exists())
+
+
+class RunInVMsTests(TestCase):
+
+    def setUp(self):
+        self.vms = [mock.Mock(network_configuration=mock.Mock()) for n in range(3)]
+        for n, vm in enumerate(self.vms):
+            vm.network_configuration.name = "mws-guest%d.example" % n
+
+    def test_run_in_vms(self):
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            mock_check_output.side_effect = lambda cmd, stderr: "ok %s" % cmd[-1]
+            output = run_in_vms(self.vms, lambda vm: ["userv", "mws-admin", "mws_ansible_host",
+                                                      vm.network_configuration.name])
+        self.assertEqual(output.items(), [("mws-guest0.example", "ok mws-guest0.example"),
+                                          ("mws-guest1.example", "ok mws-guest1.example"),
+                                          ("mws-guest2.example", "ok mws-guest2.example")])
+        self.assertEqual(mock_check_output.call_count, 3)
+
+    def test_run_in_vms_concurrently(self):
+        # All the VMs need to be running at the same time for the command to succeed
+        running = []
+        all_running = threading.Event()
+
+        def wait_for_all(cmd, stderr):
+            running.append(cmd)
+            if len(running) == 3:
+                all_running.set()
+            if not all_running.wait(5):
+                raise subprocess.CalledProcessError(1, cmd, "timeout")
+            return "ok"
+
+        with mock.patch("apimws.ansible.subprocess.check_output", side_effect=wait_for_all):
+            with self.settings(MWS_ANSIBLE_VM_CONCURRENCY=3):
+                self.assertEqual(len(run_in_vms(self.vms, lambda vm: [vm.network_configuration.name])), 3)
+
+    def test_run_in_vms_errors(self):
+        def fail_in_guest1(cmd, stderr):
+            if cmd[-1] == "mws-guest1.example":
+                raise subprocess.CalledProcessError(2, cmd, "unreachable")
+            return "ok"
+
+        with mock.patch("apimws.ansible.subprocess.check_output", side_effect=fail_in_guest1) as mock_check_output:
+            with self.assertRaises(VMCommandError) as cm:
+                run_in_vms(self.vms, lambda vm: ["userv", vm.network_configuration.name])
+        # The command has been run in all the VMs even if it failed in one of them
+        self.assertEqual(mock_check_output.call_count, 3)
+        self.assertEqual(cm.exception.errors.keys(), ["mws-guest1.example"])
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertEqual(cm.exception.output, "mws-guest1.example: unreachable")
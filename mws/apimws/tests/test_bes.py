@@ -1,10 +1,19 @@
 import json
 import os
+import threading
+import uuid
+from datetime import date, timedelta
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.test import override_settings, TestCase
+from django.db import connection, transaction
+from django.test import override_settings, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
+from mock import mock
+from apimws.bes import prune_bes_changes, bes_site, bes_changes
+from apimws.ipreg import fake_backend, invalidate_cache
+from apimws.models import Cluster, BesChange
 from mwsauth.tests import do_test_login
-from sitesmanagement.models import Site, VirtualMachine
+from sitesmanagement.models import Site, VirtualMachine, ServerType, NetworkConfig, Service, SiteKey
 from sitesmanagement.tests.tests import assign_a_site
 
 
@@ -35,3 +44,195 @@ class BesTests(TestCase):
             json_vms.append(json_vm)
         json_site['vms'] = json_vms
         self.assertContains(response, json.dumps([json_site]))
+
+
+@override_settings(IP_REG_API_BACKEND='fake', BES_CHANGE_SAFETY_SECONDS=0)
+class BesFeedTests(TestCase):
+
+    def setUp(self):
+        fake_backend.reset()
+        invalidate_cache()
+        self.addCleanup(invalidate_cache)
+        # The transaction of a TestCase is never committed, record the changes straight away
+        patcher = mock.patch("apimws.models.transaction.on_commit", side_effect=lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        server_type = ServerType.objects.get(id=1)
+        for n in range(4):
+            site = Site.objects.create(name="testSite%d" % n, type=server_type, start_date=date.today())
+            for m, (type, status) in enumerate((('production', 'ready'), ('test', 'ready'))):
+                netconf = NetworkConfig.objects.create(IPv4='198.51.100.%d' % (n*2+m), type='ipvxpub',
+                                                       IPv6='2001:db8:212:8::8c:%d' % (n*2+m),
+                                                       name="mws-%d-%d.mws3.example" % (n, m))
+                service = Service.objects.create(site=site, type=type, status=status, network_configuration=netconf)
+                vm_netconf = NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:%d' % (n*2+m), type='ipv6',
+                                                          name='mws-guest%d-%d.example' % (n, m))
+                VirtualMachine.objects.create(name=vm_netconf.name, token=uuid.uuid4(), service=service,
+                                              network_configuration=vm_netconf, cluster=Cluster.objects.first())
+            SiteKey.objects.create(site=site, type="RSA", public_key="ssh-rsa AAAA%d" % n)
+        Site.objects.filter(name="testSite3").update(end_date=date.today())
+
+    def get_feed(self, data=None, **headers):
+        response = self.client.get(reverse("apimws.bes.bes"), data, **headers)
+        if response.status_code == 200:
+            return response, json.loads(''.join(response.streaming_content))
+        return response, None
+
+    def test_feed(self):
+        response, feed = self.get_feed()
+        # Each site only once, with the VMs of both services
+        self.assertEqual([json_site['id'] for json_site in feed],
+                         ["mwssite-%d" % site.id for site in Site.objects.exclude(name="testSite3").order_by('id')])
+        self.assertEqual(feed[0]['ssh-public-key-rsa'], "ssh-rsa AAAA0")
+        self.assertEqual([(vm['fqdn'], vm['service_fqdn']) for vm in feed[0]['vms']],
+                         [("mws-guest0-0.example", "mws-0-0.mws3.example"),
+                          ("mws-guest0-1.example", "mws-0-1.mws3.example")])
+
+    @override_settings(BES_FEED_CHUNK_SIZE=2)
+    def test_bounded_queries(self):
+        self.get_feed()
+        # Version and ids, and 4 queries for each chunk of sites
+        with self.assertNumQueries(2 + 2 * 4):
+            self.get_feed()
+
+    def test_conditional_requests(self):
+        response, feed = self.get_feed()
+        response, feed = self.get_feed(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Changes that do not modify the feed keep the version
+        Service.objects.get(site__name="testSite0", type='production').save()
+        service = Service.objects.get(site__name="testSite0", type='production')
+        service.status = 'ansible'
+        service.save()
+        site = Site.objects.get(name="testSite0")
+        site.description = "A description"
+        site.save()
+        self.assertEqual(self.get_feed(HTTP_IF_NONE_MATCH=response['ETag'])[0].status_code, 304)
+
+        site.disabled = True
+        site.save()
+        new_response, feed = self.get_feed(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(new_response.status_code, 200)
+        self.assertTrue(feed[0]['vms'][0]['disabled'])
+
+        SiteKey.objects.filter(site=site).delete()
+        self.assertEqual(self.get_feed(HTTP_IF_NONE_MATCH=new_response['ETag'])[0].status_code, 200)
+
+    def test_delta(self):
+        response, feed = self.get_feed()
+        token = response['X-BES-Token']
+        response, feed = self.get_feed(data={'since': token})
+        self.assertEqual(feed, [])
+        self.assertEqual(response['X-BES-Token'], token)
+
+        site0, site1, site2 = Site.objects.order_by('id')[:3]
+        site0.disabled = True
+        site0.save()
+        netconf = VirtualMachine.objects.filter(service__site=site1).order_by('id').first().network_configuration
+        netconf.name = "mws-guest-renamed.example"
+        netconf.save()
+        # Changes that are not recorded, but the site has reached the end date set two days ago
+        BesChange.objects.update(changed_at=timezone.now() - timedelta(days=2))
+        Site.objects.filter(id=site2.id).update(end_date=date.today())
+        response, feed = self.get_feed(data={'since': token})
+        self.assertEqual(feed[:2], [bes_site(site) for site in Site.objects.filter(id__in=[site0.id, site1.id])
+                                    .order_by('id')])
+        self.assertTrue(feed[0]['vms'][0]['disabled'])
+        self.assertEqual(feed[1]['vms'][0]['fqdn'], "mws-guest-renamed.example")
+        # Tombstones of the sites that have reached their end date since then, even if they were not in the feed
+        self.assertEqual(feed[2:], [{'id': "mwssite-%d" % site.id, 'deleted': True}
+                                    for site in Site.objects.filter(end_date=date.today()).order_by('id')])
+        self.assertEqual(feed[2]['id'], "mwssite-%d" % site2.id)
+
+        token = response['X-BES-Token']
+        BesChange.objects.update(changed_at=timezone.now())
+        SiteKey.objects.filter(site=site1).delete()
+        site0_id = site0.id
+        with mock.patch("apimws.xen.vm_api_request"):
+            site0.delete()
+        response, feed = self.get_feed(data={'since': token})
+        self.assertEqual([json_site['id'] for json_site in feed], ["mwssite-%d" % site1.id, "mwssite-%d" % site0_id])
+        self.assertNotIn('ssh-public-key-rsa', feed[0])
+        self.assertEqual(feed[1], {'id': "mwssite-%d" % site0_id, 'deleted': True})
+
+    @override_settings(BES_CHANGE_SAFETY_SECONDS=60)
+    def test_delta_safety_window(self):
+        BesChange.objects.update(changed_at=timezone.now() - timedelta(days=1))
+        site0, site1 = Site.objects.order_by('id')[:2]
+        latest = BesChange.latest().id
+        BesChange.objects.create(id=latest + 2, site_id=site1.id)
+        token = self.get_feed()[0]['X-BES-Token']
+        self.assertEqual(token, str(latest + 2))
+        # The change of site0 got its id first but was inserted after the client got the token
+        BesChange.objects.create(id=latest + 1, site_id=site0.id)
+        response, feed = self.get_feed(data={'since': token})
+        # The changes of the last BES_CHANGE_SAFETY_SECONDS before the token are sent again, but not the older ones
+        self.assertEqual([json_site['id'] for json_site in feed], ["mwssite-%d" % site0.id, "mwssite-%d" % site1.id])
+
+    def test_invalid_tokens(self):
+        self.assertEqual(self.get_feed(data={'since': 'abc'})[0].status_code, 400)
+        BesChange.objects.filter(id__lt=BesChange.latest().id).delete()
+        self.assertEqual(self.get_feed(data={'since': 1})[0].status_code, 410)
+
+    def test_prune_bes_changes(self):
+        latest = BesChange.latest()
+        BesChange.objects.update(changed_at=timezone.now() - timedelta(days=31))
+        prune_bes_changes()
+        self.assertEqual(list(BesChange.objects.all()), [latest])
+
+
+class BesChangeTransactionTests(TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        self.sites = [Site.objects.create(name="testSite%d" % n, type=ServerType.objects.get(id=1),
+                                          start_date=date.today()) for n in range(2)]
+
+    def disable(self, site):
+        site = Site.objects.get(id=site.id)
+        site.disabled = True
+        site.save()
+
+    def test_recorded_on_commit(self):
+        token = BesChange.latest().id
+        with transaction.atomic():
+            self.disable(self.sites[0])
+            self.assertEqual(BesChange.latest().id, token)
+        self.assertEqual(list(BesChange.objects.filter(id__gt=token).values_list('site_id', flat=True)),
+                         [self.sites[0].id])
+
+        token = BesChange.latest().id
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.disable(self.sites[1])
+                raise ValueError()
+        self.assertEqual(BesChange.latest().id, token)
+
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    @override_settings(BES_CHANGE_SAFETY_SECONDS=0)
+    def test_interleaved_transactions(self):
+        token = BesChange.latest().id
+        saved = threading.Event()
+        polled = threading.Event()
+
+        def change_in_transaction():
+            try:
+                with transaction.atomic():
+                    self.disable(self.sites[0])
+                    saved.set()
+                    polled.wait(5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=change_in_transaction)
+        thread.start()
+        saved.wait(5)
+        # A change committed while the other transaction is still open, and a poll between both commits
+        self.disable(self.sites[1])
+        self.assertEqual([entry['id'] for entry in bes_changes(token)], ["mwssite-%d" % self.sites[1].id])
+        token = BesChange.latest().id
+        polled.set()
+        thread.join()
+        # The change of the transaction committed later is not covered by the token returned in between
+        self.assertEqual([entry['id'] for entry in bes_changes(token)], ["mwssite-%d" % self.sites[0].id])
@@ -0,0 +1,79 @@
+import json
+import uuid
+from datetime import date, timedelta
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from mock import mock
+from apimws.capacity import capacity_report
+from apimws.models import Cluster, Host
+from mwsauth.models import MWSUser
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, ServerType
+
+
+class CapacityTests(TestCase):
+
+    def setUp(self):
+        self.server_type = ServerType.objects.get(id=1)
+        Cluster.objects.all().delete()
+        self.cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1a.example", cluster=self.cluster, numcpu=8,
+                            sizeram=8 * self.server_type.sizeram, sizedisk=10 * self.server_type.sizedisk)
+        Host.objects.create(hostname="mws-test-1b.example", cluster=self.cluster, numcpu=8,
+                            sizeram=8 * self.server_type.sizeram, sizedisk=10 * self.server_type.sizedisk)
+        Cluster.objects.create(name="mws-test-2")
+        # 6 sites started in the last 30 days, one of them cancelled, and an older one
+        for n in range(7):
+            NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n,
+                                         type='ipvxpub', name="mws-%d.mws3.example" % n)
+            NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:%d' % n, name='mws-guest%d.example' % n,
+                                         type='ipv6')
+            site = Site.objects.create(name="testSite%d" % n, type=self.server_type,
+                                       start_date=date.today() - timedelta(days=10 if n else 100),
+                                       end_date=date.today() - timedelta(days=5) if n == 1 else None)
+            service = Service.objects.create(type="production", site=site, status="ready",
+                                             network_configuration=NetworkConfig.get_free_prod_service_config())
+            VirtualMachine.objects.create(token=uuid.uuid4(), service=service, cluster=self.cluster,
+                                          network_configuration=NetworkConfig.get_free_host_config())
+
+    def test_capacity_report(self):
+        with self.assertNumQueries(3):
+            report = capacity_report(days=30)
+        cluster = report['clusters'][0]
+        self.assertEqual(cluster['name'], "mws-test-1")
+        self.assertEqual([host['hostname'] for host in cluster['hosts']],
+                         ["mws-test-1a.example", "mws-test-1b.example"])
+        self.assertEqual(cluster['guests'], 7)
+        self.assertEqual(cluster['used']['sizedisk'], 7 * self.server_type.sizedisk)
+        self.assertEqual(cluster['capacity']['sizedisk'], 20 * self.server_type.sizedisk)
+        # Clusters without hosts are not part of the report
+        self.assertEqual(len(report['clusters']), 1)
+        self.assertEqual(report['total']['free']['sizeram'], 9 * self.server_type.sizeram)
+        self.assertEqual(report['total']['free']['sizedisk'], 13 * self.server_type.sizedisk)
+
+        forecast = report['forecast']
+        self.assertAlmostEqual(forecast['sites_per_day'], 6 / 30.0)
+        # Net growth of 5 sites in 30 days
+        self.assertAlmostEqual(forecast['growth_per_day']['sizedisk'], 5 * self.server_type.sizedisk / 30.0)
+        self.assertEqual(forecast['exhaustion']['sizeram'], date.today() + timedelta(days=9 * 30 / 5))
+        self.assertEqual(forecast['exhaustion']['sizedisk'], date.today() + timedelta(days=13 * 30 / 5))
+
+    def test_no_capacity_configured(self):
+        Host.objects.all().delete()
+        report = capacity_report(days=30)
+        self.assertEqual(report['forecast']['exhaustion'], {'numcpu': None, 'sizeram': None, 'sizedisk': None})
+
+    @mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Test User")
+    def test_views(self, mock_return_visibleName_by_crsid):
+        user = User.objects.create(username="amc203")
+        MWSUser.objects.create(user=user, uid=10000)
+        User.objects.filter(id=user.id).update(is_active=True)
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('apimws.views.capacitydata')).status_code, 302)
+
+        User.objects.filter(id=user.id).update(is_superuser=True)
+        response = self.client.get(reverse('apimws.views.capacitydata'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['total']['guests'], 7)
+        response = self.client.get(reverse('capacity'))
+        self.assertContains(response, "mws-test-1b.example")
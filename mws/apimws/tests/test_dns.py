@@ -5,6 +5,7 @@ from django.conf import settings
 from django.core import mail
 from django.core.urlresolvers import reverse
 from django.test import override_settings, TestCase
+from apimws.ipreg import invalidate_cache
 from mwsauth.tests import do_test_login
 from sitesmanagement.cronjobs import reject_or_accepted_old_domain_names_requests
 from sitesmanagement.models import Vhost, DomainName
@@ -15,6 +16,8 @@ from sitesmanagement.tests.tests import assign_a_site
 class DNSTests(TestCase):
     fixtures = [os.path.join(settings.BASE_DIR, 'sitesmanagement/fixtures/amc203_test_IPs.yaml'), ]
     def setUp(self):
+        invalidate_cache()
+        self.addCleanup(invalidate_cache)
         do_test_login(self, user="test0001")
         assign_a_site(self)
 
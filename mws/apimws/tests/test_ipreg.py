@@ -0,0 +1,61 @@
+import subprocess
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws import ipreg
+from apimws.ipreg import fake_backend, get_nameinfo, set_cname, get_cname, DomainNameDelegatedException, \
+    set_sshfp_batch, find_sshfp, delete_sshfp_batch, invalidate_cache
+
+
+@override_settings(IP_REG_API_BACKEND='fake', IP_REG_API_CACHE_TTL=60)
+class IPRegClientTests(TestCase):
+
+    def setUp(self):
+        fake_backend.reset()
+        invalidate_cache()
+        self.addCleanup(invalidate_cache)
+
+    def test_read_calls_are_cached(self):
+        fake_backend.set_nameinfo('test.example.cam.ac.uk', exists=['C'])
+        self.assertEqual(get_nameinfo('test.example.cam.ac.uk')['exists'], ['C'])
+        get_nameinfo('test.example.cam.ac.uk')['exists'].append('V')
+        self.assertEqual(get_nameinfo('test.example.cam.ac.uk')['exists'], ['C'])
+        self.assertEqual(len(fake_backend.calls), 1)
+
+        # The results expire after IP_REG_API_CACHE_TTL seconds
+        with mock.patch("apimws.ipreg.time.time", return_value=ipreg.time.time() + 61):
+            get_nameinfo('test.example.cam.ac.uk')
+        self.assertEqual(len(fake_backend.calls), 2)
+
+        with self.settings(IP_REG_API_CACHE_TTL=0):
+            invalidate_cache()
+            get_nameinfo('test.example.cam.ac.uk')
+            get_nameinfo('test.example.cam.ac.uk')
+        self.assertEqual(len(fake_backend.calls), 4)
+
+    def test_writes_invalidate_the_cache(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            get_cname('test.example.cam.ac.uk')
+        set_cname('test.example.cam.ac.uk', 'mws-1.mws3.example')
+        self.assertEqual(get_cname('test.example.cam.ac.uk')['target'], 'mws-1.mws3.example')
+        set_cname('test.example.cam.ac.uk', 'mws-2.mws3.example')
+        self.assertEqual(get_cname('test.example.cam.ac.uk')['target'], 'mws-2.mws3.example')
+
+        fake_backend.set_nameinfo('delegated.example.cam.ac.uk', delegated='Y')
+        with self.assertRaises(DomainNameDelegatedException):
+            set_cname('delegated.example.cam.ac.uk', 'mws-1.mws3.example')
+
+    def test_batch(self):
+        self.assertEqual(find_sshfp('mws-1.mws3.example'), [])
+        results = set_sshfp_batch([('mws-1.mws3.example', 1, 1, 'aa'), ('mws-1.mws3.example', 1, 2, 'bb'),
+                                   ('mws-2.mws3.example', 1, 1, 'aa')])
+        self.assertEqual([result for record, result in results], [{}, {}, {}])
+        self.assertEqual([record['fingerprint'] for record in find_sshfp('mws-1.mws3.example')], ['aa', 'bb'])
+
+        delete_sshfp_batch([('mws-1.mws3.example', 1, 1)])
+        self.assertEqual([record['fingerprint'] for record in find_sshfp('mws-1.mws3.example')], ['bb'])
+
+        # A failed call does not stop the rest
+        results = ipreg.ip_reg_batch([['get', 'cname', 'unknown.example'], ['put', 'cname', 'a.example', 'b.example']])
+        self.assertIsInstance(results[0], subprocess.CalledProcessError)
+        self.assertEqual(results[1], {})
+        self.assertEqual(fake_backend.cnames, {'a.example': 'b.example'})
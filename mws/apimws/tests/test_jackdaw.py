@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.jackdaw import jackdaw_api, parse_jackdaw_feed, JackdawEmptyFeedException
+from mwsauth.models import MWSUser
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   JACKDAW_SYNC_BATCH_SIZE=2)
+class JackdawSyncTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Test User")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sync(self, *lines):
+        with mock.patch("apimws.jackdaw.subprocess.check_output", return_value="\n".join(lines)):
+            return jackdaw_api()
+
+    def test_parse_jackdaw_feed(self):
+        self.assertEqual(parse_jackdaw_feed("ABC12,Test User,1234\nabc13,Test User,\nabc14,Test User,5"),
+                         {'abc12': 1234, 'abc14': 66005})
+        with self.assertRaises(JackdawEmptyFeedException):
+            parse_jackdaw_feed("abc13,Test User,\n")
+
+    def test_sync(self):
+        report = self.sync("abc12,Test User,1234", "abc13,Test User,1235", "abc14,Test User,5")
+        self.assertEqual((report['add'], report['remove'], report['change'], report['reactivate']), (3, 0, 0, 0))
+        self.assertEqual(dict(MWSUser.objects.values_list('user_id', 'uid')),
+                         {'abc12': 1234, 'abc13': 1235, 'abc14': 66005})
+
+        for username in ['abc12', 'abc13', 'abc14']:
+            User.objects.create(username=username)
+        self.assertEqual(User.objects.filter(is_active=True).count(), 3)
+
+        # abc13 is no longer in Jackdaw, the UID of abc14 has changed and abc15 is new
+        report = self.sync("abc12,Test User,1234", "abc14,Test User,1236", "abc15,Test User,1237")
+        self.assertEqual((report['add'], report['remove'], report['change'], report['reactivate']), (1, 1, 1, 0))
+        self.assertEqual(dict(MWSUser.objects.values_list('user_id', 'uid')),
+                         {'abc12': 1234, 'abc14': 1236, 'abc15': 1237})
+        self.assertFalse(User.objects.get(username='abc13').is_active)
+
+        # abc13 is back in Jackdaw, the user is reactivated
+        report = self.sync("abc12,Test User,1234", "abc13,Test User,1235", "abc14,Test User,1236",
+                           "abc15,Test User,1237")
+        self.assertEqual((report['add'], report['remove'], report['change'], report['reactivate']), (1, 0, 0, 1))
+        self.assertEqual(MWSUser.objects.get(user_id='abc13').uid, 1235)
+        self.assertTrue(User.objects.get(username='abc13').is_active)
+
+        # Nothing changes
+        report = self.sync("abc12,Test User,1234", "abc13,Test User,1235", "abc14,Test User,1236",
+                           "abc15,Test User,1237")
+        self.assertEqual((report['add'], report['remove'], report['change'], report['reactivate']), (0, 0, 0, 0))
+
+    def test_banned_users_not_reactivated(self):
+        MWSUser.objects.create(user_id='abc12', uid=1234)
+        User.objects.create(username='abc12')
+        # Banned by an administrator while still in Jackdaw
+        User.objects.filter(username='abc12').update(is_active=False)
+        report = self.sync("abc12,Test User,1234")
+        self.assertEqual(report['reactivate'], 0)
+        self.assertFalse(User.objects.get(username='abc12').is_active)
+
+    def test_sync_queries(self):
+        MWSUser.objects.bulk_create([MWSUser(user_id='abc%d' % n, uid=2000 + n) for n in range(50)])
+        feed = ["abc%d,Test User,%d" % (n, 3000 + n) for n in range(2, 75)]
+        # The number of queries depends on the batches and the users removed, not on the number of users
+        with override_settings(JACKDAW_SYNC_BATCH_SIZE=500), self.assertNumQueries(12):
+            report = self.sync(*feed)
+        self.assertEqual((report['add'], report['remove'], report['change'], report['reactivate']), (25, 2, 48, 0))
+        self.assertEqual(MWSUser.objects.get(user_id='abc30').uid, 3030)
+
+    def test_empty_feed(self):
+        MWSUser.objects.create(user_id='abc12', uid=1234)
+        with self.assertRaises(JackdawEmptyFeedException):
+            self.sync()
+        self.assertTrue(MWSUser.objects.filter(user_id='abc12').exists())
@@ -0,0 +1,166 @@
+import threading
+import uuid
+from datetime import datetime, timedelta
+import redis
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import mock
+from apimws.locks import acquire_lock, single_instance, RedisLockBackend
+from apimws.models import Cluster, Host, TaskLock
+from apimws.xen import change_vm_power_state, reset_vm
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, ServerType
+
+
+class FakeRedis(object):
+    """Stand-in for the subset of the Redis client used by the locks"""
+    def __init__(self):
+        self.data = {}
+        self.mutex = threading.Lock()
+
+    def set(self, name, value, nx=False, ex=None):
+        with self.mutex:
+            if nx and name in self.data:
+                return None
+            self.data[name] = value
+            return True
+
+    def eval(self, script, numkeys, key, token):
+        assert script == RedisLockBackend.RELEASE_SCRIPT
+        with self.mutex:
+            if self.data.get(key) == token:
+                del self.data[key]
+                return 1
+            return 0
+
+
+class BrokenRedis(object):
+    def set(self, *args, **kwargs):
+        raise redis.ConnectionError("Connection refused")
+
+
+@single_instance(key=lambda value, callback=None: value)
+def locked_function(value, callback=None):
+    if callback:
+        callback()
+    return value
+
+
+@override_settings(MWS_TASK_LOCK_REDIS_URL='redis://localhost:6379/0')
+class RedisLocksTests(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch("apimws.locks.get_redis_client", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_acquire_lock(self):
+        lock = acquire_lock("test")
+        self.assertIsNotNone(lock)
+        self.assertIsNone(acquire_lock("test"))
+        self.assertIsNotNone(acquire_lock("test2"))
+        lock.release()
+        self.assertIsNotNone(acquire_lock("test"))
+        self.assertFalse(TaskLock.objects.exists())
+
+    def test_release_only_own_lock(self):
+        lock = acquire_lock("test")
+        # The lock expired and someone else acquired it
+        self.redis.data["test"] = "other"
+        lock.release()
+        self.assertEqual(self.redis.data["test"], "other")
+
+    def test_single_instance(self):
+        results = []
+        # The same function with the same parameters is not run while it is already running
+        callback = lambda: results.append(locked_function(1))
+        self.assertEqual(locked_function(1, callback), 1)
+        self.assertEqual(results, [False])
+        # but it can be run with other parameters
+        del results[:]
+        callback = lambda: results.append(locked_function(2))
+        self.assertEqual(locked_function(1, callback), 1)
+        self.assertEqual(results, [2])
+        # The lock is released when the function finishes, even if it fails
+        self.assertEqual(self.redis.data, {})
+        with self.assertRaises(ZeroDivisionError):
+            locked_function(1, lambda: 1/0)
+        self.assertEqual(self.redis.data, {})
+
+    def test_fallback_to_database(self):
+        with mock.patch("apimws.locks.get_redis_client", return_value=BrokenRedis()):
+            lock = acquire_lock("test")
+            self.assertIsNotNone(lock)
+            self.assertTrue(TaskLock.objects.filter(key="test").exists())
+            self.assertIsNone(acquire_lock("test"))
+            lock.release()
+            self.assertFalse(TaskLock.objects.exists())
+
+
+@override_settings(MWS_TASK_LOCK_REDIS_URL='', BROKER_URL='django://')
+class DatabaseLocksTests(TestCase):
+
+    def test_acquire_lock(self):
+        lock = acquire_lock("test", timeout=60)
+        self.assertIsNotNone(lock)
+        self.assertIsNone(acquire_lock("test"))
+        lock.release()
+        self.assertIsNotNone(acquire_lock("test"))
+
+    def test_expired_lock(self):
+        lock = acquire_lock("test")
+        TaskLock.objects.filter(key="test").update(expires_at=timezone.now() - timedelta(seconds=1))
+        new_lock = acquire_lock("test")
+        self.assertIsNotNone(new_lock)
+        # The old lock cannot release the new one
+        lock.release()
+        self.assertIsNone(acquire_lock("test"))
+        new_lock.release()
+        self.assertFalse(TaskLock.objects.exists())
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   MWS_TASK_LOCK_REDIS_URL='redis://localhost:6379/0')
+class VMPowerTasksLocksTests(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch("apimws.locks.get_redis_client", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.example", cluster=cluster)
+        NetworkConfig.objects.create(IPv4='198.51.100.1', IPv6='2001:db8:212:8::8c:1', type='ipvxpub',
+                                     name="mws-1.mws3.example")
+        NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:1', name='mws-guest1.example', type='ipv6')
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        service = Service.objects.create(type="production", site=site, status="ready",
+                                         network_configuration=NetworkConfig.get_free_prod_service_config())
+        self.vm = VirtualMachine.objects.create(name="mws-client1", token=uuid.uuid4(), service=service,
+                                                cluster=cluster,
+                                                network_configuration=NetworkConfig.get_free_host_config())
+
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_change_vm_power_state(self, mock_vm_api_request):
+        def power_off_again(*args, **kwargs):
+            if mock_vm_api_request.call_count == 1:
+                self.assertFalse(change_vm_power_state(self.vm.id, "off"))
+                self.assertTrue(change_vm_power_state(self.vm.id, "on"))
+            return "{}"
+
+        mock_vm_api_request.side_effect = power_off_again
+        self.assertTrue(change_vm_power_state.delay(self.vm.id, "off").get())
+        self.assertEqual(mock_vm_api_request.call_count, 2)
+        mock_vm_api_request.assert_any_call(command='button', vm=self.vm,
+                                            parameters={"action": "poweroff", "vmid": "mws-client1"})
+        self.assertEqual(self.redis.data, {})
+
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_reset_vm(self, mock_vm_api_request):
+        self.redis.data["mws-lock:apimws.xen.reset_vm:%d" % self.vm.id] = "running"
+        self.assertFalse(reset_vm(self.vm.id))
+        self.assertFalse(mock_vm_api_request.called)
+        self.redis.data.clear()
+        self.assertTrue(reset_vm(self.vm.id))
+        mock_vm_api_request.assert_called_once_with(command='button', vm=self.vm,
+                                                    parameters={"action": "reboot", "vmid": "mws-client1"})
@@ -0,0 +1,107 @@
+import uuid
+from datetime import datetime
+from StringIO import StringIO
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from apimws.models import Cluster, Host
+from apimws.placement import cluster_loads
+from apimws.xen import which_cluster
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, ServerType
+
+
+class PlacementTests(TestCase):
+
+    def setUp(self):
+        self.server_type = ServerType.objects.get(id=1)
+        Cluster.objects.all().delete()
+        self.clusters = [Cluster.objects.create(name="mws-test-%d" % n) for n in range(2)]
+        # Hosts without capacity configured
+        for cluster in self.clusters:
+            Host.objects.create(hostname="%s.example" % cluster.name, cluster=cluster)
+        for n in range(8):
+            NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:%d' % n, name='mws-guest%d.example' % n,
+                                         type='ipv6')
+        self.site = self.create_site(0)
+
+    def create_site(self, n):
+        NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n, type='ipvxpub',
+                                     name="mws-%d.mws3.example" % n)
+        site = Site.objects.create(name="testSite%d" % n, start_date=datetime.today(), type=self.server_type)
+        Service.objects.create(type="production", site=site, status="ready",
+                               network_configuration=NetworkConfig.get_free_prod_service_config())
+        return site
+
+    def create_vm(self, site, cluster):
+        return VirtualMachine.objects.create(token=uuid.uuid4(), service=site.production_service, cluster=cluster,
+                                             network_configuration=NetworkConfig.get_free_host_config())
+
+    def test_cluster_loads(self):
+        Host.objects.create(hostname="mws-test-0a.example", cluster=self.clusters[0], numcpu=8, sizeram=32,
+                            sizedisk=1000)
+        Host.objects.create(hostname="mws-test-0b.example", cluster=self.clusters[0], numcpu=8, sizeram=32,
+                            sizedisk=1000)
+        self.create_vm(self.site, self.clusters[0])
+        self.create_vm(self.create_site(1), self.clusters[0])
+        with CaptureQueriesContext(connection) as queries:
+            loads = cluster_loads(self.site)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([load.cluster for load in loads], self.clusters)
+        self.assertEqual(loads[0].capacity, {'numcpu': 16, 'sizeram': 64, 'sizedisk': 2000})
+        self.assertEqual(loads[0].used, {'numcpu': 2 * self.server_type.numcpu,
+                                         'sizeram': 2 * self.server_type.sizeram,
+                                         'sizedisk': 2 * self.server_type.sizedisk})
+        self.assertEqual(loads[0].guests, 2)
+        self.assertEqual(loads[0].site_guests, 1)
+        self.assertEqual(loads[1].capacity, {'numcpu': 0, 'sizeram': 0, 'sizedisk': 0})
+        self.assertEqual(loads[1].guests, 0)
+
+    def test_least_used(self):
+        Host.objects.create(hostname="mws-test-0a.example", cluster=self.clusters[0], numcpu=100, sizeram=100,
+                            sizedisk=10000)
+        Host.objects.create(hostname="mws-test-1a.example", cluster=self.clusters[1], numcpu=10, sizeram=10,
+                            sizedisk=1000)
+        self.assertEqual(which_cluster(self.site), self.clusters[0])
+        self.assertEqual(which_cluster(), self.clusters[0])
+        # The cluster with less capacity is chosen once the other one is more used
+        for n in range(1, 4):
+            self.create_vm(self.create_site(n), self.clusters[0])
+        Host.objects.filter(cluster=self.clusters[0]).update(sizeram=3 * self.server_type.sizeram)
+        self.assertEqual(which_cluster(self.site), self.clusters[1])
+
+    def test_full_cluster_avoided(self):
+        Host.objects.create(hostname="mws-test-0a.example", cluster=self.clusters[0],
+                            sizedisk=self.server_type.sizedisk)
+        self.create_vm(self.create_site(1), self.clusters[0])
+        self.assertEqual(which_cluster(self.site), self.clusters[1])
+        # A cluster is still returned when none of them has enough resources
+        Host.objects.create(hostname="mws-test-1a.example", cluster=self.clusters[1],
+                            sizeram=self.server_type.sizeram - 1)
+        self.assertIn(which_cluster(self.site), self.clusters)
+
+    def test_anti_affinity(self):
+        # Both clusters are empty, the production and test VMs of the site end up in different clusters
+        self.create_vm(self.site, which_cluster(self.site))
+        cluster = which_cluster(self.site)
+        self.assertNotEqual(cluster, self.site.production_service.virtual_machines.get().cluster)
+        # Other sites go to the cluster with less guests
+        self.assertEqual(which_cluster(self.create_site(1)), cluster)
+
+    def test_clusters_without_hosts_ignored(self):
+        Host.objects.filter(cluster=self.clusters[1]).delete()
+        self.create_vm(self.site, self.clusters[0])
+        self.assertEqual([load.cluster for load in cluster_loads(self.site)], [self.clusters[0]])
+        # The second VM of the site shares the cluster rather than going to a cluster that cannot run it
+        self.assertEqual(which_cluster(self.site), self.clusters[0])
+        Host.objects.all().delete()
+        self.assertIsNone(which_cluster(self.site))
+
+    def test_simulation_command(self):
+        for n in range(1, 5):
+            self.create_vm(self.create_site(n), self.clusters[0])
+        out = StringIO()
+        call_command('placement_simulation', stdout=out)
+        self.assertIn("mws-test-0\n  current:   4 guests", out.getvalue())
+        self.assertIn("  simulated: 2 guests", out.getvalue())
+        self.assertIn("VMs placed in a different cluster: 2", out.getvalue())
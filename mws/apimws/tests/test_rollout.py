@@ -0,0 +1,92 @@
+import subprocess
+import uuid
+from datetime import datetime
+from StringIO import StringIO
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.models import Cluster, Host, AnsibleRollout, AnsibleRun
+from apimws.rollout import start_rollout, dispatch_services
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, ServerType
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class AnsibleRolloutTests(TestCase):
+
+    def setUp(self):
+        self.clusters = [Cluster.objects.create(name="mws-test-%d" % n) for n in range(2)]
+        Host.objects.create(hostname="mws-test-0a.example", cluster=self.clusters[0])
+        Host.objects.create(hostname="mws-test-0b.example", cluster=self.clusters[0])
+        Host.objects.create(hostname="mws-test-1a.example", cluster=self.clusters[1])
+        for n in range(6):
+            NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n, type='ipvxpub',
+                                         name="mws-%d.mws3.example" % n)
+            NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:%d' % n, name='mws-guest%d.example' % n,
+                                         type='ipv6')
+            site = Site.objects.create(name="testSite%d" % n, start_date=datetime.today(),
+                                       type=ServerType.objects.get(id=1))
+            service = Service.objects.create(type="production", site=site, status="ready",
+                                             network_configuration=NetworkConfig.get_free_prod_service_config())
+            VirtualMachine.objects.create(name="test_vm%d" % n, token=uuid.uuid4(), service=service,
+                                          cluster=self.clusters[n % 2],
+                                          network_configuration=NetworkConfig.get_free_host_config())
+
+    def test_rollout(self):
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            rollout = start_rollout(Service.objects.all(), batch_size=4)
+            self.assertEqual(mock_check_output.call_count, 6)
+        rollout.refresh_from_db()
+        self.assertEqual(rollout.status, 'finished')
+        self.assertEqual(rollout.progress(), {'pending': 0, 'running': 0, 'done': 6, 'failed': 0, 'skipped': 0})
+        self.assertEqual(AnsibleRun.objects.filter(tags='', successful=True).count(), 6)
+
+    def test_dispatch_limits(self):
+        rollout = AnsibleRollout.objects.create(batch_size=10, max_concurrency=3, max_per_host=2)
+        for service in Service.objects.all():
+            rollout.services.create(service=service)
+        with mock.patch("apimws.rollout.launch_ansible") as mock_launch_ansible:
+            self.assertEqual(dispatch_services(rollout), 3)
+            self.assertEqual(mock_launch_ansible.call_count, 3)
+            # No more services can be running at the same time
+            self.assertEqual(dispatch_services(rollout), 0)
+
+            # Clusters can only run max_per_host services per host
+            rollout.services.update(status='pending')
+            rollout.max_concurrency = 10
+            rollout.max_per_host = 1
+            self.assertEqual(dispatch_services(rollout), 3)
+            running = rollout.services.filter(status='running')
+            self.assertEqual(running.filter(service__virtual_machines__cluster=self.clusters[0]).count(), 2)
+            self.assertEqual(running.filter(service__virtual_machines__cluster=self.clusters[1]).count(), 1)
+
+    def test_services_not_ready_skipped(self):
+        Service.objects.filter(site__name="testSite0").update(status='installing')
+        with mock.patch("apimws.ansible.subprocess.check_output"):
+            rollout = start_rollout(Service.objects.all())
+        self.assertEqual(rollout.progress(), {'pending': 0, 'running': 0, 'done': 5, 'failed': 0, 'skipped': 1})
+
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=False)
+    def test_stop_on_errors(self):
+        with mock.patch("apimws.ansible.subprocess.check_output") as mock_check_output:
+            mock_check_output.side_effect = subprocess.CalledProcessError(1, "userv", "error")
+            rollout = start_rollout(Service.objects.all(), batch_size=2, max_failures=1)
+        rollout.refresh_from_db()
+        self.assertEqual(rollout.status, 'stopped')
+        self.assertEqual(rollout.progress(), {'pending': 4, 'running': 0, 'done': 0, 'failed': 2, 'skipped': 0})
+
+    def test_command(self):
+        out = StringIO()
+        call_command('ansible_rollout', 'start', '--dry-run', '--cluster', 'mws-test-1', stdout=out)
+        self.assertIn("3 services", out.getvalue())
+        self.assertFalse(AnsibleRollout.objects.exists())
+
+        out = StringIO()
+        with mock.patch("apimws.ansible.subprocess.check_output"):
+            call_command('ansible_rollout', 'start', '--service-type', 'production', stdout=out)
+        rollout = AnsibleRollout.objects.get()
+        self.assertIn("Ansible rollout %d started" % rollout.id, out.getvalue())
+
+        out = StringIO()
+        call_command('ansible_rollout', 'status', str(rollout.id), stdout=out)
+        self.assertIn("Ansible rollout %d: Finished" % rollout.id, out.getvalue())
+        self.assertIn("6/6 services finished", out.getvalue())
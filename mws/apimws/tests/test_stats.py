@@ -0,0 +1,95 @@
+import json
+from datetime import date
+from time import mktime
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from apimws.models import MonthlyStats, FleetSummary
+from apimws.stats import update_monthly_stats, stats_dates, sites_in_use, update_fleet_summary
+from sitesmanagement.models import Site, ServerType, Service, NetworkConfig, Vhost, DomainName
+
+
+class MonthlyStatsTests(TestCase):
+
+    def setUp(self):
+        server_type = ServerType.objects.get(id=1)
+        today = date.today()
+        Site.objects.create(name="old", type=server_type, start_date=date(2016, 5, 3))
+        Site.objects.create(name="cancelled", type=server_type, start_date=date(2016, 6, 10),
+                            end_date=date(2017, 1, 15))
+        Site.objects.create(name="exmws2", type=server_type, start_date=date(2017, 2, 1), exmws2=date(2016, 9, 2))
+        Site.objects.create(name="recent", type=server_type, start_date=today)
+        Site.objects.create(name="preallocated", type=server_type, start_date=today, preallocated=True)
+
+    def test_update_monthly_stats(self):
+        self.assertEqual(update_monthly_stats(), len(stats_dates()))
+        points = list(MonthlyStats.objects.order_by('date'))
+        self.assertEqual([point.date for point in points[:3]], [date(2016, 3, 31), date(2016, 4, 30),
+                                                                 date(2016, 5, 30)])
+        self.assertEqual(points[0].in_use, 0)
+        self.assertEqual((points[2].in_use, points[2].requests), (1, 1))
+        self.assertEqual((points[6].date, points[6].in_use, points[6].requests), (date(2016, 9, 30), 3, 1))
+        self.assertEqual((points[11].date, points[11].in_use), (date(2017, 2, 28), 2))
+        self.assertEqual(points[-1].in_use, 3)
+
+        # Only the recent points are computed again
+        self.assertLessEqual(update_monthly_stats(), 4)
+        self.assertEqual(update_monthly_stats(full=True), len(stats_dates()))
+
+    def test_views(self):
+        # The series are computed on the first request if the periodic task has not run yet
+        response = self.client.get(reverse('apimws.views.statsdatainuse'))
+        self.assertEqual(response.status_code, 200)
+        values = json.loads(response.content)[0]['values']
+        self.assertEqual(len(values), len(stats_dates()))
+        self.assertEqual(values[6], [mktime(date(2016, 9, 30).timetuple())*1000, sites_in_use(date(2016, 9, 30))])
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('apimws.views.statsdatarequests'))
+        self.assertEqual(sum(value['y'] for value in json.loads(response.content)[0]['values']), 4)
+        self.assertIn('public', response['Cache-Control'])
+
+        response = self.client.get(reverse('apimws.views.statsdatarequests'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(reverse('apimws.views.statsdatarequests'),
+                                   HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        MonthlyStats.objects.filter(date=stats_dates()[-1]).update(in_use=10)
+        update_monthly_stats()
+        response = self.client.get(reverse('apimws.views.statsdatainuse'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+class FleetSummaryTests(TestCase):
+
+    def setUp(self):
+        server_type = ServerType.objects.get(id=1)
+        for n in range(3):
+            netconf = NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n,
+                                                   type='ipvxpub', name="mws-%d.mws3.csx.cam.ac.uk" % n)
+            site = Site.objects.create(name="testSite%d" % n, type=server_type, start_date=date.today(),
+                                       preallocated=(n == 2))
+            service = Service.objects.create(site=site, type='production', status='ready',
+                                             network_configuration=netconf)
+            vhost = Vhost.objects.create(name="default", service=service)
+            vhost.main_domain = DomainName.objects.create(name=netconf.name, vhost=vhost, status='accepted')
+            vhost.save()
+        # A second website of the first server which is live
+        vhost = Vhost.objects.create(name="live", service=Site.objects.get(name="testSite0").production_service)
+        vhost.main_domain = DomainName.objects.create(name="www.example.com", vhost=vhost, status='external')
+        vhost.save()
+
+    def test_fleet_summary(self):
+        summary = update_fleet_summary()
+        self.assertEqual((summary.websites, summary.live_websites, summary.servers, summary.live_servers),
+                         (3, 1, 2, 1))
+        # Only today's snapshot is updated
+        FleetSummary.objects.filter(date=summary.date).update(date=date(2017, 1, 1))
+        update_fleet_summary()
+        self.assertEqual(FleetSummary.objects.count(), 2)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('apimws.views.statsdataactive'))
+        self.assertEqual([value['y'] for value in json.loads(response.content)[0]['values']], [3, 1, 2, 2, 1, 1])
+        response = self.client.get(reverse('apimws.views.statsdatafleet'))
+        self.assertEqual([value['y'] for value in json.loads(response.content)[3]['values']], [1, 1])
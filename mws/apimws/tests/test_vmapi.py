@@ -21,12 +21,10 @@ class XenAPITests(TestCase):
     @staticmethod
     @patch("apimws.xen.launch_ansible")
     @patch("apimws.xen.secrets_prealocation_vm")
-    @patch("apimws.xen.app")
     @patch("apimws.xen.vm_api_request")
-    def test_xen_api(mock_vm_api_request, mock_xen_app, secrets_prealocation_vm, launch_ansible):
+    def test_xen_api(mock_vm_api_request, secrets_prealocation_vm, launch_ansible):
         # We retrieve the VM created by the create Xen API call
         vm = VirtualMachine.objects.first()
-        mock_xen_app.control.inspect.active.values.return_value = []
         mock_vm_api_request.return_value = "{}"
         # We try that the switch off change of state works
         change_vm_power_state(vm.id, "off")
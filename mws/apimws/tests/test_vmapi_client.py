@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import uuid
+from datetime import datetime
+from django.test import TestCase, override_settings
+from apimws.models import Cluster, Host
+from apimws.vmapi import get_connection, close_connections, VMAPIConnectionError
+from apimws.xen import vm_api_request, VMAPIFailure
+from sitesmanagement.models import Site, Service, VirtualMachine, NetworkConfig, ServerType
+
+
+# Stand-in for "vmmanager serve": answers each request with the pid of the process so that tests can tell whether
+# the connection has been reused
+FAKE_SERVER = """
+import json, os, sys
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    if request["command"] == "exit":
+        break
+    if request["command"] == "fail":
+        response = {"id": request["id"], "status": "error", "error": "Failed"}
+    else:
+        response = {"id": request["id"], "status": "ok",
+                    "output": json.dumps({"pid": os.getpid(), "parameters": request["parameters"]})}
+    sys.stdout.write(json.dumps(response) + "\\n")
+    sys.stdout.flush()
+"""
+
+
+@override_settings(VM_END_POINT_COMMAND=[sys.executable, "-c", FAKE_SERVER], VM_API_PERSISTENT_CONNECTIONS=True)
+class VMAPIClientTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(close_connections)
+
+    def test_connection_reused(self):
+        connection = get_connection("mws-test-1.example")
+        self.assertIs(connection, get_connection("mws-test-1.example"))
+        first = json.loads(connection.request("button", {"action": "reboot"}))
+        second = json.loads(connection.request("button", {"action": "poweron"}))
+        self.assertEqual(first["pid"], second["pid"])
+        self.assertEqual(second["parameters"], {"action": "poweron"})
+        self.assertNotEqual(first["pid"], os.getpid())
+
+    def test_reconnect(self):
+        connection = get_connection("mws-test-1.example")
+        first = json.loads(connection.request("button", {}))
+        # The other end closes the connection
+        with self.assertRaises(VMAPIConnectionError):
+            connection.request("exit", {})
+        second = json.loads(connection.request("button", {}))
+        self.assertNotEqual(first["pid"], second["pid"])
+
+    def test_error(self):
+        connection = get_connection("mws-test-1.example")
+        with self.assertRaises(VMAPIConnectionError):
+            connection.request("fail", {})
+        # The connection can still be used after a command has failed
+        json.loads(connection.request("button", {}))
+
+    def test_vm_api_request(self):
+        cluster = Cluster.objects.create(name="mws-test-1")
+        Host.objects.create(hostname="mws-test-1.example", cluster=cluster)
+        NetworkConfig.objects.create(IPv4='198.51.100.1', IPv6='2001:db8:212:8::8c:1', type='ipvxpub',
+                                     name="mws-1.mws3.example")
+        NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:1', name='mws-guest1.example', type='ipv6')
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        service = Service.objects.create(type="production", site=site, status="ready",
+                                         network_configuration=NetworkConfig.get_free_prod_service_config())
+        vm = VirtualMachine.objects.create(name="mws-client1", token=uuid.uuid4(), service=service, cluster=cluster,
+                                           network_configuration=NetworkConfig.get_free_host_config())
+        first = json.loads(vm_api_request(command='button', parameters={"action": "reboot", "vmid": vm.name}, vm=vm))
+        second = json.loads(vm_api_request(command='delete', parameters={"vmid": vm.name}, vm=vm))
+        self.assertEqual(first["pid"], second["pid"])
+        self.assertEqual(first["parameters"], {"action": "reboot", "vmid": vm.name})
+        with self.assertRaises(VMAPIFailure):
+            vm_api_request(command='fail', parameters={}, vm=vm)
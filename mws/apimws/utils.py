@@ -6,6 +6,7 @@ from celery import shared_task, Task
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from apimws.vm import new_site_primary_vm
 from sitesmanagement.models import EmailConfirmation, NetworkConfig, Site, Service, ServerType
 from sitesmanagement.utils import is_camacuk_subdomain
@@ -103,22 +104,28 @@ def preallocate_new_site(servertype=None):
     Create a new :py:class:`~sitesmanagement.models.Site` object with a unique
     uuid4 as name. The new Site has two
     :py:class:`~sitesmanagement.models.Service` instances associated with it,
-    "production" and "test".
+    "production" and "test". The creation of the VM is left to a separate task
+    (:py:func:`apimws.xen.new_site_primary_vm`) so that many sites can be
+    preallocated at the same time.
 
     """
-    if servertype:
-        site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True, type=servertype)
-    else:
-        site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True,
-                                   type=ServerType.objects.get(id=1))
-    prod_service_netconf = NetworkConfig.get_free_prod_service_config()
-    test_service_netconf = NetworkConfig.get_free_test_service_config()
-    host_netconf = NetworkConfig.get_free_host_config()
-    if not prod_service_netconf or not test_service_netconf or not host_netconf:
-        raise Exception('A MWS server cannot be created at this moment because there are no network addresses available')
-    prod_service = Service.objects.create(site=site, type='production', network_configuration=prod_service_netconf)
-    Service.objects.create(site=site, type='test', network_configuration=test_service_netconf)
-    new_site_primary_vm(prod_service, host_netconf)
+    # The addresses reserved are released if any of them is not available
+    with transaction.atomic():
+        if servertype:
+            site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True, type=servertype)
+        else:
+            site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True,
+                                       type=ServerType.objects.get(id=1))
+        prod_service_netconf = NetworkConfig.get_free_prod_service_config()
+        test_service_netconf = NetworkConfig.get_free_test_service_config()
+        host_netconf = NetworkConfig.get_free_host_config()
+        if not prod_service_netconf or not test_service_netconf or not host_netconf:
+            raise Exception('A MWS server cannot be created at this moment because there are no network addresses '
+                            'available')
+        prod_service = Service.objects.create(site=site, type='production',
+                                              network_configuration=prod_service_netconf)
+        Service.objects.create(site=site, type='test', network_configuration=test_service_netconf)
+    new_site_primary_vm.delay(prod_service, host_netconf)
     LOGGER.info("Preallocated MWS server created '" + str(site.name) + "' with id " + str(site.id))
 
 
@@ -1,21 +1,24 @@
-import calendar
 import logging
 import subprocess
-from datetime import date, datetime, timedelta
+from datetime import date
 from time import mktime
 from celery import shared_task
 from django.conf import settings
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.mail import EmailMessage
-from django.db.models import Q
 from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from stronghold.decorators import public
 from apimws.ansible import launch_ansible_async, AnsibleTaskWithFailure, ansible_change_mysql_root_pwd
+from apimws.capacity import capacity_report
 from apimws.ipreg import get_nameinfo
+from apimws.models import FleetSummary
+from apimws.stats import monthly_stats, monthly_stats_version, fleet_summary
 from mwsauth.utils import get_or_create_group_by_groupid, privileges_check
-from sitesmanagement.models import DomainName, EmailConfirmation, VirtualMachine, Billing, Site, Vhost
+from sitesmanagement.models import DomainName, EmailConfirmation, VirtualMachine, Billing, NetworkConfig
 from ucamlookup import user_in_groups
 
 
@@ -190,28 +193,22 @@ def stats(request):
     return render(request, 'stats.html')
 
 
-def add_months(sourcedate, months=1):
-    month = sourcedate.month - 1 + months
-    year = sourcedate.year + month / 12
-    month = month % 12 + 1
-    day = min(sourcedate.day, calendar.monthrange(year, month)[1])
-    return date(year, month, day)
+def _monthly_stats_version(request):
+    # Computed once per request for both the ETag and the Last-Modified headers
+    if not hasattr(request, '_monthly_stats_version'):
+        request._monthly_stats_version = monthly_stats_version()
+    return request._monthly_stats_version
+
+
+monthly_stats_condition = condition(etag_func=lambda request: _monthly_stats_version(request)[1],
+                                    last_modified_func=lambda request: _monthly_stats_version(request)[0])
 
 
 @public
+@cache_control(public=True, max_age=3600)
+@monthly_stats_condition
 def statsdatainuse(request):
-    values = []
-    today = add_months(datetime.today().date())
-    odate = date(2016, 4, 1) - timedelta(days=1)
-    while odate < today:
-        values.append([
-            mktime(odate.timetuple())*1000,
-            Site.objects.filter(Q(start_date__lte=odate), Q(end_date__gt=odate) | Q(end_date__isnull=True),
-                                Q(preallocated=False), Q(exmws2__isnull=True)).count() +
-            Site.objects.filter(Q(exmws2__isnull=False), Q(exmws2__lte=odate),
-                                Q(end_date__gt=odate) | Q(end_date__isnull=True)).count()  # exmws2 sites
-        ])
-        odate = add_months(odate)
+    values = [[mktime(point.date.timetuple())*1000, point.in_use] for point in monthly_stats()]
     data = [{
       "key" : "MWS Servers",
       "values" : values
@@ -220,19 +217,15 @@ def statsdatainuse(request):
 
 
 @public
+@cache_control(public=True, max_age=3600)
 def statsdataactive(request):
-    all = Site.objects.filter(Q(end_date__gt=datetime.today().date()) | Q(end_date__isnull=True), preallocated=False)
-    external_domains = DomainName.objects.exclude(name__endswith="mws3.csx.cam.ac.uk")
-    active = all.filter(services__vhosts__domain_names__in=external_domains).distinct().count()
-    websites = Vhost.objects.filter(service__site__preallocated=False, service__site__end_date__isnull=True).count()
-    live_websites = Vhost.objects.filter(service__site__preallocated=False, service__site__end_date__isnull=True)\
-        .exclude(main_domain__name__endswith="mws3.csx.cam.ac.uk").count()
-    values = [{'x': 'Total Websites', 'y': websites},
-              {'x': 'Live Websites', 'y':live_websites},
-              {'x': 'Test Websites', 'y': websites-live_websites},
-              {'x': 'Total MWS Servers', 'y': all.count()},
-              {'x': 'Live MWS Servers', 'y': active},
-              {'x': 'Test MWS Servers', 'y': all.count()-active}]
+    summary = fleet_summary()
+    values = [{'x': 'Total Websites', 'y': summary.websites},
+              {'x': 'Live Websites', 'y': summary.live_websites},
+              {'x': 'Test Websites', 'y': summary.websites-summary.live_websites},
+              {'x': 'Total MWS Servers', 'y': summary.servers},
+              {'x': 'Live MWS Servers', 'y': summary.live_servers},
+              {'x': 'Test MWS Servers', 'y': summary.servers-summary.live_servers}]
     data = [{
       "key" : "MWS Servers",
       "values" : values
@@ -241,20 +234,45 @@ def statsdataactive(request):
 
 
 @public
+@cache_control(public=True, max_age=3600)
+def statsdatafleet(request):
+    history = FleetSummary.objects.order_by('date')
+    data = [{
+      "key": name,
+      "values": [{'x': mktime(summary.date.timetuple())*1000, 'y': value(summary)} for summary in history]
+    } for name, value in (('Total Websites', lambda summary: summary.websites),
+                          ('Live Websites', lambda summary: summary.live_websites),
+                          ('Total MWS Servers', lambda summary: summary.servers),
+                          ('Live MWS Servers', lambda summary: summary.live_servers))]
+    return JsonResponse(data, safe=False)
+
+
+@public
+@cache_control(public=True, max_age=3600)
+@monthly_stats_condition
 def statsdatarequests(request):
-    values = []
-    today = add_months(datetime.today().date())
-    odate = date(2016, 4, 1) - timedelta(days=1)
-    while odate < today:
-        values.append({
-            'x': mktime(odate.timetuple())*1000,
-            'y': Site.objects.filter(Q(start_date__month=odate.month, start_date__year=odate.year,
-                                     preallocated=False, exmws2__isnull=True) |
-                                     Q(exmws2__month=odate.month, exmws2__year=odate.year)).count(),  # + exmws2 sites
-        })
-        odate = add_months(odate)
+    values = [{'x': mktime(point.date.timetuple())*1000, 'y': point.requests} for point in monthly_stats()]
     data = [{
       "key" : "MWS Servers",
       "values" : values
     }, ]
     return JsonResponse(data, safe=False)
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def capacity(request):
+    return render(request, 'mws/admin/capacity.html', {'report': capacity_report(),
+                                                       'address_pools': sorted(NetworkConfig.pool_summary().items())})
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def capacitydata(request):
+    return JsonResponse(capacity_report())
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def capacityaddresses(request):
+    return JsonResponse(NetworkConfig.pool_summary())
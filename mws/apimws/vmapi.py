@@ -0,0 +1,117 @@
+"""
+The :py:mod:`~apimws.vmapi` module keeps a long-lived connection to the VM API of each host (``vmmanager serve``)
+so that VM API requests do not need a new process and SSH session each. It is used by
+:py:func:`apimws.xen.vm_api_request` when VM_API_PERSISTENT_CONNECTIONS is True.
+
+"""
+
+import json
+import logging
+import select
+import subprocess
+import threading
+import time
+from django.conf import settings
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class VMAPIConnectionError(Exception):
+    pass
+
+
+class VMAPIConnection(object):
+    """Connection to the VM API of a host. Requests are sent one at a time as JSON lines and the connection is
+    reopened when it has been closed by the other end or has been idle for more than VM_API_CONNECTION_IDLE_TIMEOUT
+    seconds."""
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.process = None
+        self.last_used = None
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.process = subprocess.Popen(settings.VM_END_POINT_COMMAND + [self.hostname, "serve"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.last_used = time.time()
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def is_usable(self):
+        return self.process is not None and self.process.poll() is None and \
+            time.time() - self.last_used < getattr(settings, 'VM_API_CONNECTION_IDLE_TIMEOUT', 300)
+
+    def send(self, request):
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+            return True
+        except (IOError, OSError):
+            return False
+
+    def request(self, command, parameters):
+        """Sends a request to the VM API and returns the output of the command
+        :raises VMAPIConnectionError: if the command failed or the VM API could not be reached
+        """
+        with self.lock:
+            request = {"id": self.next_id, "command": command, "parameters": parameters}
+            self.next_id += 1
+            if not self.is_usable():
+                self.close()
+                self.open()
+            if not self.send(request):
+                # The connection was closed by the other end before the request was sent, try with a new one
+                self.close()
+                self.open()
+                if not self.send(request):
+                    self.close()
+                    raise VMAPIConnectionError("The VM API of %s is not reachable" % self.hostname)
+            ready, _, _ = select.select([self.process.stdout], [], [], getattr(settings, 'VM_API_TIMEOUT', 600))
+            line = self.process.stdout.readline() if ready else ''
+            if not line:
+                self.close()
+                raise VMAPIConnectionError("No response from the VM API of %s" % self.hostname)
+            self.last_used = time.time()
+            try:
+                response = json.loads(line)
+            except ValueError:
+                self.close()
+                raise VMAPIConnectionError("Response from the VM API not properly formatted: %s" % line)
+            if response.get("id") != request["id"]:
+                self.close()
+                raise VMAPIConnectionError("Unexpected response from the VM API: %s" % line)
+        if response.get("status") != "ok":
+            raise VMAPIConnectionError(response.get("error", line))
+        return response.get("output")
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(hostname):
+    """Returns the connection to the VM API of the host, shared by all the threads of the process"""
+    with _connections_lock:
+        if hostname not in _connections:
+            _connections[hostname] = VMAPIConnection(hostname)
+        return _connections[hostname]
+
+
+def close_connections():
+    with _connections_lock:
+        for connection in _connections.values():
+            with connection.lock:
+                connection.close()
+        _connections.clear()
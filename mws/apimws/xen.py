@@ -7,13 +7,15 @@ import subprocess
 from celery import shared_task, Task
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
 
 from apimws.ansible import launch_ansible
-from apimws.ipreg import set_sshfp
-from apimws.models import Cluster
+from apimws.ipreg import set_sshfp_batch
+from apimws.locks import single_instance
+from apimws.placement import cluster_loads, choose_cluster
+from apimws.vmapi import get_connection, VMAPIConnectionError
 from apimws.views import post_installation, post_recreate
 from libs.sshpubkey import SSHPubKey
-from mws.celery import app
 from sitesmanagement.models import VirtualMachine, NetworkConfig, SiteKey, Vhost, DomainName
 
 
@@ -33,8 +35,17 @@ class VMAPIFailure(Exception):
 
 
 def vm_api_request(command, parameters, vm):
+    hostname = vm.cluster.hosts.first().hostname
+    if getattr(settings, 'VM_API_PERSISTENT_CONNECTIONS', False):
+        try:
+            response = get_connection(hostname).request(command, parameters)
+            LOGGER.info("VM API request to %s: %s %s\nVM API response: %s", hostname, command, parameters, response)
+        except VMAPIConnectionError as e:
+            LOGGER.error("VM API request to %s: %s %s\nVM API response: %s", hostname, command, parameters, e)
+            raise VMAPIFailure()
+        return response
     api_command = copy.copy(settings.VM_END_POINT_COMMAND)
-    api_command.append(vm.cluster.hosts.first().hostname)
+    api_command.append(hostname)
     api_command.append(command)
     api_command.append("'%s'" % json.dumps(parameters))
     try:
@@ -58,46 +69,93 @@ class XenWithFailure(Task):
                          "The parameters passed to the task were: %s\n\n The traceback is: \n %s", task_id, args, einfo)
 
 
+def mws_pubkey(request):
+    p = subprocess.Popen(["userv", "mws-admin", "mws_pubkey"], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(json.dumps(request))
+    try:
+        return json.loads(stdout)
+    except ValueError as e:
+        LOGGER.error("mws_pubkey response is not properly formated:\nstdout: %s\nstderr: %s" % (stdout, stderr))
+        raise e
+
+
+def get_site_pubkeys(site):
+    """Returns the public keys generated for the site by key type. If MWS_PUBKEY_ALL_KEYTYPES is set all of them are
+    retrieved in a single call to mws_pubkey, otherwise one call is made for each key type"""
+    keytypes = dict(("ssh"+keytype.lower(), keytype) for keytype in SiteKey.ALGORITHMS)
+    if getattr(settings, 'MWS_PUBKEY_ALL_KEYTYPES', False):
+        result = mws_pubkey({"id": "mwssite-%d" % site.id, "keytypes": sorted(keytypes)})
+        return dict((keytypes[keytype], pubkey) for keytype, pubkey in result["pubkeys"].items())
+    return dict((keytype, mws_pubkey({"id": "mwssite-%d" % site.id, "keytype": name})["pubkey"])
+                for name, keytype in keytypes.items())
+
+
+def store_site_keys(service):
+    """Gets the public keys generated for the site and stores them with their fingerprints"""
+    for keytype, public_key in get_site_pubkeys(service.site).items():
+        pubkey = SSHPubKey(public_key)
+        SiteKey.objects.get_or_create(site=service.site, type=keytype, public_key=public_key,
+                                      fingerprint=pubkey.hash_md5(), fingerprint2=pubkey.hash_sha256())
+
+
+def register_sshfp(vm):
+    """Sends the SSHFP records of the keys of the site to ip-register for the hostnames of both services and the
+    VM, all of them in one batch"""
+    service = vm.service
+    hostnames = [service.network_configuration.name, service.site.test_service.network_configuration.name,
+                 vm.network_configuration.name]
+    # The last key stored of each type
+    sitekeys = dict((sitekey.type, sitekey) for sitekey in SiteKey.objects.filter(site=service.site).order_by('id'))
+    records = []
+    for keytype, sitekey in sitekeys.items():
+        if keytype == "ED25519":  # "sshed25519" as of 2016 is not supported by jackdaw
+            continue
+        pubkey = SSHPubKey(sitekey.public_key)
+        for fptype in SiteKey.FP_TYPES:
+            if fptype == "SHA1":
+                fp = pubkey.sshfp_sha1()
+            elif fptype == "SHA256":
+                fp = pubkey.sshfp_sha256()
+            else:
+                LOGGER.error("Error while trying to set up sshfp records. \nkeytype: %s\nfptype: %s do not exists"
+                             % (keytype, fptype))
+                continue
+            records.extend((hostname, SiteKey.ALGORITHMS[keytype], SiteKey.FP_TYPES[fptype], fp)
+                           for hostname in hostnames)
+    if not records:
+        return
+    try:
+        results = set_sshfp_batch(records)
+    except Exception as e:
+        LOGGER.error("Error while trying to set up sshfp records of %s. \nexception: %s"
+                     % (", ".join(hostnames), str(e.__class__)+" "+str(e)))
+        return
+    for (hostname, algorithm, fptype, fp), result in results:
+        if isinstance(result, Exception):
+            LOGGER.error("Error while trying to set up sshfp records. \nhostname: %s\nalgorithm: %s\nfptype: %s"
+                         "\nexception: %s" % (hostname, algorithm, fptype, str(result.__class__)+" "+str(result)))
+
+
 def secrets_prealocation_vm(vm):
     # Gets all the keys generated for the site and generates the fingerprint and the SSHFP from them
     # It sends the SSHFP record to ip-register
-    service = vm.service
+    store_site_keys(vm.service)
+    register_sshfp(vm)
 
-    for keytype in SiteKey.ALGORITHMS:
-        p = subprocess.Popen(["userv", "mws-admin", "mws_pubkey"], stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(json.dumps({"id": "mwssite-%d" % service.site.id,
-                                                   "keytype": "ssh"+keytype.lower()}))
-        try:
-            result = json.loads(stdout)
-        except ValueError as e:
-            LOGGER.error("mws_pubkey response is not properly formated:\nstdout: %s\nstderr: %s" % (stdout, stderr))
-            raise e
 
-        pubkey = SSHPubKey(result["pubkey"])
+@shared_task(base=XenWithFailure)
+def preallocation_site_keys(vm):
+    """Second step of the preallocation of a site, after the VM has been requested: stores the keys of the site"""
+    store_site_keys(vm.service)
+    preallocation_sshfp.delay(vm)
 
-        SiteKey.objects.get_or_create(site=service.site, type=keytype, public_key=result["pubkey"],
-                                      fingerprint=pubkey.hash_md5(), fingerprint2=pubkey.hash_sha256())
 
-        if keytype is not "ED25519":  # "sshed25519" as of 2016 is not supported by jackdaw
-            for fptype in SiteKey.FP_TYPES:
-                try:
-                    if fptype == "SHA1":
-                        fp = pubkey.sshfp_sha1()
-                    elif fptype == "SHA256":
-                        fp = pubkey.sshfp_sha256()
-                    else:
-                        raise Exception("fptype %s do not exists" % fptype)
-                    set_sshfp(service.network_configuration.name, SiteKey.ALGORITHMS[keytype],
-                              SiteKey.FP_TYPES[fptype], fp)
-                    set_sshfp(service.site.test_service.network_configuration.name, SiteKey.ALGORITHMS[keytype],
-                              SiteKey.FP_TYPES[fptype], fp)
-                    set_sshfp(vm.network_configuration.name, SiteKey.ALGORITHMS[keytype], SiteKey.FP_TYPES[fptype],
-                              fp)
-                except Exception as e:
-                    LOGGER.error("Error while trying to set up sshfp records. \nkeytype: %s\nfptype: %s\nexception: %s"
-                                 % (keytype, fptype, str(e.__class__)+" "+str(e)))
-                    pass
+@shared_task(base=XenWithFailure)
+def preallocation_sshfp(vm):
+    """Third step of the preallocation of a site: registers the SSHFP records. The last step, post_installOS, is
+    launched when the VM API calls back once the OS has been installed"""
+    register_sshfp(vm)
 
 
 @shared_task(base=XenWithFailure)
@@ -115,7 +173,8 @@ def new_site_primary_vm(service, host_network_configuration=None):
         if host_network_configuration.name:
             netconf["hostname"] = host_network_configuration.name
         vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
+                                           network_configuration=host_network_configuration,
+                                           cluster=which_cluster(service.site))
     else:
         raise AttributeError("No host network configuration")
 
@@ -164,7 +223,7 @@ def new_site_primary_vm(service, host_network_configuration=None):
                                                status="accepted", vhost=default_vhost)
     default_vhost.main_domain = service_domain
     default_vhost.save()
-    secrets_prealocation_vm(vm)
+    preallocation_site_keys.delay(vm)
 
 
 def recreate_vm(vm_id):
@@ -221,30 +280,21 @@ def recreate_vm(vm_id):
 
 
 @shared_task(base=XenWithFailure)
+@single_instance()
 def change_vm_power_state(vm_id, on):
     if on != 'on' and on != 'off':
         raise VMAPIInputException("passed wrong parameter power %s" % on)
     vm = VirtualMachine.objects.get(pk=vm_id)
-    lock = filter(lambda x: x and x['name'] == u'apimws.xen.change_vm_power_state' and
-                            x['args'] == u"(%s, '%s')" % (vm_id, on),
-                  [item for sublist in app.control.inspect().active().values() for item in sublist])
-    if len(lock) == 1:
-        vm_api_request(command='button', parameters={"action": "power%s" % on, "vmid": vm.name}, vm=vm)
-        return True
-    else:
-        return False
+    vm_api_request(command='button', parameters={"action": "power%s" % on, "vmid": vm.name}, vm=vm)
+    return True
 
 
 @shared_task(base=XenWithFailure)
+@single_instance()
 def reset_vm(vm_id):
-    lock = filter(lambda x: x and x['name'] == u'apimws.xen.reset_vm' and x['args'] == u'(%s,)' % vm_id,
-                  [item for sublist in app.control.inspect().active().values() for item in sublist])
-    if len(lock) == 1:
-        vm = VirtualMachine.objects.get(pk=vm_id)
-        vm_api_request(command='button', vm=vm, parameters={"action": "reboot", "vmid": vm.name})
-        return True
-    else:
-        return False
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    vm_api_request(command='button', vm=vm, parameters={"action": "reboot", "vmid": vm.name})
+    return True
 
 
 @shared_task(base=XenWithFailure)
@@ -257,23 +307,26 @@ def destroy_vm(vm_id):
 @shared_task(base=XenWithFailure)
 def clone_vm_api_call(site):
     service = site.test_service
-    host_network_configuration = NetworkConfig.get_free_host_config()
     parameters = {}
     parameters["site-id"] = "mwssite-%d" % service.site.id
     parameters["os"] = getattr(settings, 'OS_VERSION_VMXENAPI', "jessie")
 
-    if host_network_configuration:
-        netconf = {}
-        if host_network_configuration.IPv4:
-            netconf["IPv4"] = host_network_configuration.IPv4
-        if host_network_configuration.IPv6:
-            netconf["IPv6"] = host_network_configuration.IPv6
-        if host_network_configuration.name:
-            netconf["hostname"] = host_network_configuration.name
-        vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
-    else:
-        raise AttributeError("No host network configuration")
+    # The address allocated is released if the VM cannot be created
+    with transaction.atomic():
+        host_network_configuration = NetworkConfig.get_free_host_config()
+        if host_network_configuration:
+            netconf = {}
+            if host_network_configuration.IPv4:
+                netconf["IPv4"] = host_network_configuration.IPv4
+            if host_network_configuration.IPv6:
+                netconf["IPv6"] = host_network_configuration.IPv6
+            if host_network_configuration.name:
+                netconf["hostname"] = host_network_configuration.name
+            vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
+                                               network_configuration=host_network_configuration,
+                                               cluster=which_cluster(site))
+        else:
+            raise AttributeError("No host network configuration")
 
     parameters["netconf"] = netconf
     parameters["callback"] = {
@@ -320,8 +373,14 @@ def clone_vm_api_call(site):
     return True
 
 
-def which_cluster():
-    """This function decides which cluster to use when creating a new VM based on how busy each cluster is.
-    At present we only have one cluster, so the decision algorithm is pretty obvious. Returns a Cluster object.
+def which_cluster(site=None):
+    """This function decides which cluster to use when creating a new VM for the site based on the resources used
+    in each cluster and where the other VMs of the site are (see apimws.placement). Returns a Cluster object.
     """
-    return Cluster.objects.first()
+    server_type = site.type if site else None
+    load = choose_cluster(cluster_loads(site), server_type)
+    if load is None:
+        return None
+    if not load.fits(server_type):
+        LOGGER.error("None of the clusters has enough free resources for a new VM of %s, using %s", site, load.cluster)
+    return load.cluster
@@ -159,8 +159,12 @@ OS_DUE_UPGRADE = []
 FINANCE_EMAIL = 'fh103@cam.ac.uk'
 
 CELERY_IMPORTS = ('apimws.platforms', 'apimws.xen', 'apimws.utils', 'apimws.jackdaw', 'apimws.ansible',
-                  'sitesmanagement.cronjobs', 'apimws.ipreg')
+                  'sitesmanagement.cronjobs', 'apimws.ipreg', 'mwsauth.utils', 'apimws.rollout')
 IP_REG_API_END_POINT = ['userv', 'mws-admin', 'mws_ipreg']
+# "userv" calls IP_REG_API_END_POINT, "fake" keeps the records in memory (apimws.ipreg.FakeIPRegBackend)
+IP_REG_API_BACKEND = "userv"
+# Seconds the results of the IPREG API read calls (nameinfo, cname, sshfp) are reused for
+IP_REG_API_CACHE_TTL = 60
 
 # Maximum length of time which a domain can remain unapproved.
 MWS_DOMAIN_NAME_GRACE_DAYS = 30
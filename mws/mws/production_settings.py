@@ -70,7 +70,32 @@ CELERYBEAT_SCHEDULE = {
     },
     'check_num_preallocated_sites': {
         'task': 'sitesmanagement.cronjobs.check_num_preallocated_sites',
-        'schedule': crontab(hour=3, minute=25),
+        'schedule': crontab(minute='*/30'),
+        'args': ()
+    },
+    'release_unused_addresses': {
+        'task': 'sitesmanagement.cronjobs.release_unused_addresses',
+        'schedule': crontab(hour=8, minute=35),
+        'args': ()
+    },
+    'check_address_pools': {
+        'task': 'sitesmanagement.cronjobs.check_address_pools',
+        'schedule': crontab(hour=8, minute=40),
+        'args': ()
+    },
+    'update_monthly_stats': {
+        'task': 'sitesmanagement.cronjobs.update_monthly_stats',
+        'schedule': crontab(hour=0, minute=20),
+        'args': ()
+    },
+    'update_fleet_summary': {
+        'task': 'sitesmanagement.cronjobs.update_fleet_summary',
+        'schedule': crontab(minute=35),
+        'args': ()
+    },
+    'prune_bes_changes': {
+        'task': 'sitesmanagement.cronjobs.prune_bes_changes',
+        'schedule': crontab(hour=3, minute=15),
         'args': ()
     },
     'send_warning_last_or_none_admin': {
@@ -82,6 +107,11 @@ CELERYBEAT_SCHEDULE = {
         'task': 'sitesmanagement.cronjobs.reject_or_accepted_old_domain_names_requests',
         'schedule': crontab(hour=7, minute=25),
         'args': ()
+    },
+    'refresh_lookup_groups_membership': {
+        'task': 'mwsauth.utils.refresh_lookup_groups_membership',
+        'schedule': timedelta(minutes=15),
+        'args': ()
     }
 }
 
@@ -91,9 +121,15 @@ MIDDLEWARE_CLASSES += (
 
 VM_END_POINT_COMMAND = ["userv", "mws-admin", "mws_xen_vm_api"]
 VM_API = "xen"
+# Keep a connection open to "vmmanager serve" on each host instead of a new one per request (needs vmmanager >= 0.16)
+VM_API_PERSISTENT_CONNECTIONS = False
 
 EMAIL_TIMEOUT = 60
 
 IP_REG_API_END_POINT = IP_REG_API_END_POINT + ['live']
+# Submit several IPREG API calls (e.g. the SSHFP records of a new site) in one request (needs the batch method)
+IP_REG_API_BATCH = False
+# Retrieve the public keys of all the types of a site in a single mws_pubkey call (needs "keytypes" support)
+MWS_PUBKEY_ALL_KEYTYPES = False
 
 from mws.logging_configuration import *
@@ -74,6 +74,7 @@ INSTALLED_APPS = INSTALLED_APPS+('kombu.transport.django', )
 
 VM_END_POINT_COMMAND = ["vmmanager"]
 VM_API = "xen"
+IP_REG_API_BACKEND = "fake"
 
 CELERY_EAGER_PROPAGATES_EXCEPTIONS=True
 CELERY_ALWAYS_EAGER=True
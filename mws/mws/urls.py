@@ -110,11 +110,15 @@ urlpatterns = [
     # Admin
     url(r'^searchadmin/$', sitesmanagement.views.admin_search, name='searchadmin'),
     url(r'^adminemailist/$', sitesmanagement.views.others.admin_email_list, name='adminemailist'),
+    url(r'^capacity/$', apimws.views.capacity, name='capacity'),
+    url(r'^capacity/data$', apimws.views.capacitydata, name='apimws.views.capacitydata'),
+    url(r'^capacity/addresses$', apimws.views.capacityaddresses, name='apimws.views.capacityaddresses'),
 
     # Stats
     url(r'^stats/$', apimws.views.stats, name='stats'),
     url(r'^stats/datainuse$', apimws.views.statsdatainuse, name='apimws.views.statsdatainuse'),
     url(r'^stats/datarequests$', apimws.views.statsdatarequests, name='apimws.views.statsdatarequests'),
     url(r'^stats/dataactive$', apimws.views.statsdataactive, name='apimws.views.statsdataactive'),
+    url(r'^stats/datafleet$', apimws.views.statsdatafleet, name='apimws.views.statsdatafleet'),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:04
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ucamlookup', '0001_initial'),
+        ('mwsauth', '0004_auto_20150407_1008'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LookupGroupMembership',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='membership', serialize=False, to='ucamlookup.LookupGroup')),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+                ('users', models.ManyToManyField(blank=True, related_name='lookup_groups_membership', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 from django.db import models
+from ucamlookup.models import LookupGroup
 
 
 class MWSUser(models.Model):
@@ -10,6 +11,15 @@ class MWSUser(models.Model):
     user = models.OneToOneField(User, to_field='username', related_name='mws_user', db_constraint=False)
 
 
+class LookupGroupMembership(models.Model):
+    """Copy of the list of members of a lookup group. It is refreshed from lookup when refreshed_at is older
+    than MWS_LOOKUP_GROUP_MEMBERSHIP_TTL seconds or it is None (invalidated), see
+    :py:func:`mwsauth.utils.get_users_of_a_group`"""
+    group = models.OneToOneField(LookupGroup, primary_key=True, related_name='membership')
+    users = models.ManyToManyField(User, related_name='lookup_groups_membership', blank=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+
 @receiver(pre_save, sender=User)
 def add_name_to_user(instance, **kwargs):
     if len(MWSUser.objects.filter(user=instance.username)) == 0:
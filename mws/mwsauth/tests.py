@@ -1,19 +1,22 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 import mock
 from ucamwebauth.tests import create_wls_response
 
+from apimws.ansible import launch_ansible_by_user
 from apimws.models import Cluster, Host
 from apimws.xen import which_cluster
 from mwsauth import views
-from mwsauth.models import MWSUser
-from mwsauth.utils import get_or_create_group_by_groupid
+from mwsauth.models import MWSUser, LookupGroupMembership
+from mwsauth.utils import get_or_create_group_by_groupid, get_users_of_a_group, invalidate_users_of_groups, \
+    refresh_lookup_groups_membership
 from ucamlookup import user_in_groups, get_or_create_user_by_crsid, validate_crsids
 from mwsauth.validators import validate_groupids
 from sitesmanagement.models import Site, Suspension, VirtualMachine, NetworkConfig, Service, Vhost, ServerType
@@ -331,3 +334,145 @@ class AuthTestCases(TestCase):
             User.objects.filter(username="amc203").update(is_active=False)
             response = self.client.get(reverse('listsites'))
             self.assertEqual(response.status_code, 302)  # There user is not active
+
+
+def lookup_person(crsid, name):
+    return mock.Mock(identifier=mock.Mock(value=crsid), visibleName=name)
+
+
+class LookupGroupMembershipTestCases(TestCase):
+
+    def setUp(self):
+        with mock.patch('ucamlookup.signals.return_title_by_groupid', return_value='Test group'):
+            self.group = LookupGroup.objects.create(lookup_id='101888')
+        MWSUser.objects.create(uid=9999, user_id='test0001')
+        self.members = [lookup_person('test0001', 'Test User 1'), lookup_person('test0002', 'Test User 2')]
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_users_created_in_bulk(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        users = get_users_of_a_group(self.group)
+        mock_group_methods.return_value.getMembers.assert_called_once_with(groupid='101888')
+        self.assertEqual([user.username for user in users], ['test0001', 'test0002'])
+        self.assertEqual(User.objects.get(username='test0002').last_name, 'Test User 2')
+        self.assertTrue(User.objects.get(username='test0001').is_active)
+        self.assertFalse(User.objects.get(username='test0002').is_active)  # Has no MWSUser
+        self.assertEqual(set(self.group.membership.users.all()), set(users))
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_membership_cached(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        users = get_users_of_a_group(self.group)
+        self.assertEqual(set(get_users_of_a_group(self.group)), set(users))
+        self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+
+        # The list of members is retrieved again when forced to
+        mock_group_methods.return_value.getMembers.return_value = self.members[:1]
+        self.assertEqual([user.username for user in get_users_of_a_group(self.group, refresh=True)], ['test0001'])
+        self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 2)
+        self.assertEqual([user.username for user in self.group.membership.users.all()], ['test0001'])
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_membership_expired(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        get_users_of_a_group(self.group)
+        LookupGroupMembership.objects.filter(group=self.group).update(
+            refreshed_at=timezone.now() - timedelta(seconds=120))
+        with override_settings(MWS_LOOKUP_GROUP_MEMBERSHIP_TTL=300):
+            get_users_of_a_group(self.group)
+            self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+        with override_settings(MWS_LOOKUP_GROUP_MEMBERSHIP_TTL=60):
+            get_users_of_a_group(self.group)
+            self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 2)
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_membership_invalidated(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        get_users_of_a_group(self.group)
+        invalidate_users_of_groups([self.group])
+        get_users_of_a_group(self.group)
+        self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 2)
+        self.assertEqual(User.objects.filter(username__in=['test0001', 'test0002']).count(), 2)
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_site_list_of_users(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        site = Site.objects.create(name="testsite", institution_id="testinst", start_date=datetime.today(),
+                                   type=ServerType.objects.get(id=1))
+        site.groups.add(self.group)
+        site.ssh_groups.add(self.group)
+        self.assertEqual(set(user.username for user in site.list_of_all_type_of_users()),
+                         {'test0001', 'test0002'})
+        self.assertEqual(site.list_of_ssh_users(), [])  # All of them are already admins
+        self.assertEqual([user.username for user in site.list_of_all_type_of_active_users()], ['test0001'])
+        self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+
+        # The lists are memoised in the instance until its users or groups change
+        with self.assertNumQueries(0):
+            site.list_of_admins()
+            site.list_of_ssh_users()
+            site.list_of_all_type_of_users()
+        site.groups.remove(self.group)
+        # Users and groups of both lists, and the membership of the group cached in the database
+        with self.assertNumQueries(6):
+            self.assertEqual(site.list_of_admins(), [])
+            self.assertEqual(set(user.username for user in site.list_of_ssh_users()), {'test0001', 'test0002'})
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_sites_of_user(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        with mock.patch('ucamlookup.signals.return_visibleName_by_crsid', return_value='Test User 3'):
+            MWSUser.objects.create(uid=9998, user_id='test0003')
+            user3 = User.objects.create_user(username='test0003')
+        site1 = Site.objects.create(name="testsite1", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        site2 = Site.objects.create(name="testsite2", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        site3 = Site.objects.create(name="testsite3", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        site1.ssh_groups.add(self.group)
+        site2.users.add(user3)
+        site3.supporters.add(user3)
+
+        # The members of the group are retrieved from lookup the first time only
+        self.assertFalse(User.objects.filter(username='test0001').exists())
+        self.assertEqual(list(Site.sites_of_user(user3)), [site2])
+        self.assertEqual(list(Site.sites_of_user(User.objects.get(username='test0001'))), [site1])
+        site2.groups.add(self.group)
+        self.assertEqual(set(Site.sites_of_user(User.objects.get(username='test0001'))), {site1, site2})
+        self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+
+        with mock.patch('apimws.ansible.launch_ansible_site') as mock_launch_ansible_site:
+            launch_ansible_by_user(User.objects.get(username='test0001'))
+            self.assertEqual(set(call[0][0] for call in mock_launch_ansible_site.call_args_list), {site1, site2})
+            mock_launch_ansible_site.reset_mock()
+            site1.end_date = datetime.today()
+            site1.save()
+            launch_ansible_by_user(User.objects.get(username='test0001'))
+            mock_launch_ansible_site.assert_called_once_with(site2, 'users')
+            mock_launch_ansible_site.reset_mock()
+            launch_ansible_by_user(User.objects.get(username='test0002'))  # Not active
+            self.assertFalse(mock_launch_ansible_site.called)
+
+    @mock.patch('mwsauth.utils.GroupMethods')
+    def test_refresh_lookup_groups_membership(self, mock_group_methods):
+        mock_group_methods.return_value.getMembers.return_value = self.members
+        site = Site.objects.create(name="testsite", start_date=datetime.today(), type=ServerType.objects.get(id=1))
+        site.groups.add(self.group)
+        with mock.patch('apimws.ansible.launch_ansible_site') as mock_launch_ansible_site:
+            # The members are retrieved for the first time, there is nothing to change in the site
+            refresh_lookup_groups_membership()
+            self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+            self.assertFalse(mock_launch_ansible_site.called)
+
+            # The membership has not expired yet
+            refresh_lookup_groups_membership()
+            self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 1)
+
+            # The membership has expired but the members are the same
+            invalidate_users_of_groups([self.group])
+            refresh_lookup_groups_membership()
+            self.assertEqual(mock_group_methods.return_value.getMembers.call_count, 2)
+            self.assertFalse(mock_launch_ansible_site.called)
+
+            invalidate_users_of_groups([self.group])
+            mock_group_methods.return_value.getMembers.return_value = self.members[1:]
+            refresh_lookup_groups_membership()
+            mock_launch_ansible_site.assert_called_once_with(site, 'users')
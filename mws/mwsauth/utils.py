@@ -1,9 +1,15 @@
 import logging
+from datetime import timedelta
 from celery import shared_task, Task
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
-from ucamlookup import user_in_groups, get_or_create_user_by_crsid, GroupMethods, conn
+from django.utils import timezone
+from ucamlookup import user_in_groups, GroupMethods, conn
 from ucamlookup.models import LookupGroup
+from mwsauth.models import MWSUser, LookupGroupMembership
 
 
 LOGGER = logging.getLogger('mws')
@@ -38,15 +44,74 @@ def privileges_check(site_id, user):
     return site
 
 
+def get_or_create_users_by_crsid(people):
+    """ Bulk version of get_or_create_user_by_crsid. Returns the django users corresponding to the list of
+    people retrieved from lookup, creating those that do not exist yet with a single query.
+    :param people: the list of IbisPerson
+    :return: the list of Users
+    """
+    crsids = [person.identifier.value for person in people]
+    users = {user.username: user for user in User.objects.filter(username__in=crsids)}
+    new_people = [person for person in people if person.identifier.value not in users]
+    if new_people:
+        # Users are created in the same way the pre_save signals of ucamlookup and mwsauth would do
+        mws_users = set(MWSUser.objects.filter(user_id__in=[person.identifier.value for person in new_people])
+                        .values_list('user_id', flat=True))
+        new_users = []
+        for person in new_people:
+            user = User(username=person.identifier.value, last_name=(person.visibleName or '')[:30],
+                        is_active=person.identifier.value in mws_users)
+            user.set_unusable_password()
+            new_users.append(user)
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(new_users)
+        except IntegrityError:
+            pass  # Some of them have been created concurrently, fetch all of them again
+        users.update({user.username: user for user in
+                      User.objects.filter(username__in=[user.username for user in new_users])})
+    return [users[crsid] for crsid in crsids]
+
+
 # TODO move this function to django-ucam-lookup
-def get_users_of_a_group(group):
-    """ Returns the list of users of a LookupGroup
+def get_users_of_a_group(group, refresh=False):
+    """ Returns the list of users of a LookupGroup. The list of members retrieved from lookup is kept in the
+    database (LookupGroupMembership) and reused during MWS_LOOKUP_GROUP_MEMBERSHIP_TTL seconds.
     :param group: The LookupGroup
+    :param refresh: retrieve the list of members from lookup even if the copy in the database is still valid
     :return: the list of Users
     """
+    ttl = timedelta(seconds=getattr(settings, 'MWS_LOOKUP_GROUP_MEMBERSHIP_TTL', 3600))
+    membership = LookupGroupMembership.objects.filter(group=group).first()
+    if not refresh and membership and membership.refreshed_at and membership.refreshed_at > timezone.now() - ttl:
+        return list(membership.users.all())
+
+    users = get_or_create_users_by_crsid(GroupMethods(conn).getMembers(groupid=group.lookup_id))
+    with transaction.atomic():
+        membership, created = LookupGroupMembership.objects.update_or_create(
+            group=group, defaults={'refreshed_at': timezone.now()})
+        membership.users.set(users)
+    return users
+
+
+def refresh_expired_groups(groups):
+    """ Retrieves from lookup the members of the LookupGroups given whose copy in the database is missing, has been
+    invalidated or is older than MWS_LOOKUP_GROUP_MEMBERSHIP_TTL seconds, so that the members of all of them can then
+    be read from the database at once
+    :param groups: The queryset of LookupGroups
+    """
+    ttl = timedelta(seconds=getattr(settings, 'MWS_LOOKUP_GROUP_MEMBERSHIP_TTL', 3600))
+    for group in groups.filter(Q(membership__isnull=True) | Q(membership__refreshed_at__isnull=True) |
+                               Q(membership__refreshed_at__lte=timezone.now() - ttl)).distinct():
+        get_users_of_a_group(group, refresh=True)
+
 
-    return map(lambda user: get_or_create_user_by_crsid(user.identifier.value),
-               GroupMethods(conn).getMembers(groupid=group.lookup_id))
+def invalidate_users_of_groups(groups):
+    """ Forces the list of members of the LookupGroups to be retrieved again from lookup the next time
+    get_users_of_a_group is called
+    :param groups: The list of LookupGroups
+    """
+    LookupGroupMembership.objects.filter(group__in=groups).update(refreshed_at=None)
 
 
 class ScheduledTaskWithFailure(Task):
@@ -64,4 +129,28 @@ def remove_supporter(site_id, crsid):
     user = User.objects.get(username=crsid)
     site.supporters.remove(user)
     from apimws.ansible import launch_ansible_site
-    launch_ansible_site(site)
+    launch_ansible_site(site, 'users')
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def refresh_lookup_groups_membership():
+    """Refreshes from lookup the expired copies of the members of the lookup groups used by active sites, so that
+    Site.sites_of_user stays up to date. Ansible is launched for the sites of the groups whose members have changed,
+    groups whose members had never been retrieved are not considered changed as their sites already have them."""
+    from sitesmanagement.models import Site
+    from apimws.ansible import launch_ansible_site
+    ttl = timedelta(seconds=getattr(settings, 'MWS_LOOKUP_GROUP_MEMBERSHIP_TTL', 3600))
+    groups = LookupGroup.objects.filter(Q(sites__end_date__isnull=True, sites__isnull=False) |
+                                        Q(sites_auth_as_user__end_date__isnull=True, sites_auth_as_user__isnull=False))
+    groups = groups.exclude(membership__refreshed_at__gt=timezone.now() - ttl).distinct()
+    changed_groups = []
+    for group in groups:
+        membership = LookupGroupMembership.objects.filter(group=group).first()
+        old_members = set(membership.users.values_list('id', flat=True)) if membership else None
+        new_members = set(user.id for user in get_users_of_a_group(group, refresh=True))
+        if old_members is not None and new_members != old_members:
+            changed_groups.append(group)
+    if changed_groups:
+        for site in Site.objects.filter(Q(groups__in=changed_groups) | Q(ssh_groups__in=changed_groups),
+                                        end_date__isnull=True).distinct():
+            launch_ansible_site(site, 'users')
@@ -7,7 +7,7 @@ from django.shortcuts import render, redirect
 from ucamlookup import validate_crsids
 from apimws.ansible import launch_ansible_site, launch_ansible_by_user
 from mwsauth.models import MWSUser
-from mwsauth.utils import privileges_check, remove_supporter
+from mwsauth.utils import privileges_check, remove_supporter, invalidate_users_of_groups
 from mwsauth.validators import validate_groupids
 from sitesmanagement.views.sites import warning_messages
 
@@ -45,7 +45,7 @@ def auth_change(request, site_id):
         site.groups.add(*authgrouplist)
         site.ssh_groups.clear()
         site.ssh_groups.add(*sshauthgrouplist)
-        launch_ansible_site(site)  # to add or delete users from the ssh/login auth list of the server
+        launch_ansible_site(site, 'users')  # to add or delete users from the ssh/login auth list of the server
         return redirect(site)
 
     breadcrumbs = {
@@ -69,7 +69,8 @@ def force_update(request, site_id):
         return HttpResponseForbidden()
 
     if request.method == 'POST':
-        launch_ansible_site(site)  # to refresh lookup lists
+        invalidate_users_of_groups(list(site.groups.all()) + list(site.ssh_groups.all()))
+        launch_ansible_site(site, 'users')  # to refresh lookup lists
         # TODO add message to the user
 
     return redirect(site)
@@ -119,7 +120,7 @@ def add_supporter(request, site_id):
 
     if request.method == 'POST':
         site.supporters.add(request.user)
-        launch_ansible_site(site)
+        launch_ansible_site(site, 'users')
         remove_supporter.apply_async(args=(site.id, request.user.username),
                                      countdown=3600)  # Remove supporter after 1 hour
 
@@ -67,6 +67,16 @@ def execute_ansible(modeladmin, request, queryset):
 execute_ansible.short_description = "Launch Ansible"
 
 
+def rollout_ansible(modeladmin, request, queryset):
+    from apimws.rollout import start_rollout
+    rollout = start_rollout(queryset.filter(virtual_machines__isnull=False))
+    modeladmin.message_user(request, "Ansible rollout %d started for %d services" %
+                            (rollout.id, rollout.services.count()))
+
+
+rollout_ansible.short_description = "Launch Ansible in batches (rollout)"
+
+
 class SiteAdmin(ModelAdmin):
     list_display = ('name', 'primary_vm', 'secondary_vm', 'start_date', 'disabled', 'canceled')
     ordering = ('name', 'start_date')
@@ -98,7 +108,7 @@ class ServiceAdmin(VersionAdmin):
     def fqdn(self, obj):
         return str(obj)
 
-    actions = [execute_ansible]
+    actions = [execute_ansible, rollout_ansible]
 
 
 class SiteKeyAdmin(VersionAdmin):
@@ -9,13 +9,16 @@ import json
 import logging
 import subprocess
 from datetime import date, timedelta, datetime
+from multiprocessing.pool import ThreadPool
 from celery import shared_task, Task
 from django.conf import settings
 from django.core.mail import EmailMessage
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Count
 from django.utils import timezone
+from apimws.ansible import launch_ansible
 from apimws.utils import preallocate_new_site
-from sitesmanagement.models import Billing, Site, VirtualMachine, DomainName, ServerType
+from sitesmanagement.models import Billing, Site, VirtualMachine, DomainName, ServerType, Service, NetworkConfig
 
 
 LOGGER = logging.getLogger('mws')
@@ -208,13 +211,93 @@ def check_num_preallocated_sites():
     A :py:class:`~.ScheduledTaskWithFailure` which checks, for each
     :py:class:`~sitesmanagement.models.ServerType` how many pre-allocated
     :py:class:`~sitesmanagement.models.Site` instances there are. If that is
-    smaller than the number which should be pre-allocated, allocate a new one
-    via :py:func:`apimws.utils.preallocate_new_site`.
+    smaller than the number which should be pre-allocated, allocate new ones
+    via :py:func:`apimws.utils.preallocate_new_site` until the deficit is
+    filled, taking turns between server types. At most
+    MWS_PREALLOCATION_CONCURRENCY sites are installed at the same time,
+    including those still being installed from previous runs.
 
     """
-    for servertype in ServerType.objects.all():
-        if Site.objects.filter(preallocated=True, type=servertype).count() < servertype.preallocated:
-            preallocate_new_site(servertype=servertype)
+    preallocated = Site.objects.filter(preallocated=True)
+    installing = Service.objects.filter(site__preallocated=True, type='production').exclude(status='ready').count()
+    slots = getattr(settings, 'MWS_PREALLOCATION_CONCURRENCY', 4) - installing
+    num_preallocated = dict(preallocated.order_by().values_list('type').annotate(num_sites=Count('id')))
+    deficits = [[servertype, servertype.preallocated - num_preallocated.get(servertype.id, 0)]
+                for servertype in ServerType.objects.order_by('order', 'id')]
+    while slots > 0 and any(deficit > 0 for servertype, deficit in deficits):
+        for deficit in deficits:
+            if slots > 0 and deficit[1] > 0:
+                preallocate_new_site(servertype=deficit[0])
+                deficit[1] -= 1
+                slots -= 1
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def check_address_pools():
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which warns when the number of
+    free :py:class:`~sitesmanagement.models.NetworkConfig` addresses of a type
+    used for new sites is below MWS_ADDRESS_POOL_LOW_WATER, before
+    :py:func:`apimws.utils.preallocate_new_site` fails because there are none
+    left.
+
+    """
+    low_water = getattr(settings, 'MWS_ADDRESS_POOL_LOW_WATER', {'ipvxpub': 10, 'ipv4priv': 10, 'ipv6': 10})
+    summary = NetworkConfig.pool_summary()
+    for type, threshold in sorted(low_water.items()):
+        if summary[type]['free'] < threshold:
+            LOGGER.error("Only %d %s addresses are free (%d in total). New address ranges can be loaded with the "
+                         "import_addresses command.", summary[type]['free'], type, summary[type]['total'])
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def release_unused_addresses():
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which frees the
+    :py:class:`~sitesmanagement.models.NetworkConfig` addresses marked as
+    allocated that no Service or VirtualMachine uses, e.g. because the task
+    that allocated them failed before using them. Addresses allocated less
+    than MWS_ADDRESS_RELEASE_GRACE_HOURS ago are left for the tasks queued.
+
+    """
+    released = NetworkConfig.release_unused()
+    if released:
+        LOGGER.warning("%d allocated addresses were not used by any service or VM and have been released", released)
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def update_monthly_stats():
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which refreshes the recent
+    points of the time series of the public stats page (see
+    :py:mod:`apimws.stats`).
+
+    """
+    from apimws import stats
+    stats.update_monthly_stats()
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def update_fleet_summary():
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which refreshes today's summary
+    of the websites and MWS servers shown in the public stats page (see
+    :py:mod:`apimws.stats`).
+
+    """
+    from apimws import stats
+    stats.update_fleet_summary()
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def prune_bes_changes():
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which deletes the old entries of
+    the change log of the BES++ backup feed (see :py:mod:`apimws.bes`).
+
+    """
+    from apimws import bes
+    bes.prune_bes_changes()
 
 
 @shared_task(base=ScheduledTaskWithFailure)
@@ -279,18 +362,70 @@ def send_warning_last_or_none_admin():
             site.save()
 
 
+def _nameinfo(name):
+    from apimws.ipreg import get_nameinfo
+    try:
+        return get_nameinfo(name), None
+    except Exception as e:
+        return None, e
+
+
 @shared_task
 def reject_or_accepted_old_domain_names_requests():
+    """
+    Accepts or rejects the domain names requested more than
+    MWS_DOMAIN_NAME_GRACE_DAYS ago that the administrator of the domain has
+    not answered, depending on whether the name can be changed. The nameinfo of
+    the names is looked up MWS_NAMEINFO_CONCURRENCY at a time, and ansible is
+    launched once for each service with accepted names. Returns the names
+    accepted, rejected and those that failed, either because their nameinfo
+    could not be retrieved or because they could not be accepted or rejected.
+
+    """
     # number of days grace before a domain name request is denied
     grace_days = settings.MWS_DOMAIN_NAME_GRACE_DAYS
 
-    for domain_name in DomainName.objects.filter(status='requested',
-                                                 requested_at__lt=(timezone.now()-timedelta(days=grace_days))):
-        from apimws.ipreg import get_nameinfo
-        nameinfo = get_nameinfo(domain_name.name)
-        if nameinfo['exists'] and "C" not in nameinfo['exists']:
-            domain_name.reject_it(("This domain name request has been automatically denied due to the lack of answer "
-                                   "from the domain name administrator after "
-                                   "%s days.") % (grace_days,))
-        else:
-            domain_name.accept_it()
+    domain_names = list(DomainName.objects.filter(status='requested',
+                                                  requested_at__lt=(timezone.now()-timedelta(days=grace_days)))
+                        .select_related('vhost__service'))
+    summary = {'accepted': [], 'rejected': [], 'failed': []}
+    if not domain_names:
+        return summary
+    pool = ThreadPool(min(getattr(settings, 'MWS_NAMEINFO_CONCURRENCY', 8), len(domain_names)))
+    try:
+        nameinfos = pool.map(_nameinfo, [domain_name.name for domain_name in domain_names])
+    finally:
+        pool.close()
+
+    services = {}
+    for domain_name, (nameinfo, error) in zip(domain_names, nameinfos):
+        if error is not None:
+            LOGGER.error("The nameinfo of the domain name %s could not be retrieved: %s", domain_name.name, error)
+            summary['failed'].append(domain_name.name)
+            continue
+        # A name that cannot be accepted or rejected (e.g. IPREG fails to set its CNAME) does not stop the rest, nor
+        # the ansible runs of the names already accepted. Its changes are rolled back so that it is still requested
+        # and retried the next day
+        try:
+            with transaction.atomic():
+                if nameinfo['exists'] and "C" not in nameinfo['exists']:
+                    domain_name.reject_it(("This domain name request has been automatically denied due to the lack "
+                                           "of answer from the domain name administrator after "
+                                           "%s days.") % (grace_days,))
+                    summary['rejected'].append(domain_name.name)
+                else:
+                    domain_name.accept_it(configure=False)
+                    # accept_it rejects the names of delegated domains
+                    if domain_name.status == 'accepted':
+                        services[domain_name.vhost.service.id] = domain_name.vhost.service
+                        summary['accepted'].append(domain_name.name)
+                    else:
+                        summary['rejected'].append(domain_name.name)
+        except Exception as e:
+            LOGGER.error("The domain name %s could not be accepted or rejected: %s", domain_name.name, e)
+            summary['failed'].append(domain_name.name)
+    for service in services.values():
+        launch_ansible(service, 'domains')
+    LOGGER.info("Domain names requested more than %d days ago: %d accepted, %d rejected, %d failed", grace_days,
+                len(summary['accepted']), len(summary['rejected']), len(summary['failed']))
+    return summary
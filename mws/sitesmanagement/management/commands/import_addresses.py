@@ -0,0 +1,82 @@
+import ipaddress
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from sitesmanagement.models import NetworkConfig
+
+
+class Command(BaseCommand):
+    help = "Loads the addresses of new IPv4 and/or IPv6 ranges as free NetworkConfig of the type given, all of them " \
+           "or none. The hostnames are generated from a template, e.g. 'mws-{n}.mws3.example' where {n} is a " \
+           "sequence number; {ipv4} and {ipv6} can also be used."
+
+    def add_arguments(self, parser):
+        parser.add_argument('type', choices=[type for type, _ in NetworkConfig.NETWORK_CONFIGURATION_TYPES])
+        parser.add_argument('name', help="Template of the hostnames")
+        parser.add_argument('--ipv4', help="IPv4 range (CIDR), the network and broadcast addresses are skipped")
+        parser.add_argument('--ipv4-gateway', help="IPv4 gateway, it is also skipped from the range")
+        parser.add_argument('--ipv6', help="IPv6 range (CIDR)")
+        parser.add_argument('--start', type=int, default=1, help="First sequence number (default: 1)")
+        parser.add_argument('--count', type=int, help="Maximum number of addresses to load")
+        parser.add_argument('--dry-run', action='store_true', help="Show what would be loaded without loading it")
+
+    def hosts(self, cidr, skip=()):
+        try:
+            network = ipaddress.ip_network(unicode(cidr))
+        except ValueError as e:
+            raise CommandError(str(e))
+        return network, (host for host in network.hosts() if host not in skip)
+
+    def handle(self, *args, **options):
+        type = options['type']
+        needs_ipv4 = type != 'ipv6'
+        needs_ipv6 = type in ('ipvxpub', 'ipvxpriv', 'ipv6')
+        if needs_ipv4 != bool(options['ipv4']) or needs_ipv6 != bool(options['ipv6']):
+            raise CommandError("Addresses of type %s need %s" % (type, " and ".join(
+                version for version, needed in (('--ipv4', needs_ipv4), ('--ipv6', needs_ipv6)) if needed)))
+
+        ranges = []
+        netmask = gateway = None
+        if needs_ipv4:
+            gateway = ipaddress.ip_address(unicode(options['ipv4_gateway'])) if options['ipv4_gateway'] else None
+            network, hosts = self.hosts(options['ipv4'], skip=[gateway])
+            netmask = str(network.netmask)
+            ranges.append(hosts)
+        if needs_ipv6:
+            network, hosts = self.hosts(options['ipv6'])
+            if not options['count'] and network.num_addresses > 2 ** 16:
+                raise CommandError("--count is needed for IPv6 ranges larger than a /112")
+            ranges.append(hosts)
+
+        addresses = []
+        for n, hosts in enumerate(islice(zip(*ranges) if len(ranges) > 1 else ((host, ) for host in ranges[0]),
+                                         options['count']), options['start']):
+            ipv4 = str(hosts[0]) if needs_ipv4 else None
+            ipv6 = str(hosts[-1]) if needs_ipv6 else None
+            try:
+                name = options['name'].format(n=n, ipv4=ipv4, ipv6=ipv6)
+            except (KeyError, IndexError) as e:
+                raise CommandError("Unknown field in the name template: %s" % e)
+            addresses.append(NetworkConfig(type=type, name=name, IPv4=ipv4, IPv6=ipv6, IPv4_netmask=netmask,
+                                           IPv4_gateway=str(gateway) if gateway else None))
+        if not addresses:
+            raise CommandError("There are no addresses to load")
+        if len(set(address.name for address in addresses)) < len(addresses):
+            raise CommandError("The name template needs to generate a different name for each address")
+
+        existing = NetworkConfig.objects.filter(Q(name__in=[address.name for address in addresses]) |
+                                                Q(IPv4__in=[address.IPv4 for address in addresses if address.IPv4]) |
+                                                Q(IPv6__in=[address.IPv6 for address in addresses if address.IPv6]))
+        if existing.exists():
+            raise CommandError("Some of the addresses already exist, nothing has been loaded: %s" %
+                               ", ".join(existing.order_by('name').values_list('name', flat=True)[:10]))
+
+        if options['dry_run']:
+            for address in addresses:
+                self.stdout.write("%s %s %s" % (address.name, address.IPv4 or "-", address.IPv6 or "-"))
+            self.stdout.write("%d %s addresses would be loaded" % (len(addresses), type))
+            return
+        with transaction.atomic():
+            NetworkConfig.objects.bulk_create(addresses, batch_size=500)
+        self.stdout.write("%d %s addresses loaded" % (len(addresses), type))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def mark_allocated(apps, schema_editor):
+    NetworkConfig = apps.get_model("sitesmanagement", "NetworkConfig")
+    NetworkConfig.objects.filter(Q(service__isnull=False) | Q(vm__isnull=False)).update(allocated=True)
+
+
+def no_op(apps, schema_editor):
+    """
+    Nothing to do
+    """
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0078_auto_20171129_1334'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkconfig',
+            name='allocated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='networkconfig',
+            index_together=set([('type', 'allocated')]),
+        ),
+        migrations.RunPython(mark_allocated, no_op),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0079_networkconfig_allocated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkconfig',
+            name='allocated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
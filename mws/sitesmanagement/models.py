@@ -10,7 +10,7 @@ from django.core.validators import validate_slug
 from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
-from django.db import transaction
+from django.db import transaction, connection
 from django.utils import timezone
 from django.utils.timezone import now
 from os.path import splitext
@@ -35,18 +35,92 @@ class NetworkConfig(models.Model):
     IPv6 = models.GenericIPAddressField(protocol='IPv6', unique=True, null=True, blank=True)
     name = models.CharField(max_length=250, unique=True)
     type = models.CharField(max_length=50, choices=NETWORK_CONFIGURATION_TYPES)
+    # Whether the address is used by a Service or a VirtualMachine, or has been reserved for one. Kept up to date by
+    # sitesmanagement.signals so that free addresses can be found without looking at the services and VMs
+    allocated = models.BooleanField(default=False)
+    # When the address was last reserved by allocate, so that the addresses reserved for tasks still queued (e.g.
+    # new_site_primary_vm) are not released before the task uses them
+    allocated_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('type', 'allocated')]
+
+    @classmethod
+    def allocate(cls, type, number=1):
+        """Reserves up to number free addresses of the type given and returns them. Addresses being reserved at the
+        same time by someone else are skipped instead of waited for. If called inside a transaction, the addresses
+        are released if it is rolled back."""
+        allocated = []
+        with transaction.atomic():
+            while len(allocated) < number:
+                free = cls.objects.filter(type=type, allocated=False).exclude(id__in=[n.id for n in allocated])
+                if connection.features.has_select_for_update_skip_locked:
+                    free = free.select_for_update(skip_locked=True)
+                candidates = list(free.order_by('id')[:number - len(allocated)])
+                if not candidates:
+                    break
+                for candidate in candidates:
+                    # Databases without skip_locked may have given the same address to someone else
+                    allocated_at = timezone.now()
+                    if cls.objects.filter(id=candidate.id, allocated=False).update(allocated=True,
+                                                                                   allocated_at=allocated_at):
+                        candidate.allocated = True
+                        candidate.allocated_at = allocated_at
+                        allocated.append(candidate)
+        return allocated
+
+    @classmethod
+    def allocate_one(cls, type):
+        allocated = cls.allocate(type)
+        return allocated[0] if allocated else None
 
     @classmethod
     def get_free_prod_service_config(cls):
-        return cls.objects.filter(service=None, type='ipvxpub').first()
+        return cls.allocate_one('ipvxpub')
 
     @classmethod
     def get_free_test_service_config(cls):
-        return cls.objects.filter(service=None, type='ipv4priv').first()
+        return cls.allocate_one('ipv4priv')
 
     @classmethod
     def get_free_host_config(cls):
-        return cls.objects.filter(vm=None, type='ipv6').first()
+        return cls.allocate_one('ipv6')
+
+    @classmethod
+    def pool_summary(cls):
+        """Returns the number of addresses of each type and how many of them are allocated and free, computed in a
+        single query"""
+        summary = dict((type, {'total': 0, 'allocated': 0, 'free': 0}) for type, _ in cls.NETWORK_CONFIGURATION_TYPES)
+        for pool in cls.objects.order_by().values('type').annotate(
+                total=models.Count('id'), num_allocated=models.Sum(models.Case(
+                    models.When(allocated=True, then=1), default=0, output_field=models.IntegerField()))):
+            summary[pool['type']] = {'total': pool['total'], 'allocated': pool['num_allocated'],
+                                     'free': pool['total'] - pool['num_allocated']}
+        return summary
+
+    @classmethod
+    def update_allocated(cls, ids):
+        """Marks the addresses given as allocated or free depending on whether they are used by a Service or a
+        VirtualMachine"""
+        ids = set(ids) - {None}
+        if not ids:
+            return
+        used = set(Service.objects.filter(network_configuration_id__in=ids)
+                   .values_list('network_configuration_id', flat=True)) | \
+            set(VirtualMachine.objects.filter(network_configuration_id__in=ids)
+                .values_list('network_configuration_id', flat=True))
+        cls.objects.filter(id__in=used, allocated=False).update(allocated=True)
+        cls.objects.filter(id__in=ids - used, allocated=True).update(allocated=False)
+
+    @classmethod
+    def release_unused(cls):
+        """Frees the addresses marked as allocated that are not used by any Service or VirtualMachine, e.g. because
+        the task that allocated them failed before using them. Addresses reserved less than
+        MWS_ADDRESS_RELEASE_GRACE_HOURS ago are kept, as the task that will use them may still be queued. Returns the
+        number of addresses freed"""
+        grace = timedelta(hours=getattr(settings, 'MWS_ADDRESS_RELEASE_GRACE_HOURS', 24))
+        return cls.objects.filter(models.Q(allocated_at__isnull=True) | models.Q(allocated_at__lt=timezone.now()-grace),
+                                  allocated=True, service__isnull=True, vm__isnull=True).update(allocated=False)
 
     def __unicode__(self):
         return self.name
@@ -307,23 +381,27 @@ class Site(models.Model):
             return False
         return True
 
+    def _users_with_access(self, users, groups):
+        """Returns the set of users of the site assigned directly (users field) or through a lookup group (groups
+        field). It is memoised in the instance, which only lives during a request or a task, until the site is saved
+        or its users or groups change (see clear_users_cache)"""
+        cache = self.__dict__.setdefault('_users_cache', {})
+        if users not in cache:
+            cache[users] = set(chain(getattr(self, users).all(),
+                                     chain.from_iterable(map(get_users_of_a_group, getattr(self, groups).all()))))
+        return cache[users]
+
+    def clear_users_cache(self):
+        self.__dict__.pop('_users_cache', None)
+
     def list_of_admins(self):
-        list_of_admins_in_lookup_groups = list(chain.from_iterable(map(get_users_of_a_group, self.groups.all())))
-        list_of_admins_directly_assigned = list(self.users.all())
-        return list(set(list_of_admins_in_lookup_groups + list_of_admins_directly_assigned))
+        return list(self._users_with_access('users', 'groups'))
 
     def list_of_ssh_users(self):
-        list_of_ssh_users_in_lookup_groups = list(chain.from_iterable(map(get_users_of_a_group, self.ssh_groups.all())))
-        list_of_ssh_users_directly_assigned = list(self.ssh_users.all())
-        final_list_of_ssh_users = list(set(list_of_ssh_users_in_lookup_groups + list_of_ssh_users_directly_assigned))
-        return [item for item in final_list_of_ssh_users if item not in self.list_of_admins()]
+        return list(self._users_with_access('ssh_users', 'ssh_groups') - self._users_with_access('users', 'groups'))
 
     def list_of_all_type_of_users(self):
-        list_of_ssh_users_in_lookup_groups = list(chain.from_iterable(map(get_users_of_a_group, self.ssh_groups.all())))
-        list_of_ssh_users_directly_assigned = list(self.ssh_users.all())
-        final_list_of_ssh_users = list_of_ssh_users_in_lookup_groups + list_of_ssh_users_directly_assigned
-        final_list_of_all_type_of_users = final_list_of_ssh_users + self.list_of_admins()
-        return list(set(final_list_of_all_type_of_users))
+        return list(self._users_with_access('ssh_users', 'ssh_groups') | self._users_with_access('users', 'groups'))
 
     def list_of_active_admins(self):
         return filter(lambda user: user.is_active, self.list_of_admins())
@@ -334,6 +412,20 @@ class Site(models.Model):
     def list_of_all_type_of_active_users(self):
         return filter(lambda user: user.is_active, self.list_of_all_type_of_users())
 
+    @classmethod
+    def sites_of_user(cls, user):
+        """Returns the sites where the user is an admin or an ssh user, either directly or through a lookup group.
+        This is the reverse of list_of_all_type_of_users but, instead of asking lookup for the members of the groups
+        of every site, it uses the copy of the membership kept in the database (see get_users_of_a_group) so it
+        only needs one query. Groups whose members have never been retrieved are retrieved first."""
+        groups = LookupGroup.objects.filter(models.Q(sites__isnull=False) | models.Q(sites_auth_as_user__isnull=False),
+                                            membership__isnull=True)
+        for group in groups.distinct():
+            get_users_of_a_group(group)
+        return cls.objects.filter(models.Q(users=user) | models.Q(ssh_users=user) |
+                                  models.Q(groups__membership__users=user) |
+                                  models.Q(ssh_groups__membership__users=user)).distinct()
+
 
 class EmailConfirmation(models.Model):
     STATUS_CHOICES = (
@@ -628,7 +720,9 @@ class DomainName(models.Model):
     token = models.CharField(max_length=50, default=uuid.uuid4)
     authorised_by = models.ForeignKey(User, related_name='domain_names_authorised', blank=True, null=True)
 
-    def accept_it(self):
+    def accept_it(self, configure=True):
+        """Accepts the domain name and sets its CNAME. If configure is False the caller is responsible for launching
+        ansible in the service of the vhost (e.g. once for several domain names accepted at the same time)"""
         self.status = 'accepted'
         self.save()
         if self.vhost.main_domain is None or \
@@ -640,8 +734,9 @@ class DomainName(models.Model):
             set_cname(self.name, self.vhost.service.network_configuration.name)
         except DomainNameDelegatedException:
             return self.reject_it("Domain delegated")
-        from apimws.ansible import launch_ansible
-        launch_ansible(self.vhost.service)
+        if configure:
+            from apimws.ansible import launch_ansible
+            launch_ansible(self.vhost.service, 'domains')
         now = datetime.now()
         # Check if the set_cname was executed before the DNS refresh of the current hour.
         # DNS refreshes happen at 53 minutes of each hour
@@ -1,8 +1,8 @@
 import logging
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
-from apimws.ipreg import delete_sshfp, delete_cname
-from sitesmanagement.models import DomainName, SiteKey, Site, VirtualMachine
+from apimws.ipreg import delete_sshfp_batch, delete_cname
+from sitesmanagement.models import DomainName, SiteKey, Site, VirtualMachine, Service, NetworkConfig
 
 LOGGER = logging.getLogger('mws')
 
@@ -15,18 +15,33 @@ def check_main_domain_name(instance, **kwargs):
         vhost.save()
 
 
+@receiver(post_save, sender=Site)
+def clear_site_users_cache(instance, **kwargs):
+    instance.clear_users_cache()
+
+
+@receiver(m2m_changed, sender=Site.users.through)
+@receiver(m2m_changed, sender=Site.ssh_users.through)
+@receiver(m2m_changed, sender=Site.groups.through)
+@receiver(m2m_changed, sender=Site.ssh_groups.through)
+def clear_site_members_cache(instance, action, reverse, **kwargs):
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        instance.clear_users_cache()
+
+
 @receiver(pre_delete, sender=SiteKey)
 def delete_sshfp_from_dns(instance, **kwargs):
     '''Delete SSHFP records from the DNS using the DNS API when a SiteKey is deleted from the database'''
     if instance.type != "ED25519":
+        hostnames = []
         for service in instance.site.services.all():
-            for fptype in SiteKey.FP_TYPES:
-                delete_sshfp(service.network_configuration.name, SiteKey.ALGORITHMS[instance.type],
-                             SiteKey.FP_TYPES[fptype])
-            for vm in service.virtual_machines.all():
-                for fptype in SiteKey.FP_TYPES:
-                    delete_sshfp(vm.network_configuration.name, SiteKey.ALGORITHMS[instance.type],
-                                 SiteKey.FP_TYPES[fptype])
+            hostnames.append(service.network_configuration.name)
+            hostnames.extend(vm.network_configuration.name for vm in service.virtual_machines.all())
+        records = [(hostname, SiteKey.ALGORITHMS[instance.type], SiteKey.FP_TYPES[fptype])
+                   for hostname in hostnames for fptype in SiteKey.FP_TYPES]
+        for record, result in delete_sshfp_batch(records):
+            if isinstance(result, Exception):
+                raise result
 
 
 @receiver(pre_delete, sender=DomainName)
@@ -45,3 +60,28 @@ def log_deleted_site(sender, instance, **kwargs):
 @receiver(pre_delete, sender=VirtualMachine)
 def log_deleted_site(sender, instance, **kwargs):
     LOGGER.info("Class %s deleted the Virtual Machine %s" % (str(sender), instance.name))
+
+
+@receiver(post_init, sender=Service)
+@receiver(post_init, sender=VirtualMachine)
+def remember_network_configuration(instance, **kwargs):
+    # Read from __dict__ so that querysets that defer the field do not need an extra query per instance
+    instance._loaded_network_configuration_id = instance.__dict__.get('network_configuration_id')
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_save, sender=VirtualMachine)
+def update_network_configuration_allocated(instance, created, update_fields=None, **kwargs):
+    """Keeps NetworkConfig.allocated up to date when a Service or a VirtualMachine starts or stops using an
+    address"""
+    if update_fields is not None and 'network_configuration' not in update_fields:
+        return
+    if created or instance.network_configuration_id != instance._loaded_network_configuration_id:
+        NetworkConfig.update_allocated([instance.network_configuration_id, instance._loaded_network_configuration_id])
+        instance._loaded_network_configuration_id = instance.network_configuration_id
+
+
+@receiver(post_delete, sender=Service)
+@receiver(post_delete, sender=VirtualMachine)
+def release_network_configuration(instance, **kwargs):
+    NetworkConfig.update_allocated([instance.network_configuration_id])
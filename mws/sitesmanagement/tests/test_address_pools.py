@@ -0,0 +1,84 @@
+import json
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.management import call_command, CommandError
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from mock import mock
+from mwsauth.models import MWSUser
+from sitesmanagement.cronjobs import check_address_pools, release_unused_addresses
+from sitesmanagement.models import NetworkConfig, Service
+
+
+class AddressPoolTests(TestCase):
+
+    def setUp(self):
+        call_command('import_addresses', 'ipvxpub', 'mws-{n}.mws3.example', ipv4='198.51.100.0/29',
+                     ipv6='2001:db8:212:8::8c:0/125', stdout=StringIO())
+        NetworkConfig.allocate('ipvxpub', 2)
+
+    def test_import_addresses(self):
+        addresses = NetworkConfig.objects.order_by('id')
+        # Network and broadcast addresses are skipped and both ranges are paired up
+        self.assertEqual(addresses.count(), 6)
+        self.assertEqual((addresses[0].name, addresses[0].IPv4, addresses[0].IPv6, addresses[0].IPv4_netmask),
+                         ("mws-1.mws3.example", "198.51.100.1", "2001:db8:212:8::8c:1", "255.255.255.248"))
+        self.assertEqual(addresses.last().name, "mws-6.mws3.example")
+
+        call_command('import_addresses', 'ipv6', 'mws-guest{n}.example', ipv6='2001:db8:212:8::8d:0/120', count=4,
+                     stdout=StringIO())
+        self.assertEqual(NetworkConfig.objects.filter(type='ipv6').count(), 4)
+
+        # Nothing is loaded if any of the addresses exists
+        with self.assertRaises(CommandError):
+            call_command('import_addresses', 'ipv4priv', 'mws-{n}.mws3.example', ipv4='172.28.18.0/24',
+                         start=6, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('import_addresses', 'ipvxpub', 'mws-{n}.mws3.example', ipv4='198.51.100.0/29',
+                         stdout=StringIO())
+        out = StringIO()
+        call_command('import_addresses', 'ipv4priv', 'mws-{n}.mws3.private.example', ipv4='172.28.18.0/24',
+                     ipv4_gateway='172.28.18.1', count=10, dry_run=True, stdout=out)
+        self.assertIn("mws-1.mws3.private.example 172.28.18.2 -", out.getvalue())
+        self.assertFalse(NetworkConfig.objects.filter(type='ipv4priv').exists())
+
+    def test_pool_summary(self):
+        with self.assertNumQueries(1):
+            summary = NetworkConfig.pool_summary()
+        self.assertEqual(summary['ipvxpub'], {'total': 6, 'allocated': 2, 'free': 4})
+        self.assertEqual(summary['ipv6'], {'total': 0, 'allocated': 0, 'free': 0})
+
+    @override_settings(MWS_ADDRESS_POOL_LOW_WATER={'ipvxpub': 4, 'ipv6': 1})
+    @mock.patch("sitesmanagement.cronjobs.LOGGER")
+    def test_check_address_pools(self, mock_logger):
+        check_address_pools()
+        self.assertEqual(mock_logger.error.call_count, 1)
+        self.assertEqual(mock_logger.error.call_args[0][2], 'ipv6')
+
+        NetworkConfig.allocate('ipvxpub')
+        mock_logger.reset_mock()
+        check_address_pools()
+        self.assertEqual(mock_logger.error.call_count, 2)
+
+    def test_release_unused_addresses(self):
+        # The addresses allocated in setUp are not used by any service or VM, those allocated recently are kept
+        NetworkConfig.objects.update(allocated_at=timezone.now() - timedelta(hours=25))
+        recent = NetworkConfig.allocate_one('ipvxpub')
+        service = Service.objects.create(type='production', network_configuration=NetworkConfig.allocate_one('ipvxpub'))
+        NetworkConfig.objects.filter(id=service.network_configuration.id).update(
+            allocated_at=timezone.now() - timedelta(hours=25))
+        release_unused_addresses()
+        self.assertEqual(set(NetworkConfig.objects.filter(allocated=True)), {recent, service.network_configuration})
+
+    @mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Test User")
+    def test_view(self, mock_return_visibleName_by_crsid):
+        user = User.objects.create(username="amc203")
+        MWSUser.objects.create(user=user, uid=10000)
+        User.objects.filter(id=user.id).update(is_active=True, is_superuser=True)
+        self.client.force_login(user)
+        response = self.client.get(reverse('apimws.views.capacityaddresses'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['ipvxpub']['free'], 4)
+        self.assertContains(self.client.get(reverse('capacity')), "ipvxpub")
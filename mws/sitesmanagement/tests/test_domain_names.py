@@ -0,0 +1,88 @@
+import subprocess
+from datetime import date, timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import mock
+from apimws.ipreg import fake_backend, invalidate_cache
+from sitesmanagement.cronjobs import reject_or_accepted_old_domain_names_requests
+from sitesmanagement.models import Site, Service, NetworkConfig, ServerType, Vhost, DomainName
+
+
+@override_settings(IP_REG_API_BACKEND='fake', MWS_NAMEINFO_CONCURRENCY=3)
+class OldDomainNamesRequestsTests(TestCase):
+
+    def setUp(self):
+        fake_backend.reset()
+        invalidate_cache()
+        self.addCleanup(invalidate_cache)
+        self.vhosts = []
+        for n in range(2):
+            netconf = NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n,
+                                                   type='ipvxpub', name="mws-%d.mws3.example" % n)
+            site = Site.objects.create(name="testSite%d" % n, start_date=date.today(),
+                                       type=ServerType.objects.get(id=1))
+            service = Service.objects.create(site=site, type='production', status='ready',
+                                             network_configuration=netconf)
+            self.vhosts.append(Vhost.objects.create(name="default", service=service))
+
+    def request(self, name, vhost, days=31):
+        domain_name = DomainName.objects.create(name=name, vhost=vhost)
+        DomainName.objects.filter(id=domain_name.id).update(requested_at=timezone.now() - timedelta(days=days))
+        return domain_name
+
+    @mock.patch("sitesmanagement.cronjobs.launch_ansible")
+    def test_reject_or_accepted_old_domain_names_requests(self, mock_launch_ansible):
+        for n in range(3):
+            self.request("test%d.example.cam.ac.uk" % n, self.vhosts[0])
+        self.request("other.example.cam.ac.uk", self.vhosts[1])
+        self.request("recent.example.cam.ac.uk", self.vhosts[1], days=5)
+        self.request("unchangeable.example.cam.ac.uk", self.vhosts[1])
+        fake_backend.set_nameinfo("unchangeable.example.cam.ac.uk", exists=['V'])
+        self.request("delegated.example.cam.ac.uk", self.vhosts[1])
+        fake_backend.set_nameinfo("delegated.example.cam.ac.uk", delegated='Y')
+
+        summary = reject_or_accepted_old_domain_names_requests()
+        self.assertEqual(sorted(summary['accepted']), ["other.example.cam.ac.uk", "test0.example.cam.ac.uk",
+                                                       "test1.example.cam.ac.uk", "test2.example.cam.ac.uk"])
+        self.assertEqual(sorted(summary['rejected']), ["delegated.example.cam.ac.uk",
+                                                       "unchangeable.example.cam.ac.uk"])
+        self.assertEqual(summary['failed'], [])
+        self.assertEqual(DomainName.objects.get(name="recent.example.cam.ac.uk").status, 'requested')
+        self.assertEqual(fake_backend.cnames["test0.example.cam.ac.uk"], "mws-0.mws3.example")
+        # Ansible is launched once in each service
+        self.assertEqual(sorted(call[0][0].id for call in mock_launch_ansible.call_args_list),
+                         sorted(vhost.service.id for vhost in self.vhosts))
+
+    @mock.patch("sitesmanagement.cronjobs.LOGGER")
+    @mock.patch("apimws.ipreg.get_nameinfo")
+    @mock.patch("sitesmanagement.cronjobs.launch_ansible")
+    def test_nameinfo_failure(self, mock_launch_ansible, mock_get_nameinfo, mock_logger):
+        self.request("test.example.cam.ac.uk", self.vhosts[0])
+        mock_get_nameinfo.side_effect = Exception("IPREG API not available")
+        summary = reject_or_accepted_old_domain_names_requests()
+        self.assertEqual(summary['failed'], ["test.example.cam.ac.uk"])
+        self.assertEqual(DomainName.objects.get(name="test.example.cam.ac.uk").status, 'requested')
+        self.assertFalse(mock_launch_ansible.called)
+        self.assertEqual(mock_logger.error.call_count, 1)
+
+    @mock.patch("sitesmanagement.cronjobs.LOGGER")
+    @mock.patch("apimws.ipreg.set_cname")
+    @mock.patch("sitesmanagement.cronjobs.launch_ansible")
+    def test_accept_failure(self, mock_launch_ansible, mock_set_cname, mock_logger):
+        def set_cname(name, target):
+            if name == "failing.example.cam.ac.uk":
+                raise subprocess.CalledProcessError(1, ["put", "cname"], '{"message": "Failed"}')
+        mock_set_cname.side_effect = set_cname
+        self.request("test0.example.cam.ac.uk", self.vhosts[0])
+        self.request("failing.example.cam.ac.uk", self.vhosts[1])
+        self.request("test1.example.cam.ac.uk", self.vhosts[1])
+        summary = reject_or_accepted_old_domain_names_requests()
+        self.assertEqual(summary['accepted'], ["test0.example.cam.ac.uk", "test1.example.cam.ac.uk"])
+        self.assertEqual(summary['failed'], ["failing.example.cam.ac.uk"])
+        # The name that failed is still requested and did not become the main domain of its vhost
+        self.assertEqual(DomainName.objects.get(name="failing.example.cam.ac.uk").status, 'requested')
+        self.assertEqual(Vhost.objects.get(id=self.vhosts[1].id).main_domain.name, "test1.example.cam.ac.uk")
+        # The services of the names accepted before and after the failure are configured
+        self.assertEqual(sorted(call[0][0].id for call in mock_launch_ansible.call_args_list),
+                         sorted(vhost.service.id for vhost in self.vhosts))
+        self.assertEqual(mock_logger.error.call_count, 1)
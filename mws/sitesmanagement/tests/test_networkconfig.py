@@ -0,0 +1,107 @@
+import threading
+from datetime import datetime
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from mock import mock
+from sitesmanagement.models import NetworkConfig, Site, Service, ServerType
+
+
+def create_addresses(number):
+    for n in range(number):
+        NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n, type='ipvxpub',
+                                     name="mws-%d.mws3.example" % n)
+
+
+class NetworkConfigAllocationTests(TestCase):
+
+    def setUp(self):
+        create_addresses(5)
+        self.site = Site.objects.create(name="testSite", start_date=datetime.today(),
+                                        type=ServerType.objects.get(id=1))
+
+    def test_allocate(self):
+        allocated = NetworkConfig.allocate('ipvxpub', 3)
+        self.assertEqual(len(set(netconf.id for netconf in allocated)), 3)
+        self.assertEqual(NetworkConfig.objects.filter(allocated=True).count(), 3)
+        # Only the free ones are left
+        self.assertEqual(len(NetworkConfig.allocate('ipvxpub', 3)), 2)
+        self.assertEqual(NetworkConfig.allocate('ipvxpub'), [])
+        self.assertIsNone(NetworkConfig.get_free_prod_service_config())
+        self.assertIsNone(NetworkConfig.get_free_host_config())
+
+    def test_allocate_race(self):
+        # Another caller reserves the first address found between reading and reserving it, as databases without
+        # skip_locked allow. The address is skipped and the next free one is reserved instead
+        update = QuerySet.update
+        taken = []
+
+        def competing_update(queryset, **kwargs):
+            if not taken:
+                taken.extend(queryset.values_list('id', flat=True))
+                update(NetworkConfig.objects.filter(id__in=taken), allocated=True)
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=competing_update):
+            allocated = NetworkConfig.allocate('ipvxpub', 2)
+        self.assertEqual(len(taken), 1)
+        self.assertEqual(len(allocated), 2)
+        self.assertNotIn(taken[0], [netconf.id for netconf in allocated])
+        self.assertEqual(NetworkConfig.objects.filter(allocated=True).count(), 3)
+        self.assertEqual(len(NetworkConfig.allocate('ipvxpub', 5)), 2)
+
+    def test_released_on_rollback(self):
+        try:
+            with transaction.atomic():
+                NetworkConfig.allocate('ipvxpub', 5)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(NetworkConfig.objects.filter(allocated=True).exists())
+
+    def test_allocated_flag_follows_services(self):
+        first, second = NetworkConfig.objects.order_by('id')[:2]
+        # Addresses assigned without allocating them first are marked as allocated too
+        service = Service.objects.create(site=self.site, type='production', network_configuration=first)
+        first.refresh_from_db()
+        self.assertTrue(first.allocated)
+        self.assertNotEqual(NetworkConfig.get_free_prod_service_config(), first)
+
+        service.network_configuration = second
+        service.save()
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertFalse(first.allocated)
+        self.assertTrue(second.allocated)
+
+        service.delete()
+        second.refresh_from_db()
+        self.assertFalse(second.allocated)
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class NetworkConfigConcurrentAllocationTests(TransactionTestCase):
+
+    def test_parallel_allocation(self):
+        create_addresses(40)
+        results = []
+        errors = []
+
+        def allocate():
+            try:
+                for n in range(5):
+                    results.extend(NetworkConfig.allocate('ipvxpub', 2))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=allocate) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 40)
+        self.assertEqual(len(set(netconf.id for netconf in results)), 40)
+        self.assertFalse(NetworkConfig.objects.filter(allocated=False).exists())
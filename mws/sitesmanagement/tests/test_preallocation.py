@@ -0,0 +1,139 @@
+import json
+import subprocess
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.ipreg import ip_reg_batch, invalidate_cache
+from apimws.utils import preallocate_new_site
+from apimws.xen import clone_vm_api_call, new_site_primary_vm
+from sitesmanagement.cronjobs import check_num_preallocated_sites, release_unused_addresses
+from sitesmanagement.models import Site, Service, NetworkConfig, ServerType, SiteKey
+
+
+PUBKEY = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQClBKpj+/WXlxJMY2iYw1mB1qYLM8YDjFS6qSiT6UmNLLhXJBEfd6vOMErM1IfDsY' \
+         'N+W3604hukxwC859TU4ZLQYD6wFI2D+qMhb2UTcoLlOYD7TG436RXKbxK4iAT7ll3XUT8VxZUq/AZKVsvmH309l5LcW6UPO0PVYoa' \
+         'fpo4+Fmv5c/CRTvp5X0eaoXtgT49h58/GwNlD2RrVPInjI9isa8/k8qiNaWEHYOGKC343BQIR9Sx+5HQ16wf3x3fUFeMTOYfsbvwQ' \
+         '9T5pkKpFoiUYRxjsz7bXdPQPT4A1UrfgmGnTLJGSUh+uvHYLe7izWoMCCDCV0+Zyn0IlrlfmN+cD'
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class PreallocationTests(TestCase):
+
+    def setUp(self):
+        invalidate_cache()
+        self.addCleanup(invalidate_cache)
+        for n in range(8):
+            NetworkConfig.objects.create(IPv4='198.51.100.%d' % n, IPv6='2001:db8:212:8::8c:%d' % n,
+                                         type='ipvxpub', name="mws-%d.mws3.example" % n)
+            NetworkConfig.objects.create(IPv4='172.28.18.%d' % n, type='ipv4priv',
+                                         name='mws-%d.mws3.private.example' % n)
+            NetworkConfig.objects.create(IPv6='2001:db8:212:8::8d:%d' % n, name='mws-guest%d.example' % n,
+                                         type='ipv6')
+
+    @override_settings(MWS_PREALLOCATION_CONCURRENCY=4)
+    @mock.patch("apimws.utils.new_site_primary_vm")
+    def test_check_num_preallocated_sites(self, mock_new_site_primary_vm):
+        small = ServerType.objects.get(id=1)
+        ServerType.objects.filter(id=1).update(preallocated=3)
+        big = ServerType.objects.create(numcpu=4, sizeram=4, sizedisk=80, preallocated=2, price=400, order=2)
+
+        # The deficit of both server types is filled at the same time up to the concurrency limit
+        check_num_preallocated_sites()
+        self.assertEqual(mock_new_site_primary_vm.delay.call_count, 4)
+        self.assertEqual(Site.objects.filter(preallocated=True, type=small).count(), 2)
+        self.assertEqual(Site.objects.filter(preallocated=True, type=big).count(), 2)
+
+        # Nothing else is started while they are being installed
+        check_num_preallocated_sites()
+        self.assertEqual(mock_new_site_primary_vm.delay.call_count, 4)
+
+        Service.objects.update(status='ready')
+        check_num_preallocated_sites()
+        self.assertEqual(mock_new_site_primary_vm.delay.call_count, 5)
+        self.assertEqual(Site.objects.filter(preallocated=True, type=small).count(), 3)
+
+        Service.objects.update(status='ready')
+        check_num_preallocated_sites()
+        self.assertEqual(mock_new_site_primary_vm.delay.call_count, 5)
+
+    @mock.patch("apimws.ipreg.ip_reg_call")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_preallocation_pipeline(self, mock_vm_api_request, mock_subprocess, mock_ip_reg_call):
+        mock_vm_api_request.return_value = '{"vmid": "mws-guest0.example"}'
+        mock_subprocess.Popen().communicate.return_value = ('{"pubkey": "%s"}' % PUBKEY, '')
+        mock_ip_reg_call.return_value = {}
+        preallocate_new_site()
+
+        site = Site.objects.get(preallocated=True)
+        vm = site.production_service.virtual_machines.get()
+        self.assertEqual(vm.name, "mws-guest0.example")
+        self.assertEqual(site.production_service.status, 'installing')
+        self.assertEqual(SiteKey.objects.filter(site=site).count(), len(SiteKey.ALGORITHMS))
+        # 2 fingerprints of the keys that are not ED25519 for the hostnames of both services and the VM
+        self.assertEqual(mock_ip_reg_call.call_count, 3 * 2 * 3)
+        self.assertEqual(set(call[0][0][2] for call in mock_ip_reg_call.call_args_list),
+                         {vm.network_configuration.name, site.production_service.network_configuration.name,
+                          site.test_service.network_configuration.name})
+
+    @mock.patch("apimws.ipreg.ip_reg_call")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_release_unused_addresses_while_queued(self, mock_vm_api_request, mock_subprocess, mock_ip_reg_call):
+        mock_vm_api_request.return_value = '{"vmid": "mws-guest0.example"}'
+        mock_subprocess.Popen().communicate.return_value = ('{"pubkey": "%s"}' % PUBKEY, '')
+        mock_ip_reg_call.return_value = {}
+        with mock.patch("apimws.utils.new_site_primary_vm") as mock_new_site_primary_vm:
+            preallocate_new_site()
+        service, host_netconf = mock_new_site_primary_vm.delay.call_args[0]
+
+        # The address of the VM is kept while the task that creates it is queued
+        release_unused_addresses()
+        self.assertTrue(NetworkConfig.objects.get(id=host_netconf.id).allocated)
+        new_site_primary_vm(service, host_netconf)
+        self.assertEqual(service.virtual_machines.get().network_configuration, host_netconf)
+        self.assertEqual(NetworkConfig.objects.filter(type='ipv6', allocated=True).count(), 1)
+
+    @override_settings(IP_REG_API_BACKEND='userv', IP_REG_API_BATCH=True, MWS_PUBKEY_ALL_KEYTYPES=True)
+    @mock.patch("apimws.ipreg.subprocess.Popen")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request")
+    def test_preallocation_pipeline_batched(self, mock_vm_api_request, mock_subprocess, mock_ipreg_popen):
+        mock_vm_api_request.return_value = '{"vmid": "mws-guest0.example"}'
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkeys": dict(
+            ("ssh"+keytype.lower(), PUBKEY) for keytype in SiteKey.ALGORITHMS)}), '')
+        mock_subprocess.Popen.reset_mock()
+
+        def batch(stdin):
+            calls = json.loads(stdin)
+            # The first record fails, the rest are set
+            return json.dumps([{"error": {"returncode": 1, "message": "Failed"}}] +
+                              [{"result": {}}] * (len(calls) - 1)), ''
+        mock_ipreg_popen.return_value.communicate.side_effect = batch
+        mock_ipreg_popen.return_value.returncode = 0
+        with mock.patch("apimws.xen.LOGGER") as mock_logger:
+            preallocate_new_site()
+
+        self.assertEqual(SiteKey.objects.count(), len(SiteKey.ALGORITHMS))
+        # A single call to get all the keys and a single one to set all the SSHFP records
+        self.assertEqual(mock_subprocess.Popen.call_count, 1)
+        self.assertEqual(mock_ipreg_popen.call_count, 1)
+        calls = json.loads(mock_ipreg_popen.return_value.communicate.call_args[0][0])
+        self.assertEqual(len(calls), 3 * 2 * 3)
+        self.assertEqual(calls[0][:2], ['put', 'sshfp'])
+        # Only the record that failed is reported
+        self.assertEqual(mock_logger.error.call_count, 1)
+        self.assertIn(calls[0][2], mock_logger.error.call_args[0][0])
+
+    def test_clone_vm_releases_address_on_failure(self):
+        site = Site.objects.create(name="testsite", type=ServerType.objects.get(id=1))
+        Service.objects.create(site=site, type='test', network_configuration=NetworkConfig.allocate_one('ipv4priv'))
+        with mock.patch("apimws.xen.which_cluster", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                clone_vm_api_call(site)
+        self.assertFalse(NetworkConfig.objects.filter(type='ipv6', allocated=True).exists())
+
+    @mock.patch("apimws.ipreg.ip_reg_call")
+    def test_ip_reg_batch_without_batch_api(self, mock_ip_reg_call):
+        error = subprocess.CalledProcessError(1, ['put'], '{"message": "Failed"}')
+        mock_ip_reg_call.side_effect = [{}, error, {}]
+        self.assertEqual(ip_reg_batch([['put', 'a'], ['put', 'b'], ['put', 'c']]), [{}, error, {}])
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.test import TestCase, override_settings
+from apimws.ipreg import invalidate_cache
 from apimws.models import AnsibleConfiguration, Cluster, Host
 from apimws.utils import preallocate_new_site
 from apimws.views import post_installation
@@ -313,6 +314,8 @@ class SiteManagementTests(TestCase):
 @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
 class SiteManagement2Tests(TestCase):
     def setUp(self):
+        invalidate_cache()
+        self.addCleanup(invalidate_cache)
         do_test_login(self, user="test0001")
         NetworkConfig.objects.create(IPv4='131.111.58.253', IPv6='2001:630:212:8::8c:253', type='ipvxpub',
                                      name="mws-66424.mws3.csx.cam.ac.uk")
@@ -526,6 +529,7 @@ class SiteManagement2Tests(TestCase):
         response = self.client.get(reverse('listvhost', kwargs={'service_id': site.production_service.id}))
         self.assertInHTML('<td>testVhost</td>', response.content, count=0)
 
+    @override_settings(IP_REG_API_BACKEND='userv')
     def test_domains_management(self):
         site = self.create_site()
 
@@ -96,7 +96,7 @@ def add_domain(request, vhost_id, socket_error=None):
                                     vhost.main_domain.name == vhost.service.network_configuration.name:
                         vhost.main_domain = new_domain
                         vhost.save()
-                launch_ansible(vhost.service)  # to add the new domain name to the vhost apache configuration
+                launch_ansible(vhost.service, 'domains')  # to add the new domain name to the vhost apache configuration
         else:
             breadcrumbs = {
                 0: dict(name='Managed Web Service server: ' + str(site.name), url=site.get_absolute_url()),
@@ -138,7 +138,7 @@ def set_dn_as_main(request, domain_id):
     if request.method == 'POST':
         vhost.main_domain = domain
         vhost.save()
-        launch_ansible(vhost.service)  # to update the vhost main domain name in the apache configuration
+        launch_ansible(vhost.service, 'domains')  # to update the vhost main domain name in the apache configuration
 
     return HttpResponseRedirect(reverse('listdomains', kwargs={'vhost_id': vhost.id}))
 
@@ -155,7 +155,7 @@ class DomainDelete(DomainPriviledgeCheck, DeleteView):
         if self.domain.name != self.domain.vhost.service.network_configuration.name:
             if self.domain != self.domain.vhost.main_domain or self.domain.vhost.domain_names.count() == 1:
                 self.domain.delete()
-                launch_ansible(self.service)
+                launch_ansible(self.service, 'domains')
                 return HttpResponse()
         return HttpResponseForbidden()
 
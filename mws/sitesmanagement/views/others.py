@@ -315,7 +315,7 @@ def php_libs(request, service_id):
                 clear=True
             )
             service.save()
-            launch_ansible(service)
+            launch_ansible(service, 'php_libs')
 
     return render(request, 'mws/phplibs.html', parameters)
 
@@ -363,7 +363,7 @@ def quarantine(request, service_id):
         else:
             service.quarantined = False
         service.save()
-        launch_ansible(service)
+        launch_ansible(service, 'quarantine')
         return redirect(site)
 
     return render(request, 'mws/quarantine.html', parameters)
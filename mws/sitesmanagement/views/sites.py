@@ -232,7 +232,7 @@ class SiteEditEmail(SitePriviledgeCheck, UpdateView):
         super(SiteEditEmail, self).form_valid(form)
         if 'email' in form.changed_data and self.object.email:
             email_confirmation(self.object)
-            launch_ansible_site(self.object)
+            launch_ansible_site(self.object, 'site')
         return redirect(self.object)
 
     def form_invalid(self, form):
@@ -89,7 +89,7 @@ class UnixGroupCreate(ServicePriviledgeCheck, CreateView):
 
         self.object.users.add(*unix_users)
 
-        launch_ansible(self.service)  # to apply these changes to the vm
+        launch_ansible(self.service, 'unix_groups')  # to apply these changes to the vm
         return super(UnixGroupCreate, self).form_valid(form)
 
     def get_success_url(self):
@@ -137,7 +137,7 @@ class UnixGroupUpdate(UnixGroupPriviledgeCheck, UpdateView):
         self.object.users.clear()
         self.object.users.add(*unix_users)
 
-        launch_ansible(self.service)  # to apply these changes to the vm
+        launch_ansible(self.service, 'unix_groups')  # to apply these changes to the vm
         return super(UnixGroupUpdate, self).form_valid(form)
 
     def get_success_url(self):
@@ -159,7 +159,7 @@ class UnixGroupDelete(UnixGroupPriviledgeCheck, DeleteView):
         self.object = self.get_object()
         self.object.to_be_deleted = True
         self.object.save()
-        launch_ansible(self.service)
+        launch_ansible(self.service, 'unix_groups')
         return HttpResponse()
 
     def get_success_url(self):
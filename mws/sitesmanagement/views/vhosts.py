@@ -164,7 +164,7 @@ class VhostCreate(ServicePriviledgeCheck, CreateView):
             self.object = form.save(commit=False)
             self.object.service = self.service
             self.object.save()
-            launch_ansible(self.service)  # to create a new vhost configuration file
+            launch_ansible(self.service, 'vhosts')  # to create a new vhost configuration file
             return HttpResponseRedirect(self.get_success_url())
         except IntegrityError:
             messages.error(self.request, 'This website name already exists')
@@ -202,7 +202,7 @@ class VhostDelete(VhostPriviledgeCheck, DeleteView):
         if vhost_name != "default":
             delete_vhost_ansible.delay(service, vhost_name, webapp)
             super(VhostDelete, self).delete(request, *args, **kwargs)
-            launch_ansible(service)
+            launch_ansible(service, 'vhosts')
             return HttpResponse("The website/vhost '%s' has been deleted successfully" % vhost_name)
         else:
             return HttpResponseForbidden("The default website/vhost cannot be deleted")
@@ -246,7 +246,7 @@ def generate_csr(request, vhost_id):
             vhost.tls_enabled = False
             vhost.save()
 
-        launch_ansible(vhost.service)
+        launch_ansible(vhost.service, 'tls')
 
     return redirect(reverse(certificates, kwargs={'vhost_id': vhost.id}))
 
@@ -317,7 +317,7 @@ def certificates(request, vhost_id):
                 if vhost.tls_key_hash == 'renewal_waiting_cert':
                     vhost.tls_key_hash = 'renewal_cert'
                 vhost.save()
-                launch_ansible(service)
+                launch_ansible(service, 'tls')
             else:
                 raise ValidationError("No Certificate uploaded")
         except ValidationError as e:
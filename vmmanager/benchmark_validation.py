@@ -0,0 +1,35 @@
+"""Compares the time needed to validate the parameters of the VM API commands with jsonschema.validate, which builds
+and checks a new validator every time, and with the validators built once by vmmanager.
+
+    python benchmark_validation.py [number of validations]
+"""
+import sys
+import timeit
+from jsonschema import validate
+import vmmanager
+
+
+PARAMETERS = {
+    'create': {
+        "netconf": {"IPv4": "198.51.100.1", "IPv6": "2001:db8:212:8::8c:1", "hostname": "mws-client1.example"},
+        "features": {"cpu": 1, "maxmem": 2048, "memory": 1024, "disk": 20},
+        "os": "jessie",
+        "callback": {"endpoint": "https://panel.example/api/post_installation", "vm_id": 1, "secret": "secret"},
+    },
+    'delete': {"vmid": "mws-client1.example"},
+    'button': {"vmid": "mws-client1.example", "action": "reboot"},
+}
+
+
+def main(number):
+    print("%-8s %14s %14s %8s" % ("command", "validate (ms)", "compiled (ms)", "speedup"))
+    for command, parameters in sorted(PARAMETERS.items()):
+        schema = vmmanager.operations_json_schemas[command]
+        uncompiled = timeit.timeit(lambda: validate(parameters, schema), number=number)
+        compiled = timeit.timeit(lambda: vmmanager.validate_parameters(command, dict(parameters)), number=number)
+        print("%-8s %14.3f %14.3f %7.1fx" % (command, uncompiled * 1000 / number, compiled * 1000 / number,
+                                             uncompiled / compiled))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
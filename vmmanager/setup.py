@@ -2,7 +2,7 @@ from setuptools import setup
 
 setup(
     name='vmmanager',
-    version='0.15',
+    version='0.18',
     py_modules=['vmmanager'],
     include_package_data=True,
     install_requires=[
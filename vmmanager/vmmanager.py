@@ -1,9 +1,11 @@
 import click
 import json
 import six
+import sys
 import ipaddress
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE, STDOUT
-from jsonschema import validate
+from jsonschema.validators import validator_for
 
 
 default_options = {
@@ -138,8 +140,54 @@ button_parameters_json_schema = {
 }
 
 
-class OSNotSupportedException(Exception):
-    pass
+operations_json_schemas = {
+    'create': create_parameters_json_schema,
+    'delete': delete_parameters_json_schema,
+    'button': button_parameters_json_schema,
+    'clone': create_parameters_json_schema,
+}
+
+
+# Building a validator checks the schema itself, which is much slower than validating the parameters, so they are
+# only built once
+operations_validators = dict((command, validator_for(schema)(schema))
+                             for command, schema in operations_json_schemas.items())
+
+
+class InvalidParametersException(click.ClickException):
+    """The parameters of a command are not valid. errors is the list of problems found, each of them a dict with
+    the path of the parameter (a list of keys) and a message"""
+
+    def __init__(self, command, errors):
+        self.command = command
+        self.errors = errors
+        super(InvalidParametersException, self).__init__(
+            "The parameters of %s are not valid: %s" % (command, "; ".join(
+                "%s: %s" % ("/".join(map(six.text_type, error['path'])) or "parameters", error['message'])
+                for error in errors)))
+
+    def to_dict(self):
+        return {"command": self.command, "errors": self.errors}
+
+
+def validate_parameters(command, parameters):
+    """Validates the parameters of a command and fills in the default OS of create and clone
+    :raises InvalidParametersException: with all the problems found
+    """
+    errors = [{"path": list(error.path), "message": error.message}
+              for error in operations_validators[command].iter_errors(parameters)]
+    if not errors and command in ('create', 'clone'):
+        for version in ('IPv4', 'IPv6'):
+            if version in parameters['netconf']:
+                try:
+                    ipaddress.ip_address(six.text_type(parameters['netconf'][version]))
+                except ValueError as e:
+                    errors.append({"path": ["netconf", version], "message": str(e)})
+        parameters.setdefault('os', default_options['os'])
+        if parameters['os'] not in OS_SUPPORTED:
+            errors.append({"path": ["os"], "message": "The OS selected is not supported"})
+    if errors:
+        raise InvalidParametersException(command, errors)
 
 
 class JsonParamType(click.ParamType):
@@ -166,23 +214,7 @@ class VirtualMachinesManager(object):
     def create(self, parameters):
         """This function creates a new VM with the parameters and options passed in parameters"""
 
-        try:
-            validate(parameters, create_parameters_json_schema)
-            # Validation of IPv4 address
-            if 'IPv4' in parameters['netconf']:
-                ipaddress.ip_address(parameters['netconf']['IPv4'])
-            if 'IPv6' in parameters['netconf']:
-                ipaddress.ip_address(parameters['netconf']['IPv6'])
-            if 'os' not in parameters:
-                parameters['os'] = default_options['os']
-            if parameters['os'] not in OS_SUPPORTED:
-                raise OSNotSupportedException
-        except ValueError:
-            self.fail("The JSON parameter needs to be properly formatted")
-            # raise click.ClickException("The JSON parameter needs to be properly formatted")
-        except OSNotSupportedException:
-            self.fail("The OS selected is not supported")
-            # raise click.ClickException("The OS selected is not supported")
+        validate_parameters('create', parameters)
 
         p = Popen(["userv", "-w1=close", "-w2=close", "root", "vm_create"], stdout=PIPE, stdin=PIPE, stderr=PIPE)
         output = p.communicate(input=json.dumps(parameters))
@@ -195,11 +227,7 @@ class VirtualMachinesManager(object):
     def delete(self, parameters):
         """This function deletes the vm with id = vmid"""
 
-        try:
-            validate(parameters, delete_parameters_json_schema)
-        except ValueError:
-            self.fail("The JSON parameter needs to be properly formatted")
-            # raise click.ClickException("The JSON parameter needs to be properly formatted")
+        validate_parameters('delete', parameters)
 
         p = Popen(["userv", "root", "vm_delete"], 
                   stdout=PIPE, stdin=PIPE, stderr=PIPE)
@@ -214,11 +242,7 @@ class VirtualMachinesManager(object):
         """This function manages all the options related with power management of the VM.
         It can power on or power off the VM, and shutdown or reboot it."""
 
-        try:
-            validate(parameters, button_parameters_json_schema)
-        except ValueError:
-            self.fail("The JSON parameter needs to be properly formatted")
-            # raise click.ClickException("The JSON parameter needs to be properly formatted")
+        validate_parameters('button', parameters)
 
         p = Popen(["userv", "root", "vm_button"], stdout=PIPE, stdin=PIPE, stderr=PIPE)
         output = p.communicate(input=json.dumps(parameters))
@@ -234,6 +258,59 @@ class VirtualMachinesManager(object):
         pass
 
 
+def run_operation(command, parameters, vmid=None):
+    """Runs one of the commands of the VM API and returns what the one-shot command would have printed"""
+    if command == 'create':
+        return VirtualMachinesManager.create(parameters)
+    elif command == 'delete':
+        return VirtualMachinesManager.delete(parameters)
+    elif command == 'button':
+        return VirtualMachinesManager.button(parameters)
+    elif command == 'clone':
+        response = VirtualMachinesManager.create(parameters)
+        VirtualMachinesManager.copy(vmid, json.loads(response)['vmid'])
+        return response
+    raise click.ClickException("Unknown command: %s" % command)
+
+
+def validate_operation(operation):
+    """Checks an operation of a batch before anything is run. Returns a dict describing why it is not valid or None"""
+    if not isinstance(operation, dict):
+        return {"error": "The operation needs to be a JSON object"}
+    command = operation.get('command')
+    if command not in operations_json_schemas:
+        return {"error": "Unknown command: %s" % command}
+    try:
+        validate_parameters(command, operation.get('parameters', {}))
+    except InvalidParametersException as e:
+        return {"error": e.format_message(), "errors": e.errors}
+    if command == 'clone' and not operation.get('vmid'):
+        return {"error": "The clone command needs the vmid of the VM to be cloned"}
+    return None
+
+
+def run_batch_operation(operation):
+    """Runs an operation of a batch (or a request of serve) and returns its response, it never raises"""
+    if not isinstance(operation, dict):
+        return {"id": None, "status": "error", "error": "The operation needs to be a JSON object"}
+    response = {"id": operation.get("id")}
+    try:
+        response["output"] = run_operation(operation['command'], operation.get('parameters', {}),
+                                           operation.get('vmid'))
+        response["status"] = "ok"
+    except InvalidParametersException as e:
+        response["status"] = "error"
+        response["error"] = e.format_message()
+        response["errors"] = e.errors
+    except click.ClickException as e:
+        response["status"] = "error"
+        response["error"] = e.format_message()
+    except Exception as e:
+        response["status"] = "error"
+        response["error"] = "%s: %s" % (e.__class__.__name__, e)
+    return response
+
+
 @click.group()
 def cli():
     pass
@@ -265,3 +342,66 @@ def clone(vmid, json_parameters):
     response = VirtualMachinesManager.create(json_parameters)
     VirtualMachinesManager.copy(vmid, response['vmid'])
     click.echo(json.dumps(response))
+
+
+@cli.command()
+def serve():
+    """Reads requests as JSON lines from stdin and writes a JSON line with the response to each of them to stdout
+    until stdin is closed, so that many commands can be sent over a single connection.
+
+    Requests: {"id": 1, "command": "button", "parameters": {...}} ("vmid" is also needed by clone)
+    Responses: {"id": 1, "status": "ok", "output": "..."} or {"id": 1, "status": "error", "error": "..."}
+    """
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = {"id": None, "status": "error", "error": "The JSON parameter needs to be properly formatted"}
+        else:
+            response = run_batch_operation(request)
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+
+
+@cli.command()
+@click.option('--concurrency', default=4, type=click.IntRange(1, 64), help="Operations run at the same time")
+def batch(concurrency):
+    """Runs many operations read as JSON lines from stdin, in the same format as the requests of serve.
+    All the operations are validated before any of them is run: if one of them is not valid nothing is run.
+    The result of each operation is written as a JSON line as soon as it finishes, so they may come out of order.
+    """
+    operations = []
+    errors = []
+    for number, line in enumerate(sys.stdin, 1):
+        if not line.strip():
+            continue
+        try:
+            operation = json.loads(line)
+        except ValueError:
+            errors.append({"line": number, "error": "The JSON parameter needs to be properly formatted"})
+            continue
+        error = validate_operation(operation)
+        if error:
+            errors.append(dict(error, line=number, id=operation.get("id") if isinstance(operation, dict) else None))
+        else:
+            operation.setdefault("id", number)
+            operations.append(operation)
+    if errors:
+        for error in errors:
+            click.echo(json.dumps(dict(error, status="invalid")))
+        raise click.ClickException("%d operations are not valid, none has been run" % len(errors))
+
+    failed = 0
+    pool = ThreadPool(min(concurrency, len(operations)) or 1)
+    try:
+        for response in pool.imap_unordered(run_batch_operation, operations):
+            if response["status"] != "ok":
+                failed += 1
+            click.echo(json.dumps(response))
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        raise click.ClickException("%d of %d operations failed" % (failed, len(operations)))